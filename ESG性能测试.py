@@ -0,0 +1,146 @@
+# esg_benchmark.py
+# ESG分析流程性能测试：生成MSCI格式的合成数据，逐阶段记录耗时和内存，结果写入JSON便于对比回归
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from ESG总体分析 import ESGDataAnalyzer, StageInstrumentation, DEFAULT_CHUNKSIZE, QUERY_BACKENDS, RATING_SCALE
+
+# 合成数据的行业列表（MSCI IVA行业名称）
+SYNTHETIC_INDUSTRIES = [
+    'Banks', 'Utilities', 'Software & Services', 'Telecommunication Services', 'Pharmaceuticals',
+    'Oil & Gas Exploration & Production', 'Specialty Chemicals', 'Food Products', 'Automobiles',
+    'Auto Components', 'Biotechnology', 'Building Products', 'Casinos & Gaming', 'Restaurants',
+    'Construction Materials', 'Containers & Packaging', 'Diversified Financials', 'Electrical Equipment',
+    'Industrial Machinery', 'Media & Entertainment', 'Paper & Forest Products', 'Road & Rail Transport',
+    'Semiconductors & Semiconductor Equipment', 'Real Estate Development & Diversified Activities',
+]
+# 一次写入CSV的行数，保证生成5000万行时内存可控
+GENERATOR_CHUNK_ROWS = 1_000_000
+
+
+def generate_synthetic_esg(n_rows, path, seed=0, n_issuers=None, n_snapshots=4):
+    """生成MSCI格式的合成ESG数据CSV，字段与 identify_key_fields 识别的字段一致
+
+    每个快照日期下每个发行人恰好一行，(发行人, 日期) 不重复；行数超过 发行人数×快照数 时自动增加快照期数。
+    """
+    rng = np.random.default_rng(seed)
+    n_issuers = n_issuers or max(10, min(n_rows // n_snapshots, 200_000))
+    n_snapshots = max(n_snapshots, -(-n_rows // n_issuers))
+    snapshot_dates = pd.date_range('2019-06-30', periods=n_snapshots, freq='12ME').strftime('%Y-%m-%d')
+    issuer_industry = rng.integers(0, len(SYNTHETIC_INDUSTRIES), n_issuers)
+    industries = np.array(SYNTHETIC_INDUSTRIES)
+    ratings = np.array(RATING_SCALE)
+
+    written = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        while written < n_rows:
+            rows = min(GENERATOR_CHUNK_ROWS, n_rows - written)
+            position = np.arange(written, written + rows)
+            issuer = position % n_issuers
+            pillars = rng.uniform(0, 10, (rows, 3)).round(1)
+            total = np.clip(pillars.mean(axis=1) + rng.normal(0, 0.8, rows), 0, 10).round(2)
+            rating_code = np.clip((total / 10 * len(ratings)).astype(int), 0, len(ratings) - 1)
+            chunk = pd.DataFrame({
+                'ISSUERID': issuer,
+                'ISSUER_NAME': np.char.add('ISSUER ', issuer.astype(str)),
+                'AS_OF_DATE': np.asarray(snapshot_dates)[position // n_issuers],
+                'IVA_COMPANY_RATING': ratings[rating_code],
+                'IVA_INDUSTRY': industries[issuer_industry[issuer]],
+                'WEIGHTED_AVERAGE_SCORE': total,
+                'ENVIRONMENTAL_PILLAR_SCORE': pillars[:, 0],
+                'SOCIAL_PILLAR_SCORE': pillars[:, 1],
+                'GOVERNANCE_PILLAR_SCORE': pillars[:, 2],
+                'CARBON_EMISSIONS_SCORE': rng.uniform(0, 10, rows).round(1),
+                'BOARD_MEETINGS_HELD': rng.integers(1, 13, rows),
+            })
+            chunk.to_csv(f, index=False, header=(written == 0))
+            written += rows
+    return path
+
+
+def benchmark_pipeline(csv_path, mode='memory', chunksize=DEFAULT_CHUNKSIZE, trace_memory=True):
+    """运行 run_complete_analysis，返回 StageInstrumentation 记录的每个阶段测量结果
+
+    mode: memory(整体读入) / streaming(pandas分块) / duckdb、polars(惰性查询后端)
+    """
+    chart_dir = tempfile.mkdtemp(prefix='esg_bench_charts_')
+    instrumentation = StageInstrumentation(trace_memory=trace_memory)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            analyzer = ESGDataAnalyzer(csv_path, chunksize=chunksize if mode == 'streaming' else None,
+                                       output_dir=chart_dir, instrumentation=instrumentation,
+                                       backend=mode if mode in QUERY_BACKENDS else 'pandas')
+            completed = analyzer.run_complete_analysis(raise_errors=True)
+        if not completed:
+            raise RuntimeError(f'分析未完成: {csv_path}')
+    finally:
+        shutil.rmtree(chart_dir, ignore_errors=True)
+    return [{k: v for k, v in record.items() if k != 'file'} for record in instrumentation.records]
+
+
+def run_benchmarks(sizes, modes, output, data_dir=None, seed=0, chunksize=DEFAULT_CHUNKSIZE,
+                   trace_memory=True, keep_data=False):
+    """按数据规模和加载模式运行基准测试，结果写入JSON"""
+    data_dir = data_dir or tempfile.mkdtemp(prefix='esg_bench_data_')
+    os.makedirs(data_dir, exist_ok=True)
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'runs': [],
+    }
+
+    for size in sizes:
+        # 文件名带数据布局版本：旧版生成器会产生重复的(发行人, 日期)，不复用旧文件
+        csv_path = os.path.join(data_dir, f'synthetic_esg_v2_{size}.csv')
+        if not os.path.exists(csv_path):
+            print(f"🧪 生成合成数据: {size} 行 -> {csv_path}")
+            generate_synthetic_esg(size, csv_path, seed=seed)
+        for mode in modes:
+            print(f"⏱️ 测试 {size} 行, 模式: {mode}")
+            records = benchmark_pipeline(csv_path, mode=mode, chunksize=chunksize, trace_memory=trace_memory)
+            total = sum(r['wall_s'] for r in records)
+            results['runs'].append({'rows': size, 'mode': mode, 'file_bytes': os.path.getsize(csv_path),
+                                    'total_wall_s': round(total, 4), 'stages': records})
+            slowest = max(records, key=lambda r: r['wall_s'])
+            print(f"   总耗时 {total:.2f}s，最慢阶段: {slowest['stage']} ({slowest['wall_s']:.2f}s)")
+        if not keep_data:
+            os.remove(csv_path)
+
+    with open(output + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    os.replace(output + '.tmp', output)
+    print(f"💾 基准测试结果已写入: {output}")
+    return results
+
+
+# 主程序入口
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ESG分析流程性能测试')
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='合成数据行数，逗号分隔（支持10k到5000万行）')
+    parser.add_argument('--modes', default='memory,streaming', help='加载模式: memory, streaming, duckdb, polars')
+    parser.add_argument('--output', default='bench_results.json', help='结果JSON文件路径')
+    parser.add_argument('--data-dir', default=None, help='合成数据目录（默认临时目录）')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='流式模式每块行数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子，保证结果可复现')
+    parser.add_argument('--no-tracemalloc', action='store_true', help='关闭tracemalloc（减少测量开销）')
+    parser.add_argument('--keep-data', action='store_true', help='保留生成的CSV文件')
+    args = parser.parse_args()
+
+    run_benchmarks([int(size) for size in args.sizes.split(',')], args.modes.split(','), args.output,
+                   data_dir=args.data_dir, seed=args.seed, chunksize=args.chunksize,
+                   trace_memory=not args.no_tracemalloc, keep_data=args.keep_data)
@@ -1,221 +1,3201 @@
 # csmar_financial_analysis.py
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 import warnings
 import os
+import json
+import hashlib
+import re
+import shutil
+import bisect
+import codecs
+import unicodedata
+import sys
+import glob
+import contextlib
+import logging
+import platform
+import time
+import tracemalloc
+import base64
+from collections import Counter
+from functools import lru_cache, reduce
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+try:
+    import resource  # 仅Unix可用，用于读取进程峰值内存
+except ImportError:
+    resource = None
 
 warnings.filterwarnings('ignore')
 #忽略所有显示
 
+# 分析过程的输出统一走日志：默认INFO级别、只输出消息本身（与原来的print一致）
+# 批处理/生产环境设置 ESG_LOG_LEVEL=WARNING 即可静默，预览表和统计表不会被格式化成字符串
+logger = logging.getLogger('esg')
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """每次输出时取当前的sys.stdout，使 contextlib.redirect_stdout 仍能捕获日志"""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class _JsonFormatter(logging.Formatter):
+    """结构化日志：每条消息输出一行JSON，便于日志管道解析"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage().strip(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging(level=None, structured=None, stream=None):
+    """配置ESG日志：level为级别名或数值，structured为True时输出JSON行，stream为空时写入当前stdout
+
+    未指定的参数取环境变量 ESG_LOG_LEVEL（默认INFO）和 ESG_LOG_FORMAT（json/text）。
+    """
+    level = level or os.environ.get('ESG_LOG_LEVEL', 'INFO')
+    if structured is None:
+        structured = os.environ.get('ESG_LOG_FORMAT', 'text').lower() == 'json'
+    handler = logging.StreamHandler(stream) if stream is not None else _StdoutHandler()
+    handler.setFormatter(_JsonFormatter() if structured else logging.Formatter('%(message)s'))
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    return logger
+
+
+class _LazyText:
+    """延迟生成的日志参数：只有消息真正输出时才调用func"""
+
+    __slots__ = ('func', 'args', 'kwargs')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+def _bullet_list(items):
+    return ''.join(f'\n  - {item}' for item in items)
+
+
+configure_logging()
+
+# 统一后的分析字段名
+SCORE_COLUMNS = ['total_esg_score', 'environmental_score', 'social_score', 'governance_score']
+# 三大支柱分数字段，情景权重表的列可以用字段名或 E/S/G 简写
+PILLAR_COLUMNS = SCORE_COLUMNS[1:]
+PILLAR_ALIASES = {'E': 'environmental_score', 'S': 'social_score', 'G': 'governance_score'}
+# 字段分类关键词：基础信息 / E / S / G / 评分
+FIELD_CATEGORY_KEYWORDS = {
+    'basic': ['issuer', 'name', 'date', 'country', 'industry', 'rating'],
+    'environmental': ['environment', 'climate', 'carbon', 'energy', 'water', 'waste', 'biodiv'],
+    'social': ['social', 'human', 'labor', 'health', 'safety', 'product', 'privacy'],
+    'governance': ['governance', 'board', 'committee', 'director', 'audit', 'ethics'],
+    'score': ['score'],
+}
+# 关键字段角色关键词，每个角色取第一个匹配的字段
+KEY_FIELD_KEYWORDS = {
+    'name': ['issuer_name', 'name', 'company'],
+    'date': ['date', 'as_of_date', 'rating_date'],
+    'rating': ['rating', 'iva_company_rating'],
+    'industry': ['industry', 'iva_industry'],
+    'total_score': ['weighted_average_score', 'total_score', 'overall_score'],
+    'environmental_score': ['environmental_pillar_score'],
+    'social_score': ['social_pillar_score'],
+    'governance_score': ['governance_pillar_score'],
+}
+
+
+def _keyword_pattern(keywords):
+    return re.compile('|'.join(re.escape(keyword) for keyword in keywords))
+
+
+_CATEGORY_PATTERNS = {category: _keyword_pattern(keywords)
+                      for category, keywords in FIELD_CATEGORY_KEYWORDS.items()}
+_KEY_FIELD_PATTERNS = {role: _keyword_pattern(keywords)
+                       for role, keywords in KEY_FIELD_KEYWORDS.items()}
+
+
+class FieldIndex:
+    """字段分类索引：一次遍历表头，记录每个字段的E/S/G/基础/评分类别和关键字段角色"""
+
+    def __init__(self, columns):
+        self.columns = tuple(columns)
+        self.categories = {}                                       # 字段 -> 所属类别
+        self.by_category = {category: [] for category in _CATEGORY_PATTERNS}
+        self.key_fields = {role: None for role in _KEY_FIELD_PATTERNS}
+        self.roles = {}                                            # 字段 -> 关键字段角色
+
+        for col in self.columns:
+            lowered = str(col).lower()
+            matched = [category for category, pattern in _CATEGORY_PATTERNS.items()
+                       if pattern.search(lowered)]
+            self.categories[col] = matched
+            for category in matched:
+                self.by_category[category].append(col)
+            for role, pattern in _KEY_FIELD_PATTERNS.items():
+                if self.key_fields[role] is None and pattern.search(lowered):
+                    self.key_fields[role] = col
+                    self.roles.setdefault(col, []).append(role)
+
+    def fields(self, category):
+        return self.by_category.get(category, [])
+
+    def role_of(self, column):
+        return self.roles.get(column, [])
+
+
+@lru_cache(maxsize=32)
+def _cached_field_index(columns):
+    return FieldIndex(columns)
+
+
+def build_field_index(columns):
+    """按表头签名缓存的字段分类索引"""
+    return _cached_field_index(tuple(columns))
+
+
+# 流式读取时每块的默认行数
+DEFAULT_CHUNKSIZE = 200_000
+# ESG总分直方图的固定分箱（MSCI评分范围0-10），固定分箱才能跨数据块合并
+# 默认按MSCI的0-10分制分箱；其他分制(如0-100)通过 hist_range / ESG_HIST_RANGE 指定，超出范围时会给出警告
+SCORE_HIST_RANGE = (0.0, 10.0)
+SCORE_HIST_BINS = 20
+# 行业分组统计在数据块达到该行数且指定了多个进程时改为分片并行计算
+SHARDED_GROUPBY_MIN_ROWS = 2_000_000
+# 情景排名时每块处理的 情景数×记录数 上限，控制排序的临时内存
+SCENARIO_RANK_BLOCK = 1 << 21
+# MSCI评级从低到高的顺序
+RATING_SCALE = ['CCC', 'B', 'BB', 'BBB', 'A', 'AA', 'AAA']
+# 统一的评级序数：编码1..9依次为C..AAA（兼容华证等九级评级体系），0表示无法识别或缺失；+/-修饰不影响编码
+RATING_ORDINAL_SCALE = ['C', 'CC'] + RATING_SCALE
+RATING_UNRATED = 'NR'
+# 常见日期格式，按顺序尝试
+DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%Y%m%d', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%m/%d/%Y', '%d/%m/%Y']
+# 编码检测的候选编码（CSMAR导出文件常见编码，按优先级排列）和采样字节数
+ENCODING_CANDIDATES = ['utf-8', 'gbk', 'gb18030']
+ENCODING_SAMPLE_BYTES = 4 << 20
+# 列式缓存格式版本，缓存结构变化时递增
+CACHE_VERSION = 5
+# 图表样式（主进程和渲染工作进程共用，首次绘图时才应用）
+PLOT_RC_PARAMS = {
+    'font.sans-serif': ['SimHei', 'DejaVu Sans', 'Arial'],
+    'axes.unicode_minus': False,
+    'figure.figsize': (16, 14),  # 增大默认图像尺寸，提供更多空间
+    'figure.dpi': 150,  # 提高分辨率
+    'savefig.dpi': 300,  # 保存图像时的分辨率
+    'font.size': 12,
+    'axes.titlesize': 14,
+    'axes.labelsize': 12,
+    'xtick.labelsize': 10,
+    'ytick.labelsize': 10,
+    'legend.fontsize': 10,
+    'figure.titlesize': 16,
+}
+# 无界面渲染时默认输出的图片格式
+DEFAULT_FIGURE_FORMATS = ('png',)
+# 增量状态文件格式版本
+STATE_VERSION = 2
+# 内存映射评分存储的格式版本
+SCORE_STORE_VERSION = 1
+# 报告产物格式版本，报告结构变化时递增
+REPORT_VERSION = 1
+# 行业同业排名索引的文件格式版本
+PEER_INDEX_VERSION = 1
+# 近似分析草图的序列化格式版本
+SKETCH_VERSION = 1
+# 数据质量校验：分数的合理取值范围，以及各项问题占比的上限(超过即判定为不合格)
+SCORE_RANGE = (0.0, 10.0)
+QUALITY_THRESHOLDS = {
+    'date_unparsed': 0.01,
+    'null': 0.05,
+    'score_non_numeric': 0.001,
+    'score_out_of_range': 0.001,
+    'unknown_rating': 0.01,
+    'duplicate_key': 0.001,
+}
+# 近似分析模式的草图参数：KLL的k、HyperLogLog的精度p、count-min的宽度/深度、保留的高频候选数
+SKETCH_KLL_K = 200
+SKETCH_HLL_PRECISION = 14
+SKETCH_CM_WIDTH = 2048
+SKETCH_CM_DEPTH = 5
+SKETCH_TOP_CAPACITY = 64
+# 热启动时默认读取的分析字段（另外总是读取全部数值字段，描述统计与冷启动一致）；
+# as_of_date 为解析后的评级日期，热启动时代替原始日期字段
+CACHE_COLUMNS = ['company_name', 'year', 'as_of_date', 'esg_rating', 'esg_rating_code', 'industry'] + SCORE_COLUMNS
+# 惰性查询后端读取CSV时视为缺失值的字符串（与pandas默认的na_values一致）
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                 '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+# run_complete_analysis 的分析阶段，顺序与执行顺序一致
+PIPELINE_STAGES = ['load', 'explore', 'identify', 'prepare', 'metrics', 'descriptive', 'visualise', 'report']
+
+
+def _parse_hist_range(text):
+    """'下限,上限' -> (下限, 上限)；必须恰好两个有限数值且下限小于上限，否则抛出 ValueError"""
+    parts = [part.strip() for part in text.split(',')]
+    if len(parts) != 2:
+        raise ValueError(f'需要 "下限,上限" 两个数值，实际为: {text!r}')
+    try:
+        low, high = (float(part) for part in parts)
+    except ValueError:
+        raise ValueError(f'下限和上限必须是数值，实际为: {text!r}') from None
+    if not (np.isfinite(low) and np.isfinite(high) and low < high):
+        raise ValueError(f'下限必须小于上限且均为有限数值，实际为: {text!r}')
+    return low, high
+
+
+def _detect_date_format(values, sample_size=200):
+    """用少量样本确定日期格式，识别失败返回None"""
+    sample = pd.Series(values).dropna().astype(str).head(sample_size)
+    if sample.empty:
+        return None
+    for fmt in DATE_FORMATS:
+        if pd.to_datetime(sample, format=fmt, errors='coerce').notna().all():
+            return fmt
+    return None
+
+
+def _parse_dates(values, date_format=None, errors='raise'):
+    """按显式格式一次性解析日期列，格式未知时退回自动推断"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return pd.Series(values)
+    if date_format is None:
+        date_format = _detect_date_format(values)
+    if date_format is None:
+        return pd.to_datetime(values, errors=errors)
+    return pd.to_datetime(values, format=date_format, errors=errors)
+
+
+def _detect_encoding(file_path, sample_bytes=ENCODING_SAMPLE_BYTES):
+    """读取文件开头的样本判断编码：有UTF-8 BOM为utf-8-sig，整个样本能按UTF-8解码则为utf-8
+
+    否则按行统计：含非ASCII字符的行中至少一半能按UTF-8解码时仍为utf-8（少数其他编码的行由
+    _DecodingReader 逐行修复并计数）；其余情况在GBK/GB18030中选择能解码最多行的编码，相同时取GBK。
+    GB18030几乎能"解码"任何字节序列，因此不作为整个样本的后备编码。
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(sample_bytes)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    final = len(sample) < sample_bytes
+    try:
+        # 增量解码：样本末尾被截断的多字节字符不算错误
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=final)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    lines = sample.splitlines()
+    if not final:
+        lines = lines[:-1]
+    lines = [line for line in lines if not line.isascii()]
+
+    def decodable(encoding):
+        count = 0
+        for line in lines:
+            try:
+                line.decode(encoding)
+                count += 1
+            except UnicodeDecodeError:
+                pass
+        return count
+    if decodable('utf-8') * 2 >= len(lines):
+        return 'utf-8'
+    return max([enc for enc in ENCODING_CANDIDATES if enc != 'utf-8'], key=decodable)
+
+
+class _DecodingReader:
+    """按块流式解码的文本读取器，供 read_csv 使用，整个文件只解码一遍
+
+    每块在换行处截断后整块解码（快路径）；整块失败时逐行解码，无法用主编码解码的行
+    依次尝试其他候选编码，仍失败则替换非法字节。这类行数记录在 mixed_rows 中，不中断加载。
+    """
+
+    def __init__(self, file_path, encoding, block_size=1 << 20):
+        self._file = open(file_path, 'rb')
+        self.encoding = encoding
+        if encoding == 'utf-8-sig':
+            # BOM只在文件开头出现一次，之后按普通UTF-8解码
+            if self._file.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+                self._file.seek(0)
+            encoding = 'utf-8'
+        self._codec = encoding
+        self._fallbacks = [enc for enc in ENCODING_CANDIDATES if enc != encoding]
+        self._block_size = block_size
+        self._pending = b''
+        self._buffer = ''
+        self.mixed_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self._file.close()
+
+    def _next_block(self):
+        data = self._pending + self._file.read(self._block_size)
+        self._pending = b''
+        if not data:
+            return None
+        # 在最后一个换行处截断，保证不会切断多字节字符（GBK/GB18030的尾字节不含0x0A）；单行超过块大小时继续读
+        cut = data.rfind(b'\n')
+        while cut < 0:
+            more = self._file.read(self._block_size)
+            if not more:
+                break
+            data += more
+            cut = data.rfind(b'\n')
+        if cut >= 0:
+            data, self._pending = data[:cut + 1], data[cut + 1:]
+        try:
+            return data.decode(self._codec)
+        except UnicodeDecodeError:
+            return ''.join(map(self._decode_line, data.splitlines(keepends=True)))
+
+    def _decode_line(self, line):
+        try:
+            return line.decode(self._codec)
+        except UnicodeDecodeError:
+            self.mixed_rows += 1
+        for encoding in self._fallbacks:
+            try:
+                return line.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+        return line.decode(self._codec, errors='replace')
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            block = self._next_block()
+            if block is None:
+                break
+            self._buffer += block
+        if size is None or size < 0:
+            text, self._buffer = self._buffer, ''
+        else:
+            text, self._buffer = self._buffer[:size], self._buffer[size:]
+        return text
+
+    def readline(self):
+        while '\n' not in self._buffer:
+            block = self._next_block()
+            if block is None:
+                break
+            self._buffer += block
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+
+def _rating_text(value):
+    """评级文本的统一写法：全角转半角、去空白、大写、去掉"级"后缀（保留+/-修饰）"""
+    return unicodedata.normalize('NFKC', str(value)).strip().upper().removesuffix('级').strip()
+
+
+def _rating_modifier(value):
+    """评级的+/-修饰，没有修饰或不是文本评级时为空字符串"""
+    if isinstance(value, str):
+        text = _rating_text(value)
+        if text[-1:] in ('+', '-') and _rating_code(value) > 0:
+            return text[-1]
+    return ''
+
+
+def _rating_code(value):
+    """单个评级 -> 序数编码：MSCI字母评级、华证九级评级(含"AAA级"、全角字母)和数字等级1..7
+
+    编码只区分字母等级，A+/A/A- 的编码相同（用于迁移矩阵等按等级汇总的计算）；修饰符保留在原评级中。
+    """
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return 0
+    if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool):
+        grade = float(value)
+    else:
+        text = _rating_text(value).rstrip('+-').strip()
+        if text in RATING_ORDINAL_SCALE:
+            return RATING_ORDINAL_SCALE.index(text) + 1
+        try:
+            grade = float(text)
+        except ValueError:
+            return 0
+    # 数字等级1..7对应MSCI的CCC..AAA
+    if grade.is_integer() and 1 <= grade <= len(RATING_SCALE):
+        return RATING_ORDINAL_SCALE.index(RATING_SCALE[int(grade) - 1]) + 1
+    return 0
+
+
+def rating_codes(values):
+    """评级列 -> int8序数编码（向量化：只对不同取值查表一次，再按取值编号批量映射）"""
+    values = pd.Series(values)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        positions, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        positions, uniques = pd.factorize(values)
+    # 多出的最后一项对应缺失值(编号-1)
+    lookup = np.array([_rating_code(value) for value in uniques] + [0], dtype='int8')
+    return lookup[positions]
+
+
+def rating_labels(codes):
+    """序数编码 -> 评级标签，0为 RATING_UNRATED"""
+    labels = np.array([RATING_UNRATED] + RATING_ORDINAL_SCALE, dtype=object)
+    return labels[np.asarray(codes, dtype='int64')]
+
+
+def _normalize_rating_counts(counts):
+    """按原始评级的计数 -> 按统一写法合并后的计数(如"aa级"与"AA"合并)；+/-修饰保留为不同的评级，
+    无法识别的评级保留原标签
+    """
+    if len(counts) == 0:
+        return counts
+    codes = rating_codes(pd.Series(counts.index, dtype=object))
+    modifiers = np.array([_rating_modifier(value) for value in counts.index], dtype=object)
+    labels = np.where(codes > 0, rating_labels(codes) + modifiers, counts.index.astype(str))
+    return counts.groupby(labels, sort=False).sum()
+
+
+def _rating_sort_key(label):
+    """评级排序：统一评级从高到低(AAA..C)，同一等级内 + 在前、- 在后，其他评级排在后面"""
+    code = _rating_code(label)
+    return (0, -code, {'+': 0, '': 1, '-': 2}[_rating_modifier(label)]) if code > 0 else (1, 0, 0)
+
+
+def _migration_counts(codes_from, codes_to, n_codes=len(RATING_ORDINAL_SCALE) + 1):
+    """评级迁移计数矩阵：编码对 (from, to) 合成一个整数后用 np.bincount 一次计数"""
+    pairs = np.asarray(codes_from, dtype='int64') * n_codes + np.asarray(codes_to, dtype='int64')
+    return np.bincount(pairs, minlength=n_codes * n_codes).reshape(n_codes, n_codes)
+
+
+def _normalize_schema(frame):
+    """统一字段类型：文本字段转为分类类型，分数降为float32"""
+    for col in ['company_name', 'industry']:
+        if col in frame.columns and not isinstance(frame[col].dtype, pd.CategoricalDtype):
+            frame[col] = frame[col].astype('category')
+
+    if 'esg_rating' in frame.columns and 'esg_rating_code' not in frame.columns:
+        # 在原评级旁边增加序数编码列(int8)；原评级(含+/-修饰)保持不变，只转为分类类型
+        frame['esg_rating_code'] = rating_codes(frame['esg_rating'])
+        if not isinstance(frame['esg_rating'].dtype, pd.CategoricalDtype):
+            frame['esg_rating'] = frame['esg_rating'].astype('category')
+
+    for col in SCORE_COLUMNS:
+        if col in frame.columns and frame[col].dtype == 'float64':
+            frame[col] = frame[col].astype('float32')
+
+    if 'year' in frame.columns and pd.api.types.is_integer_dtype(frame['year']):
+        frame['year'] = frame['year'].astype('int16')
+    return frame
+
+
+def _content_hash(file_path, block_size=1 << 20):
+    """计算文件内容哈希"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_fingerprint(file_path):
+    """源文件指纹：路径、大小、修改时间（内容哈希按需计算）"""
+    stat = os.stat(file_path)
+    return {
+        'path': os.path.abspath(file_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+class ESGColumnarCache:
+    """prepare_esg_data 结果的Parquet列式缓存，按源文件指纹失效"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _paths(self, file_path):
+        key = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+        base = os.path.join(self.cache_dir, key)
+        return base + '.parquet', base + '.json'
+
+    def load(self, file_path, columns=None):
+        """命中缓存时返回 (数据, 元信息)，否则返回 None"""
+        data_path, meta_path = self._paths(file_path)
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION:
+            return None
+
+        fingerprint = _file_fingerprint(file_path)
+        cached = meta['fingerprint']
+        if (fingerprint['size'], fingerprint['mtime_ns']) != (cached['size'], cached['mtime_ns']):
+            # 修改时间变化但内容未变(如重新下载)时仍可复用缓存
+            if fingerprint['size'] != cached['size'] or _content_hash(file_path) != cached['content_hash']:
+                return None
+            meta['fingerprint'].update(fingerprint)
+            self._write_meta(meta_path, meta)
+
+        if columns is not None:
+            # 按原字段顺序读取指定字段和全部数值字段
+            numeric = set(meta.get('numeric_columns', []))
+            columns = [col for col in meta['columns'] if col in columns or col in numeric]
+        data = pd.read_parquet(data_path, columns=columns)
+        return data, meta
+
+    def store(self, file_path, data, source_columns, key_fields):
+        """写入缓存；先写临时文件再替换，避免留下不完整的缓存"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data_path, meta_path = self._paths(file_path)
+        fingerprint = _file_fingerprint(file_path)
+        fingerprint['content_hash'] = _content_hash(file_path)
+        meta = {
+            'version': CACHE_VERSION,
+            'fingerprint': fingerprint,
+            'source_columns': list(source_columns),
+            'key_fields': key_fields,
+            'columns': [str(col) for col in data.columns],
+            'numeric_columns': [str(col) for col in data.select_dtypes(include=[np.number]).columns],
+        }
+        data = data.copy(deep=False)
+        data.columns = meta['columns']
+        data.to_parquet(data_path + '.tmp', index=False)
+        os.replace(data_path + '.tmp', data_path)
+        self._write_meta(meta_path, meta)
+
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_path + '.tmp', meta_path)
+
+
+def _canonical_json(data):
+    """键排序、无多余空白的JSON，内容相同则字节相同（报告产物的内容哈希基于它计算）"""
+    return json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+class ESGReportStore:
+    """按内容寻址的报告产物存储：objects/<内容哈希>/ 下保存报告JSON、汇总量JSON和Parquet明细表
+
+    refs/<源文件键>.json 记录每个源文件最近一次报告及其输入指纹；源文件未变化时直接读取，无需重跑流程。
+    产物目录先写入临时目录再整体改名，读者不会看到写了一半的报告。
+    """
+
+    TABLES = ('numeric', 'industry', 'ratings')
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def _object_dir(self, object_id):
+        return os.path.join(self.store_dir, 'objects', object_id)
+
+    def _ref_path(self, file_path):
+        key = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.store_dir, 'refs', key + '.json')
+
+    @staticmethod
+    def _tables(aggregates):
+        """报告中的明细表：数值字段统计、行业统计、评级分布"""
+        industry = aggregates.industry_summary()
+        if not industry.empty:
+            industry.columns = industry.columns.get_level_values(-1)
+        ratings = aggregates.sorted_rating_counts().rename('count').rename_axis('esg_rating').to_frame()
+        return {
+            'numeric': aggregates.numeric_summary().T.rename_axis('field'),
+            'industry': industry,
+            'ratings': ratings,
+        }
+
+    def save(self, report, aggregates, source):
+        """写入报告产物并更新源文件的引用，返回产物ID(内容哈希)
+
+        report 中不应包含运行时间等每次都会变化的信息，相同输入得到相同的产物ID。
+        """
+        state = aggregates.to_dict()
+        object_id = hashlib.blake2b(_canonical_json({'report': report, 'aggregates': state}).encode('utf-8'),
+                                    digest_size=16).hexdigest()
+        object_dir = self._object_dir(object_id)
+        if not os.path.isdir(object_dir):
+            tmp_dir = f'{object_dir}.tmp{os.getpid()}'
+            os.makedirs(tmp_dir, exist_ok=True)
+            tables = []
+            try:
+                for name, table in self._tables(aggregates).items():
+                    table.to_parquet(os.path.join(tmp_dir, f'{name}.parquet'))
+                    tables.append(name)
+            except ImportError as e:
+                # 没有安装pyarrow时只写JSON
+                logger.warning('⚠️ 报告明细表未写入Parquet: %s', e)
+            with open(os.path.join(tmp_dir, 'aggregates.json'), 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            with open(os.path.join(tmp_dir, 'report.json'), 'w', encoding='utf-8') as f:
+                json.dump(dict(report, id=object_id, tables=tables), f, ensure_ascii=False, indent=2)
+            try:
+                os.replace(tmp_dir, object_dir)
+            except OSError:
+                # 其他进程已写入相同内容的产物
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        ref_path = self._ref_path(source)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        fingerprint = _file_fingerprint(source)
+        fingerprint['content_hash'] = report['inputs']['content_hash']
+        ref = {'object': object_id, 'fingerprint': fingerprint, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        _write_json(ref_path, ref)
+        _write_json(os.path.join(self.store_dir, 'refs', 'latest.json'), ref)
+        return object_id
+
+    def _read_ref(self, ref_path):
+        if not os.path.exists(ref_path):
+            return None
+        with open(ref_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def lookup(self, file_path, params=None):
+        """源文件未变化且分析参数(params)相同时返回最近一次报告的产物ID，否则返回 None"""
+        ref_path = self._ref_path(file_path)
+        ref = self._read_ref(ref_path)
+        if ref is None or not os.path.isdir(self._object_dir(ref['object'])):
+            return None
+        fingerprint = _file_fingerprint(file_path)
+        cached = ref['fingerprint']
+        if (fingerprint['size'], fingerprint['mtime_ns']) != (cached['size'], cached['mtime_ns']):
+            # 修改时间变化但内容未变(如重新下载)时仍可复用报告
+            if fingerprint['size'] != cached['size'] or _content_hash(file_path) != cached['content_hash']:
+                return None
+            ref['fingerprint'].update(fingerprint)
+            _write_json(ref_path, ref)
+        if params is not None and self.load(ref['object'])['inputs'].get('params') != params:
+            return None
+        return ref['object']
+
+    def latest(self):
+        """最近写入的报告产物ID（不检查源文件），供看板直接读取"""
+        ref = self._read_ref(os.path.join(self.store_dir, 'refs', 'latest.json'))
+        return None if ref is None else ref['object']
+
+    def load(self, object_id):
+        with open(os.path.join(self._object_dir(object_id), 'report.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def load_aggregates(self, object_id):
+        with open(os.path.join(self._object_dir(object_id), 'aggregates.json'), 'r', encoding='utf-8') as f:
+            return ESGAggregates.from_dict(json.load(f))
+
+    def load_table(self, object_id, name):
+        return pd.read_parquet(os.path.join(self._object_dir(object_id), f'{name}.parquet'))
+
+
+def _to_day(value):
+    """日期 -> 自1970-01-01起的天数（评分存储的日期键）"""
+    return int(pd.Timestamp(value).to_datetime64().astype('datetime64[D]').astype('int64'))
+
+
+class ESGScoreStore:
+    """内存映射的二进制评分存储：按(发行人, 评级日期)排序，分数字段为NumPy memmap数组
+
+    发行人/行业/评级做字典编码，并预先建立发行人偏移表、行业行号索引和日期行号索引。
+    按发行人查询(可加日期范围)直接返回memmap切片，不复制数据；按行业或日期范围查询通过行号索引取数。
+    """
+
+    CODE_COLUMNS = {'issuer': 'int32', 'industry': 'int16', 'rating': 'int16'}
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != SCORE_STORE_VERSION:
+            raise ValueError(f"评分存储格式版本不匹配: {self.meta.get('version')}")
+        self.issuers = self.meta['issuers']
+        self.industries = self.meta['industries']
+        self.ratings = self.meta['ratings']
+        self.score_columns = self.meta['score_columns']
+        self.arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                       for name in self.meta['arrays']}
+        self._issuer_names = None
+        self._industry_lookup = {name: code for code, name in enumerate(self.industries)}
+        self._dtypes = {}
+
+    def __len__(self):
+        return self.meta['row_count']
+
+    @classmethod
+    def build(cls, frame, path, date_column=None, source=None):
+        """由准备好的数据(prepare_esg_data之后)建立存储；没有评级日期字段时抛出 ValueError"""
+        if 'company_name' not in frame.columns:
+            raise ValueError('评分存储需要公司名称字段 company_name')
+        issuer_codes, issuers = pd.factorize(frame['company_name'], sort=True)
+        days = _snapshot_days(frame, date_column).astype('datetime64[D]')
+
+        # 没有发行人的记录无法按键查询，不写入存储
+        keep = np.flatnonzero(issuer_codes >= 0)
+        order = keep[np.lexsort((days[keep].astype('int64'), issuer_codes[keep]))]
+        arrays = {'issuer': issuer_codes[order].astype('int32'), 'date': days[order]}
+
+        categories = {}
+        for column, key in [('industry', 'industry'), ('esg_rating', 'rating')]:
+            if column in frame.columns:
+                codes, uniques = pd.factorize(frame[column], sort=True)
+                arrays[key] = codes[order].astype(cls.CODE_COLUMNS[key])
+                categories[key] = [str(value) for value in uniques]
+            else:
+                categories[key] = []
+        score_columns = [col for col in SCORE_COLUMNS + ['esg_pillar_avg'] if col in frame.columns]
+        for col in score_columns:
+            arrays[col] = frame[col].to_numpy(dtype='float32', na_value=np.nan)[order]
+
+        # 索引：发行人偏移表、行业行号(行业内保持发行人/日期顺序)、日期行号
+        arrays['issuer_offsets'] = np.searchsorted(arrays['issuer'], np.arange(len(issuers) + 1)).astype('int64')
+        if 'industry' in arrays:
+            industry_rows = np.argsort(arrays['industry'], kind='stable')
+            arrays['industry_rows'] = industry_rows.astype('int64')
+            arrays['industry_offsets'] = np.searchsorted(
+                arrays['industry'][industry_rows], np.arange(len(categories['industry']) + 1)).astype('int64')
+        date_rows = np.argsort(arrays['date'].astype('int64'), kind='stable')
+        arrays['date_rows'] = date_rows.astype('int64')
+        arrays['date_sorted'] = arrays['date'][date_rows]
+
+        meta = {
+            'version': SCORE_STORE_VERSION,
+            'row_count': int(len(order)),
+            'dropped_rows': int(len(frame) - len(order)),
+            'issuers': [str(name) for name in issuers],
+            'industries': categories['industry'],
+            'ratings': categories['rating'],
+            'score_columns': score_columns,
+            'arrays': list(arrays),
+            'source': None if source is None else dict(_file_fingerprint(source), path=os.path.abspath(source)),
+        }
+
+        # 先写临时目录再替换，读者不会看到写了一半的存储
+        tmp_path = path.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), values)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def issuer_code(self, name):
+        # 发行人表已排序，二分查找即可，打开存储时不需要建立字典
+        name = str(name)
+        code = bisect.bisect_left(self.issuers, name)
+        return code if code < len(self.issuers) and self.issuers[code] == name else None
+
+    def _date_bounds(self, days, start, end):
+        """在已排序的日期数组中二分查找 [start, end] 的位置"""
+        days = days.view('int64')
+        lo = 0 if start is None else int(np.searchsorted(days, _to_day(start), side='left'))
+        hi = len(days) if end is None else int(np.searchsorted(days, _to_day(end), side='right'))
+        return lo, max(lo, hi)
+
+    def issuer_rows(self, name, start=None, end=None):
+        """发行人(可加日期范围)对应的连续行区间"""
+        code = self.issuer_code(name)
+        if code is None:
+            return slice(0, 0)
+        offsets = self.arrays['issuer_offsets']
+        first, last = int(offsets[code]), int(offsets[code + 1])
+        lo, hi = self._date_bounds(self.arrays['date'][first:last], start, end)
+        return slice(first + lo, first + hi)
+
+    def industry_rows(self, name, start=None, end=None):
+        """行业(可加日期范围)对应的行号，按发行人和日期排序"""
+        code = self._industry_lookup.get(str(name))
+        if code is None or 'industry_rows' not in self.arrays:
+            return np.empty(0, dtype='int64')
+        offsets = self.arrays['industry_offsets']
+        rows = self.arrays['industry_rows'][offsets[code]:offsets[code + 1]]
+        if start is not None or end is not None:
+            days = self.arrays['date'][rows].view('int64')
+            mask = np.ones(len(rows), dtype=bool)
+            if start is not None:
+                mask &= days >= _to_day(start)
+            if end is not None:
+                mask &= days <= _to_day(end)
+            rows = rows[mask]
+        return rows
+
+    def date_rows(self, start=None, end=None):
+        """日期范围内的行号，按日期排序"""
+        lo, hi = self._date_bounds(self.arrays['date_sorted'], start, end)
+        return self.arrays['date_rows'][lo:hi]
+
+    def select(self, rows):
+        """取出行对应的各字段数组；rows为切片时返回memmap视图（零拷贝）"""
+        names = ['issuer', 'date'] + [key for key in ['industry', 'rating'] if key in self.arrays]
+        return {name: self.arrays[name][rows] for name in names + self.score_columns}
+
+    def _decode(self, key, codes):
+        """字典编码 -> 分类类型；分类dtype只在第一次使用时建立"""
+        if key not in self._dtypes:
+            self._dtypes[key] = pd.CategoricalDtype({'industry': self.industries, 'rating': self.ratings}[key])
+        return pd.Categorical.from_codes(codes, dtype=self._dtypes[key])
+
+    def to_frame(self, columns):
+        """把 select() 的结果解码为DataFrame（行业/评级为分类类型）"""
+        if self._issuer_names is None:
+            self._issuer_names = np.array(self.issuers, dtype=object)
+        data = {
+            'company_name': self._issuer_names[columns['issuer']],
+            'as_of_date': np.asarray(columns['date']).astype('datetime64[ns]'),
+        }
+        if 'industry' in columns:
+            data['industry'] = self._decode('industry', columns['industry'])
+        if 'rating' in columns:
+            data['esg_rating'] = self._decode('rating', columns['rating'])
+        for col in self.score_columns:
+            data[col] = columns[col]
+        return pd.DataFrame(data)
+
+    def issuer(self, name, start=None, end=None, as_frame=True):
+        """单个发行人的评分历史；as_frame为False时返回零拷贝的数组视图"""
+        columns = self.select(self.issuer_rows(name, start, end))
+        return self.to_frame(columns) if as_frame else columns
+
+    def industry(self, name, start=None, end=None, as_frame=True):
+        columns = self.select(self.industry_rows(name, start, end))
+        return self.to_frame(columns) if as_frame else columns
+
+    def between(self, start=None, end=None, as_frame=True):
+        """评级日期在 [start, end] 内的全部记录"""
+        columns = self.select(self.date_rows(start, end))
+        return self.to_frame(columns) if as_frame else columns
+
+
+def _snapshot_days(frame, date_column=None):
+    """评级日期 -> 自1970-01-01起的天数；没有日期字段时抛出 ValueError（不用年份编造日期）"""
+    if not date_column or date_column not in frame.columns:
+        raise ValueError(f'需要评级日期字段，数据中没有: {date_column}')
+    dates = _parse_dates(frame[date_column], errors='coerce')
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype('int64')
+
+
+class ESGPeerIndex:
+    """行业同业排名索引：每个行业保存按分数升序排列的数组，查询都是二分查找
+
+    每个发行人只保留最新一期评级日期的分数。新的评级快照通过 update() 合并：
+    只改动涉及到的行业，旧记录删除后把新分数用 searchsorted 插入到有序数组中，不重新排序整个行业。
+    查询不存在的发行人或行业时不抛出异常，返回 None 或空结果。
+    """
+
+    def __init__(self, column='total_esg_score'):
+        self.column = column
+        self.buckets = {}  # 行业 -> {'scores': 升序分数, 'issuers': 发行人, 'days': 评级日期}
+        # 发行人当前所在的行业、分数和评级日期，用于查询和判断快照新旧
+        self.issuers = pd.DataFrame({'industry': pd.Series(dtype=object), 'score': pd.Series(dtype='float64'),
+                                     'day': pd.Series(dtype='int64')})
+
+    def __len__(self):
+        return len(self.issuers)
+
+    @classmethod
+    def from_frame(cls, frame, column='total_esg_score', date_column='as_of_date'):
+        """由准备好的数据(prepare_esg_data之后，含解析后的评级日期 as_of_date)建立索引"""
+        index = cls(column)
+        index.update(frame, date_column)
+        return index
+
+    def update(self, frame, date_column='as_of_date'):
+        """合并新的评级快照：发行人的评级日期不早于已有记录时替换其分数和行业；没有分数的记录忽略
+
+        返回被更新的发行人数。
+        """
+        for col in ['company_name', 'industry', self.column]:
+            if col not in frame.columns:
+                raise ValueError(f'同业排名需要字段 {col}')
+        batch = pd.DataFrame({
+            'company_name': frame['company_name'].astype(object).to_numpy(),
+            'industry': frame['industry'].astype(object).to_numpy(),
+            'score': frame[self.column].to_numpy(dtype='float64', na_value=np.nan),
+            'day': _snapshot_days(frame, date_column),
+        }).dropna(subset=['company_name', 'industry', 'score'])
+        # 批内每个发行人只保留最新一期
+        batch = batch.sort_values('day', kind='stable').drop_duplicates('company_name', keep='last')
+        batch = batch.set_index('company_name')
+        known = self.issuers.reindex(batch.index)
+        newer = known['day'].isna().to_numpy() | (batch['day'].to_numpy() > known['day'].to_numpy())
+        # 同一日期的记录视为更正，只有分数或行业变化时才替换
+        changed = (batch['day'].to_numpy() == known['day'].to_numpy()) & (
+            (batch['score'].to_numpy() != known['score'].to_numpy())
+            | (batch['industry'].to_numpy() != known['industry'].to_numpy()))
+        batch = batch[newer | changed]
+        if batch.empty:
+            return 0
+
+        replaced = self.issuers.loc[self.issuers.index.intersection(batch.index)]
+        removals = replaced.groupby('industry').groups
+        additions = batch.groupby('industry').groups
+        for industry in set(removals) | set(additions):
+            self._merge(industry, removals.get(industry), batch.loc[additions[industry]] if industry in additions else None)
+
+        self.issuers = pd.concat([self.issuers.drop(replaced.index), batch])
+        return len(batch)
+
+    def _merge(self, industry, removed, added):
+        """从一个行业的有序数组中删除旧记录，并把新记录按分数插入"""
+        bucket = self.buckets.get(industry, {'scores': np.empty(0), 'issuers': np.empty(0, dtype=object),
+                                             'days': np.empty(0, dtype='int64')})
+        if removed is not None:
+            keep = ~np.isin(bucket['issuers'], np.asarray(removed, dtype=object))
+            bucket = {key: values[keep] for key, values in bucket.items()}
+        if added is not None:
+            order = np.argsort(added['score'].to_numpy(), kind='stable')
+            scores = added['score'].to_numpy()[order]
+            positions = np.searchsorted(bucket['scores'], scores, side='right')
+            bucket = {
+                'scores': np.insert(bucket['scores'], positions, scores),
+                'issuers': np.insert(bucket['issuers'], positions, added.index.to_numpy(dtype=object)[order]),
+                'days': np.insert(bucket['days'], positions, added['day'].to_numpy(dtype='int64')[order]),
+            }
+        if len(bucket['scores']):
+            self.buckets[industry] = bucket
+        else:
+            self.buckets.pop(industry, None)
+
+    def percentile(self, issuer):
+        """发行人在所属行业内的排名：rank为降序名次(1为最高，并列取最小名次)，
+        percentile为升序百分位(并列取平均，与 groupby().rank(pct=True) 一致)；发行人不存在时返回 None
+        """
+        if issuer not in self.issuers.index:
+            return None
+        industry, score, day = self.issuers.loc[issuer, ['industry', 'score', 'day']]
+        scores = self.buckets[industry]['scores']
+        lower = int(np.searchsorted(scores, score, side='left'))
+        upper = int(np.searchsorted(scores, score, side='right'))
+        return {
+            'company_name': issuer,
+            'industry': industry,
+            'score': float(score),
+            'as_of_date': np.datetime64(int(day), 'D'),
+            'rank': len(scores) - upper + 1,
+            'peers': len(scores),
+            'percentile': (lower + upper + 1) / 2 / len(scores),
+        }
+
+    def _frame(self, bucket, rows):
+        return pd.DataFrame({
+            'company_name': bucket['issuers'][rows],
+            self.column: bucket['scores'][rows],
+            'as_of_date': bucket['days'][rows].astype('datetime64[D]'),
+        })
+
+    def top(self, industry, n=10):
+        """行业内分数最高的n个发行人(降序)"""
+        bucket = self.buckets.get(industry, self._empty_bucket())
+        return self._frame(bucket, np.arange(len(bucket['scores']))[::-1][:n])
+
+    def bottom(self, industry, n=10):
+        """行业内分数最低的n个发行人(升序)"""
+        bucket = self.buckets.get(industry, self._empty_bucket())
+        return self._frame(bucket, np.arange(min(n, len(bucket['scores']))))
+
+    @staticmethod
+    def _empty_bucket():
+        return {'scores': np.empty(0), 'issuers': np.empty(0, dtype=object), 'days': np.empty(0, dtype='int64')}
+
+    def quantile(self, industry, q):
+        """行业分数的分位数(线性插值，与 np.quantile 默认方法一致)；q可以是标量或数组，行业不存在时返回 None"""
+        if industry not in self.buckets:
+            return None
+        scores = self.buckets[industry]['scores']
+        position = np.asarray(q, dtype='float64') * (len(scores) - 1)
+        lower = np.floor(position).astype('int64')
+        upper = np.minimum(lower + 1, len(scores) - 1)
+        return scores[lower] + (scores[upper] - scores[lower]) * (position - lower)
+
+    def count_at_least(self, industry, score):
+        """行业内分数不低于score的发行人数；行业不存在时为0"""
+        scores = self.buckets.get(industry, self._empty_bucket())['scores']
+        return len(scores) - int(np.searchsorted(scores, score, side='left'))
+
+    def save(self, path):
+        """保存为单个npz文件（不使用pickle）；先写临时文件再替换"""
+        industries = sorted(self.buckets, key=str)
+        sizes = [len(self.buckets[industry]['scores']) for industry in industries]
+        arrays = {
+            'meta': np.array(json.dumps({'version': PEER_INDEX_VERSION, 'column': self.column})),
+            'industries': np.array([str(industry) for industry in industries]),
+            'offsets': np.concatenate([[0], np.cumsum(sizes)]).astype('int64'),
+        }
+        for key in ['scores', 'issuers', 'days']:
+            parts = [self.buckets[industry][key] for industry in industries]
+            values = np.concatenate(parts) if parts else self._empty_bucket()[key]
+            arrays[key] = values.astype(str) if key == 'issuers' else values
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('version') != PEER_INDEX_VERSION:
+                raise ValueError(f"同业排名索引格式版本不匹配: {meta.get('version')}")
+            index = cls(meta['column'])
+            offsets = data['offsets']
+            scores, issuers, days = data['scores'], data['issuers'].astype(object), data['days']
+            frames = []
+            for i, industry in enumerate(data['industries'].astype(object)):
+                rows = slice(offsets[i], offsets[i + 1])
+                index.buckets[industry] = {'scores': scores[rows], 'issuers': issuers[rows], 'days': days[rows]}
+                frames.append(pd.DataFrame({'industry': industry, 'score': scores[rows], 'day': days[rows]},
+                                           index=pd.Index(issuers[rows])))
+        if frames:
+            index.issuers = pd.concat(frames)
+        return index
+
+
+def _bit_length(values):
+    """uint64数组每个元素的二进制位数（向量化的 int.bit_length）"""
+    values = values.copy()
+    length = np.zeros(len(values), dtype='int64')
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= np.uint64(1 << shift)
+        length[high] += shift
+        values[high] >>= np.uint64(shift)
+    return length + (values > 0)
+
+
+def _hash_values(values, hash_key=None):
+    """任意取值 -> 稳定的64位哈希（按文本哈希，不同文件/进程之间结果一致）"""
+    keys = np.asarray(values, dtype=object).astype(str).astype(object)
+    if hash_key is None:
+        return pd.util.hash_array(keys, categorize=False)
+    return pd.util.hash_array(keys, hash_key=hash_key, categorize=False)
+
+
+class KLLSketch:
+    """KLL分位数草图：各层保存带权重(2^层号)的样本，超出容量的层排序后隔一取一提升到上一层
+
+    内存为O(k)，与数据量无关；归一化排名误差按经验公式 2.296/k^0.9723 估计(99%置信度)，
+    k=200 时约 1.33%，即返回的q分位数的真实排名落在 q±0.0133 之内。最小值和最大值是精确的。
+    """
+
+    def __init__(self, k=SKETCH_KLL_K, seed=None):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (2 / 3) ** depth)), 2)
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def _compress(self):
+        while True:
+            level = next((h for h, items in enumerate(self.levels) if len(items) > self._capacity(h)), None)
+            if level is None:
+                return
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[level])
+            # 奇数个时留下最小的一个；其余随机取奇数或偶数位置，权重翻倍
+            odd = len(items) % 2
+            promoted = items[odd + int(self._rng.integers(2))::2]
+            self.levels[level] = items[:odd]
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+
+    def merge(self, other):
+        merged = KLLSketch(min(self.k, other.k))
+        depth = max(len(self.levels), len(other.levels))
+        merged.levels = [np.concatenate([sketch.levels[h] for sketch in (self, other) if h < len(sketch.levels)])
+                         for h in range(depth)]
+        merged.count = self.count + other.count
+        merged.min = min(self.min, other.min)
+        merged.max = max(self.max, other.max)
+        merged._compress()
+        return merged
+
+    def _weighted(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(values), 1 << h, dtype='int64') for h, values in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        return items[order], np.cumsum(weights[order])
+
+    def quantile(self, q):
+        """近似分位数；q可以是标量或数组，空草图返回NaN"""
+        q = np.asarray(q, dtype='float64')
+        if self.count == 0:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+        items, cumulative = self._weighted()
+        positions = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        result = items[np.minimum(positions, len(items) - 1)]
+        result = np.where(q <= 0, self.min, np.where(q >= 1, self.max, result))
+        return result if q.ndim else float(result)
+
+    def rank(self, value):
+        """近似的 P(X <= value)"""
+        if self.count == 0:
+            return np.nan
+        items, cumulative = self._weighted()
+        position = np.searchsorted(items, value, side='right')
+        return float(cumulative[position - 1] / cumulative[-1]) if position else 0.0
+
+    def rank_error(self):
+        return 2.296 / self.k ** 0.9723
+
+    def to_dict(self):
+        return {'k': self.k, 'count': self.count, 'min': self.min if self.count else None,
+                'max': self.max if self.count else None, 'levels': [values.tolist() for values in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['k'])
+        sketch.count = data['count']
+        if data['count']:
+            sketch.min, sketch.max = data['min'], data['max']
+        sketch.levels = [np.asarray(values, dtype='float64') for values in data['levels']]
+        return sketch
+
+
+class HyperLogLog:
+    """HyperLogLog基数估计：2^p个寄存器(uint8)，p=14时占16KB，相对标准误差 1.04/sqrt(2^p) ≈ 0.81%"""
+
+    def __init__(self, precision=SKETCH_HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype='uint8')
+
+    def update(self, values):
+        # 同一块内的重复取值只需计入一次
+        uniques = pd.unique(pd.Series(values).dropna().astype(str))
+        if len(uniques) == 0:
+            return
+        hashes = _hash_values(uniques)
+        tail_bits = 64 - self.precision
+        buckets = (hashes >> np.uint64(tail_bits)).astype('int64')
+        tail = hashes & np.uint64((1 << tail_bits) - 1)
+        # 剩余位中第一个1的位置(从1开始)
+        ranks = (tail_bits - _bit_length(tail) + 1).astype('uint8')
+        np.maximum.at(self.registers, buckets, ranks)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('HyperLogLog精度不同，不能合并')
+        merged = HyperLogLog(self.precision)
+        merged.registers = np.maximum(self.registers, other.registers)
+        return merged
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype('int64')))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # 小基数时改用线性计数
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def relative_error(self):
+        return 1.04 / np.sqrt(len(self.registers))
+
+    def to_dict(self):
+        return {'precision': self.precision, 'registers': base64.b64encode(self.registers.tobytes()).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['precision'])
+        sketch.registers = np.frombuffer(base64.b64decode(data['registers']), dtype='uint8').copy()
+        return sketch
+
+
+class FrequencySketch:
+    """count-min频数草图 + 高频候选(top-k)
+
+    估计值不会低于真实频数，且以 1-e^-depth 的概率(depth=5时约99.3%)高出不超过 e/width * 总数
+    (width=2048时约为总数的0.13%)。候选表只保留估计频数最高的 capacity 个取值。
+    """
+
+    def __init__(self, width=SKETCH_CM_WIDTH, depth=SKETCH_CM_DEPTH, capacity=SKETCH_TOP_CAPACITY):
+        self.width = width
+        self.depth = depth
+        self.capacity = capacity
+        self.table = np.zeros((depth, width), dtype='uint64')
+        self.total = 0
+        self.candidates = np.empty(0, dtype=object)
+
+    def _buckets(self, keys):
+        # 每一行用不同的16字节哈希键，相当于depth个独立的哈希函数
+        return np.stack([(_hash_values(keys, f'esgcountmin{row:05d}') % np.uint64(self.width)).astype('int64')
+                         for row in range(self.depth)])
+
+    def update_counts(self, counts):
+        """按 取值 -> 次数 的Series更新（调用方先在数据块内做精确计数）"""
+        counts = counts[counts > 0]
+        if len(counts) == 0:
+            return
+        keys = counts.index.astype(str).to_numpy(dtype=object)
+        buckets = self._buckets(keys)
+        for row in range(self.depth):
+            np.add.at(self.table[row], buckets[row], counts.to_numpy(dtype='uint64'))
+        self.total += int(counts.sum())
+        self._keep_top(np.concatenate([self.candidates, keys]))
+
+    def _keep_top(self, keys):
+        keys = pd.unique(keys)
+        estimates = self.estimate(keys)
+        order = np.argsort(-estimates.astype('float64'), kind='stable')[:self.capacity]
+        self.candidates = np.asarray(keys, dtype=object)[order]
+
+    def estimate(self, keys):
+        """取值的近似频数（数组）"""
+        keys = np.asarray(keys, dtype=object).astype(str).astype(object)
+        if len(keys) == 0:
+            return np.empty(0, dtype='uint64')
+        buckets = self._buckets(keys)
+        return self.table[np.arange(self.depth)[:, None], buckets].min(axis=0)
+
+    def top(self, n=10):
+        """估计频数最高的n个取值，降序的Series"""
+        estimates = self.estimate(self.candidates).astype('int64')
+        return pd.Series(estimates, index=pd.Index(self.candidates, dtype=object)).sort_values(
+            ascending=False, kind='stable').head(n)
+
+    def error_bound(self):
+        """频数估计的加性误差上界(条数)"""
+        return int(np.ceil(np.e / self.width * self.total))
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('count-min草图尺寸不同，不能合并')
+        merged = FrequencySketch(self.width, self.depth, max(self.capacity, other.capacity))
+        merged.table = self.table + other.table
+        merged.total = self.total + other.total
+        merged._keep_top(np.concatenate([self.candidates, other.candidates]))
+        return merged
+
+    def to_dict(self):
+        return {'width': self.width, 'depth': self.depth, 'capacity': self.capacity, 'total': self.total,
+                'table': base64.b64encode(self.table.tobytes()).decode('ascii'),
+                'candidates': [str(key) for key in self.candidates]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['width'], data['depth'], data['capacity'])
+        sketch.table = np.frombuffer(base64.b64decode(data['table']), dtype='uint64').reshape(
+            data['depth'], data['width']).copy()
+        sketch.total = data['total']
+        sketch.candidates = np.asarray(data['candidates'], dtype=object)
+        return sketch
+
+
+class ESGSketches:
+    """近似分析模式的可合并草图集合：各分数字段的KLL分位数、发行人数的HyperLogLog、评级/行业的频数草图
+
+    内存占用固定(每个分数字段几KB、HLL 16KB、每个频数草图80KB)，查询在毫秒级完成；
+    可序列化为JSON，不同文件或不同日期的草图用 merge() 合并。
+    """
+
+    def __init__(self):
+        self.row_count = 0
+        self.quantiles = {}
+        self.issuers = HyperLogLog()
+        self.frequencies = {'esg_rating': FrequencySketch(), 'industry': FrequencySketch()}
+
+    def update(self, chunk):
+        """用一个已重命名的数据块更新各草图"""
+        if chunk.empty:
+            return
+        self.row_count += len(chunk)
+        for col in SCORE_COLUMNS + ['esg_pillar_avg']:
+            if col in chunk.columns:
+                self.quantiles.setdefault(col, KLLSketch()).update(
+                    chunk[col].to_numpy(dtype='float64', na_value=np.nan))
+        if 'company_name' in chunk.columns:
+            self.issuers.update(chunk['company_name'])
+        if 'esg_rating' in chunk.columns:
+            self.frequencies['esg_rating'].update_counts(_normalize_rating_counts(_nonzero_counts(chunk['esg_rating'])))
+        if 'industry' in chunk.columns:
+            self.frequencies['industry'].update_counts(_nonzero_counts(chunk['industry']))
+
+    def merge(self, other):
+        merged = ESGSketches()
+        merged.row_count = self.row_count + other.row_count
+        for col in self.quantiles.keys() | other.quantiles.keys():
+            parts = [sketch.quantiles[col] for sketch in (self, other) if col in sketch.quantiles]
+            merged.quantiles[col] = reduce(lambda a, b: a.merge(b), parts)
+        merged.issuers = self.issuers.merge(other.issuers)
+        merged.frequencies = {col: self.frequencies[col].merge(other.frequencies[col]) for col in self.frequencies}
+        return merged
+
+    def quantile(self, column, q):
+        return self.quantiles[column].quantile(q)
+
+    def distinct_issuers(self):
+        return self.issuers.estimate()
+
+    def top(self, column, n=10):
+        return self.frequencies[column].top(n)
+
+    def frequency(self, column, value):
+        return int(self.frequencies[column].estimate([value])[0])
+
+    def quantile_summary(self, q=(0.01, 0.25, 0.5, 0.75, 0.99)):
+        """各分数字段的 count/min/分位数/max，与 describe() 的分位数部分对应"""
+        rows = {}
+        for col in [col for col in SCORE_COLUMNS + ['esg_pillar_avg'] if col in self.quantiles]:
+            sketch = self.quantiles[col]
+            rows[col] = [sketch.count, sketch.min, *sketch.quantile(list(q)), sketch.max]
+        return pd.DataFrame(rows, index=['count', 'min'] + [f'{p:.0%}' for p in q] + ['max'])
+
+    def error_bounds(self):
+        """各草图的误差说明"""
+        return {
+            'quantile_rank_error': max((sketch.rank_error() for sketch in self.quantiles.values()), default=None),
+            'distinct_relative_error': self.issuers.relative_error(),
+            'frequency_additive_error': {col: sketch.error_bound() for col, sketch in self.frequencies.items()},
+        }
+
+    def to_dict(self):
+        return {
+            'version': SKETCH_VERSION,
+            'row_count': self.row_count,
+            'quantiles': {col: sketch.to_dict() for col, sketch in self.quantiles.items()},
+            'issuers': self.issuers.to_dict(),
+            'frequencies': {col: sketch.to_dict() for col, sketch in self.frequencies.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != SKETCH_VERSION:
+            raise ValueError(f"草图格式版本不匹配: {data.get('version')}")
+        sketches = cls()
+        sketches.row_count = data['row_count']
+        sketches.quantiles = {col: KLLSketch.from_dict(value) for col, value in data['quantiles'].items()}
+        sketches.issuers = HyperLogLog.from_dict(data['issuers'])
+        sketches.frequencies = {col: FrequencySketch.from_dict(value) for col, value in data['frequencies'].items()}
+        return sketches
+
+    def save(self, path):
+        _write_json(path, self.to_dict())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+def _merge_moments(left, right):
+    """合并两组分块矩统计(count/mean/m2/min/max)，使用并行方差公式"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    index = left.index.union(right.index)
+    a = left.reindex(index)
+    b = right.reindex(index)
+    na = a['count'].fillna(0)
+    nb = b['count'].fillna(0)
+    n = na + nb
+    mean_a = a['mean'].fillna(0)
+    mean_b = b['mean'].fillna(0)
+    delta = mean_b - mean_a
+    safe_n = n.where(n > 0)
+    merged = pd.DataFrame(index=index)
+    merged['count'] = n
+    merged['mean'] = (mean_a * na + mean_b * nb) / safe_n
+    merged['m2'] = a['m2'].fillna(0) + b['m2'].fillna(0) + delta ** 2 * na * nb / safe_n.fillna(1)
+    merged['min'] = np.fmin(a['min'], b['min'])
+    merged['max'] = np.fmax(a['max'], b['max'])
+    return merged
+
+
+def _bin_index(values, edges):
+    """等宽分箱的箱号；超出范围的值计入两端的分箱"""
+    width = (edges[-1] - edges[0]) / (len(edges) - 1)
+    index = np.floor((values - edges[0]) / width).astype('int64')
+    return np.clip(index, 0, len(edges) - 2)
+
+
+def _bin_counts(values, edges):
+    """等宽分箱计数，整数箱号 + bincount，比逐值比较边界更快"""
+    values = values[~np.isnan(values)]
+    return np.bincount(_bin_index(values, edges), minlength=len(edges) - 1)
+
+
+def _top_n(series, n):
+    """用 argpartition 取数值最大的 n 项，结果按数值降序"""
+    values = series.to_numpy(dtype='float64')
+    if len(values) > n:
+        top = np.argpartition(-values, n - 1)[:n]
+    else:
+        top = np.arange(len(values))
+    top = top[np.argsort(-values[top], kind='stable')]
+    return series.index[top].tolist(), values[top]
+
+
+def _nonzero_counts(values):
+    """value_counts，去掉分类类型中未出现的类别"""
+    counts = values.value_counts()
+    return counts[counts > 0]
+
+
+def _pillar_average(frame, columns):
+    """逐行的支柱平均分(保留两位小数)，按float64计算，与流式读取和惰性查询后端的取整一致"""
+    return frame[columns].astype('float64').mean(axis=1).round(2)
+
+
+def _chunk_moments(frame, columns, by=None):
+    """计算单个数据块的矩统计；by不为空时按分组计算"""
+    source = frame.groupby(by, observed=True)[columns[0]] if by else frame[columns]
+    stats = source.agg(['count', 'mean', 'var', 'min', 'max'])
+    if not by:
+        stats = stats.T
+    stats['m2'] = (stats['var'] * (stats['count'] - 1)).fillna(0)
+    return stats[['count', 'mean', 'm2', 'min', 'max']]
+
+
+def _attach_shared_array(name, dtype, length):
+    """在工作进程中按名称附加共享内存数组；共享内存只由创建它的主进程释放"""
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 没有 track 参数；工作进程与主进程共用同一个资源跟踪器，重复登记不会提前释放
+        shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(length, dtype=dtype, buffer=shm.buf)
+
+
+def _industry_shard_moments(codes_name, values_name, length, n_groups, start, stop):
+    """工作进程：对共享内存中 [start, stop) 行按行业编码计算行数和矩统计(count/mean/m2/min/max)"""
+    codes_shm, codes = _attach_shared_array(codes_name, 'int32', length)
+    values_shm, values = _attach_shared_array(values_name, 'float64', length)
+    try:
+        codes, values = codes[start:stop], values[start:stop]
+        rows = np.bincount(codes[codes >= 0], minlength=n_groups)
+        valid = (codes >= 0) & ~np.isnan(values)
+        group, value = codes[valid], values[valid]
+        count = np.bincount(group, minlength=n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(group, weights=value, minlength=n_groups) / count
+        # 组内均值已知后再累加离差平方，与 groupby().var() 的两遍算法一致
+        m2 = np.bincount(group, weights=(value - mean[group]) ** 2, minlength=n_groups)
+        low = np.full(n_groups, np.inf)
+        high = np.full(n_groups, -np.inf)
+        np.minimum.at(low, group, value)
+        np.maximum.at(high, group, value)
+        # 没有有效分数的行业与 groupby().agg() 一致：count为0，min/max为NaN
+        low[count == 0] = np.nan
+        high[count == 0] = np.nan
+        del codes, values
+        return rows, count, mean, m2, low, high
+    finally:
+        codes_shm.close()
+        values_shm.close()
+
+
+def _sharded_industry_moments(industry, values, workers):
+    """按行范围分片、多进程计算各行业的行数和 total_esg_score 矩统计，再用并行方差公式合并
+
+    行业编码和分数只写入共享内存一次，工作进程直接读取，不需要序列化分数数组
+    """
+    codes, groups = pd.factorize(industry, sort=True)
+    length, n_groups = len(codes), len(groups)
+    blocks = [shared_memory.SharedMemory(create=True, size=max(length * itemsize, 1)) for itemsize in (4, 8)]
+    try:
+        np.ndarray(length, dtype='int32', buffer=blocks[0].buf)[:] = codes
+        np.ndarray(length, dtype='float64', buffer=blocks[1].buf)[:] = values
+        bounds = np.linspace(0, length, workers + 1).astype('int64')
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_industry_shard_moments, blocks[0].name, blocks[1].name, length, n_groups,
+                                   int(start), int(stop))
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            partials = [future.result() for future in futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    index = pd.Index(groups, name='industry')
+    rows = reduce(np.add, [partial[0] for partial in partials])
+    moments = None
+    for shard_rows, count, mean, m2, low, high in partials:
+        # 保留分片中出现过的每个行业，包括分数全部缺失的行业
+        present = shard_rows > 0
+        shard = pd.DataFrame({'count': count, 'mean': mean, 'm2': m2, 'min': low, 'max': high},
+                             index=index)[present]
+        moments = _merge_moments(moments, shard)
+    row_counts = pd.Series(rows, index=index, dtype='int64')
+    return row_counts[row_counts > 0], moments
+
+
+def _migration_frame(counts):
+    """迁移计数矩阵 -> DataFrame：评级从高到低(AAA..C)，无法识别的评级(编码0)只在出现时保留"""
+    order = list(range(len(RATING_ORDINAL_SCALE), 0, -1))
+    if counts[0].any() or counts[:, 0].any():
+        order.append(0)
+    labels = rating_labels(order)
+    return pd.DataFrame(counts[np.ix_(order, order)], index=pd.Index(labels, name='from'),
+                        columns=pd.Index(labels, name='to'))
+
+
+def _rolling_nanmean(matrix, window):
+    """沿年份轴(axis=1)的滑动平均，忽略缺失值；窗口内没有观测时为NaN"""
+    present = ~np.isnan(matrix)
+    sums = np.cumsum(np.where(present, matrix, 0.0), axis=1)
+    counts = np.cumsum(present, axis=1)
+    sums[:, window:] = sums[:, window:] - sums[:, :-window]
+    counts[:, window:] = counts[:, window:] - counts[:, :-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+class ESGPanel:
+    """发行人×年份面板：把(company_name, year)记录展开为稠密矩阵，所有计算都是整列的NumPy运算
+
+    同一发行人同一年有多条记录时取该年最后一个评级日期的记录；相邻两列是相邻的两个年份快照
+    """
+
+    def __init__(self, issuers, years, scores, rating_codes=None, industries=None, issuer_industry=None):
+        self.issuers = issuers
+        self.years = years
+        self.scores = scores
+        self.rating_codes = rating_codes
+        self.industries = industries
+        self.issuer_industry = issuer_industry
+
+    @classmethod
+    def from_frame(cls, frame, date_column=None, score_columns=None):
+        """由准备好的数据(prepare_esg_data之后)建立面板"""
+        if 'company_name' not in frame.columns or 'year' not in frame.columns:
+            raise ValueError('面板分析需要公司名称字段 company_name 和年份字段 year')
+        score_columns = score_columns or [col for col in SCORE_COLUMNS + ['esg_pillar_avg'] if col in frame.columns]
+        issuer_codes, issuers = pd.factorize(frame['company_name'], sort=True)
+        year_codes, years = pd.factorize(frame['year'], sort=True)
+        if years.dtype.kind == 'f' and np.all(np.mod(years, 1) == 0):
+            # 年份列因缺失值变成浮点时还原为整数年份
+            years = years.astype('int64')
+        rows = np.flatnonzero((issuer_codes >= 0) & (year_codes >= 0))
+
+        # 按评级日期排序后，每个(发行人, 年份)单元格保留最后一条记录
+        if date_column and date_column in frame.columns:
+            days = _parse_dates(frame[date_column], errors='coerce').to_numpy(dtype='datetime64[ns]').astype('int64')
+            rows = rows[np.argsort(days[rows], kind='stable')]
+        n_years = len(years)
+        cells = issuer_codes[rows].astype('int64') * n_years + year_codes[rows]
+        _, last = np.unique(cells[::-1], return_index=True)
+        rows = rows[len(rows) - 1 - last]
+        issuer_idx, year_idx = issuer_codes[rows], year_codes[rows]
+
+        shape = (len(issuers), n_years)
+        scores = {}
+        for col in score_columns:
+            matrix = np.full(shape, np.nan)
+            matrix[issuer_idx, year_idx] = frame[col].to_numpy(dtype='float64', na_value=np.nan)[rows]
+            scores[col] = matrix
+        rating_matrix = None
+        if 'esg_rating_code' in frame.columns:
+            # -1 表示该年份没有记录，0 表示有记录但评级无法识别
+            rating_matrix = np.full(shape, -1, dtype='int8')
+            rating_matrix[issuer_idx, year_idx] = frame['esg_rating_code'].to_numpy()[rows]
+        industries = issuer_industry = None
+        if 'industry' in frame.columns:
+            industry_codes, industries = pd.factorize(frame['industry'], sort=True)
+            # 发行人所属行业取最近一年的记录
+            issuer_industry = np.full(len(issuers), -1, dtype='int64')
+            latest = np.lexsort((year_idx, issuer_idx))
+            issuer_industry[issuer_idx[latest]] = industry_codes[rows][latest]
+        return cls(pd.Index(issuers, name='company_name'), pd.Index(years, name='year'), scores,
+                   rating_matrix, industries, issuer_industry)
+
+    def score_matrix(self, column='total_esg_score'):
+        """发行人×年份的分数矩阵"""
+        return pd.DataFrame(self.scores[column], index=self.issuers, columns=self.years)
+
+    def yoy_deltas(self, column='total_esg_score'):
+        """相邻年份的分数变化，列名为结束年份；任一年份缺失时为NaN"""
+        matrix = self.scores[column]
+        return pd.DataFrame(matrix[:, 1:] - matrix[:, :-1], index=self.issuers, columns=self.years[1:])
+
+    def yoy_summary(self, column='total_esg_score'):
+        """每个年份的分数变化汇总：配对发行人数、平均变化、上升/下降家数"""
+        deltas = self.scores[column][:, 1:] - self.scores[column][:, :-1]
+        present = ~np.isnan(deltas)
+        paired = present.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(paired > 0, np.nansum(deltas, axis=0) / paired, np.nan)
+        return pd.DataFrame({
+            'issuers': paired,
+            'mean_delta': mean,
+            'improved': (deltas > 0).sum(axis=0),
+            'declined': (deltas < 0).sum(axis=0),
+        }, index=self.years[1:])
+
+    def transition_matrices(self):
+        """相邻年份的评级迁移矩阵 {(起始年份, 结束年份): DataFrame}，只统计两年都有记录的发行人"""
+        if self.rating_codes is None:
+            raise ValueError('面板中没有评级字段 esg_rating_code')
+        matrices = {}
+        for i in range(len(self.years) - 1):
+            start, end = self.rating_codes[:, i], self.rating_codes[:, i + 1]
+            paired = (start >= 0) & (end >= 0)
+            matrices[(self.years[i], self.years[i + 1])] = _migration_frame(
+                _migration_counts(start[paired], end[paired]))
+        return matrices
+
+    def pooled_transitions(self):
+        """所有相邻年份合并后的评级迁移矩阵"""
+        start, end = self.rating_codes[:, :-1].ravel(), self.rating_codes[:, 1:].ravel()
+        paired = (start >= 0) & (end >= 0)
+        return _migration_frame(_migration_counts(start[paired], end[paired]))
+
+    def industry_means(self, column):
+        """行业×年份平均分（np.bincount 一次完成分组求和与计数）"""
+        if self.issuer_industry is None:
+            raise ValueError('面板中没有行业字段 industry')
+        matrix = self.scores[column]
+        n_industries, n_years = len(self.industries), len(self.years)
+        cells = (self.issuer_industry[:, None] * n_years + np.arange(n_years)).ravel()
+        values = matrix.ravel()
+        keep = (cells >= 0) & ~np.isnan(values)
+        sums = np.bincount(cells[keep], weights=values[keep], minlength=n_industries * n_years)
+        counts = np.bincount(cells[keep], minlength=n_industries * n_years)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan).reshape(n_industries, n_years)
+
+    def industry_trends(self, columns=None, window=3):
+        """各支柱分数的行业滑动平均趋势 {字段: 行业×年份 DataFrame}"""
+        columns = columns or [col for col in ['environmental_score', 'social_score', 'governance_score']
+                              if col in self.scores]
+        index = pd.Index(self.industries, name='industry')
+        return {col: pd.DataFrame(_rolling_nanmean(self.industry_means(col), window), index=index,
+                                  columns=self.years)
+                for col in columns}
+
+
+def _pillar_weights(weights):
+    """情景权重表 -> 列为 PILLAR_COLUMNS 的浮点DataFrame，缺少的支柱权重为0"""
+    weights = pd.DataFrame(weights).rename(columns=PILLAR_ALIASES)
+    unknown = [col for col in weights.columns if col not in PILLAR_COLUMNS]
+    if unknown:
+        raise ValueError(f'未知的支柱字段: {unknown}')
+    weights = weights.reindex(columns=PILLAR_COLUMNS, fill_value=0.0).astype('float64')
+    if weights.isna().any().any() or (weights.to_numpy() < 0).any():
+        raise ValueError('支柱权重不能为负数或缺失')
+    return weights
+
+
+def _tie_starts(*sorted_arrays):
+    """排序后每行中开始一个新并列组的位置(任一数组的值与前一位置不同)"""
+    starts = np.ones(sorted_arrays[0].shape, dtype=bool)
+    starts[:, 1:] = reduce(np.logical_or, [a[:, 1:] != a[:, :-1] for a in sorted_arrays])
+    return starts
+
+
+def _tie_bounds(starts):
+    """并列组起点标记 -> 每个位置所在并列组的首/尾位置(0起)"""
+    n = starts.shape[1]
+    positions = np.arange(n)
+    ends = np.ones(starts.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, n - 1)[:, ::-1], axis=1)[:, ::-1]
+    return first, last
+
+
+def _scenario_ranks(scores, codes, n_groups):
+    """情景×记录 的综合分 -> (全市场降序排名(并列取最小名次), 行业内百分位(并列取平均，升序))
+
+    与 DataFrame.rank(ascending=False, method='min') 和 groupby(行业).rank(pct=True) 结果一致，
+    但各情景在同一个二维数组上排序，不逐列调用pandas。缺失的分数和行业结果为NaN。
+    """
+    n_scenarios, n = scores.shape
+    missing = np.isnan(scores)
+    rows = np.arange(n_scenarios)[:, None]
+    positions = np.arange(n)
+
+    # 全市场降序排序一次：缺失值排在最后
+    keys = np.where(missing, np.inf, -scores)
+    order = np.argsort(keys, axis=1)
+    ordered = np.take_along_axis(keys, order, axis=1)
+    ranks = np.empty(scores.shape, dtype='float32')
+    ranks[rows, order] = np.maximum.accumulate(np.where(_tie_starts(ordered), positions, 0), axis=1) + 1
+    ranks[missing] = np.nan
+
+    # 再按行业编码稳定排序(小整数走基数排序)，行业内保持降序，行业内位置即行业内名次；无行业的记录单独成组
+    groups = np.where(codes >= 0, codes, n_groups).astype('int16' if n_groups < 2 ** 15 - 1 else 'int32')
+    by_group = np.argsort(groups[order], axis=1, kind='stable')
+    group_sorted = np.take_along_axis(groups[order], by_group, axis=1)
+    value_sorted = np.take_along_axis(ordered, by_group, axis=1)
+    group_start = np.maximum.accumulate(np.where(_tie_starts(group_sorted), positions, 0), axis=1)
+    first, last = _tie_bounds(_tie_starts(group_sorted, value_sorted))
+    counts = np.bincount((rows * (n_groups + 1) + groups)[~missing],
+                         minlength=n_scenarios * (n_groups + 1)).reshape(n_scenarios, -1)
+    group_counts = np.take_along_axis(counts, group_sorted.astype('int64'), axis=1)
+    # 升序平均名次 = 行业有效记录数 - 行业内降序平均位置(0起)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pct_sorted = (group_counts - ((first + last) / 2 - group_start)) / group_counts
+    percentiles = np.empty(scores.shape, dtype='float32')
+    percentiles[rows, np.take_along_axis(order, by_group, axis=1)] = pct_sorted
+    percentiles[missing | (codes < 0)] = np.nan
+    return ranks, percentiles
+
+
+def score_scenarios(frame, weights, industry_weights=None):
+    """多情景ESG综合评分：每个情景的综合分 = 支柱分的加权平均，缺失的支柱不参与并按剩余权重重新归一
+
+    weights 为 情景×支柱 权重表(行索引为情景名)；industry_weights 为可选的行业专用权重表，
+    行索引为 (情景, 行业) 的MultiIndex，覆盖该行业在对应情景下的默认权重。
+    所有情景一次矩阵乘法算出(行业专用权重时每个行业一次)，排名也在二维数组上整体计算，不逐情景或逐发行人循环。
+    返回 scores(综合分)、ranks(全市场排名，1为最高) 和 industry_percentiles(行业内百分位) 三张 记录×情景 表。
+    """
+    weights = _pillar_weights(weights)
+    pillars = [col for col in PILLAR_COLUMNS if col in frame.columns]
+    if not pillars:
+        raise ValueError('数据中没有支柱分数字段')
+    values = frame.reindex(columns=PILLAR_COLUMNS).to_numpy(dtype='float64', na_value=np.nan)
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    present = present.astype('float64')
+    matrix = weights.to_numpy()
+    if 'industry' in frame.columns:
+        codes, industries = pd.factorize(frame['industry'], sort=True)
+    else:
+        codes, industries = np.zeros(len(frame), dtype='int64'), [None]
+
+    # 直接按 情景×记录 计算，排名时每个情景是一段连续内存
+    numerator = matrix @ filled.T
+    denominator = matrix @ present.T
+    if industry_weights is not None and 'industry' in frame.columns:
+        # 情景×行业×支柱 的完整权重：先用默认权重填满，再写入行业专用权重，每个行业一次矩阵乘法
+        overrides = _pillar_weights(industry_weights)
+        table = np.repeat(matrix[:, None, :], len(industries), axis=1)
+        scenario_pos = weights.index.get_indexer(overrides.index.get_level_values(0))
+        industry_pos = industries.get_indexer(overrides.index.get_level_values(1))
+        keep = (scenario_pos >= 0) & (industry_pos >= 0)
+        table[scenario_pos[keep], industry_pos[keep]] = overrides.to_numpy()[keep]
+        overridden = np.unique(industry_pos[keep])
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(industries) + 1))
+        for k in overridden:
+            rows = order[bounds[k]:bounds[k + 1]]
+            numerator[:, rows] = table[:, k, :] @ filled[rows].T
+            denominator[:, rows] = table[:, k, :] @ present[rows].T
+
+    # 缺失支柱的权重不计入分母，即按剩余支柱的权重重新归一；全部支柱缺失时为NaN
+    composite = numerator
+    np.divide(numerator, denominator, out=composite, where=denominator > 0)
+    composite[~(denominator > 0)] = np.nan
+    del denominator
+
+    # 按情景分块排名以限制排序时的临时内存
+    ranks = np.empty(composite.shape, dtype='float32')
+    percentiles = np.empty(composite.shape, dtype='float32')
+    block = max(1, SCENARIO_RANK_BLOCK // max(len(frame), 1))
+    for start in range(0, len(composite), block):
+        ranks[start:start + block], percentiles[start:start + block] = _scenario_ranks(
+            composite[start:start + block], codes, len(industries))
+    return {
+        'scores': pd.DataFrame(composite.T, index=frame.index, columns=weights.index),
+        'ranks': pd.DataFrame(ranks.T, index=frame.index, columns=weights.index),
+        'industry_percentiles': pd.DataFrame(percentiles.T, index=frame.index, columns=weights.index),
+    }
+
+
+class ESGAggregates:
+    """ESG统计引擎：一次向量化遍历算出所有报告和图表需要的汇总量，可在数据块/分区之间合并
+
+    内存占用与数据行数无关；描述统计、指标计算、可视化和总结报告都从这里读取结果。
+    """
+
+    def __init__(self, hist_range=SCORE_HIST_RANGE, hist_bins=SCORE_HIST_BINS, track_companies=True):
+        self.row_count = 0
+        self.numeric_stats = None      # 各数值字段的矩统计(count/mean/m2/min/max)
+        self.numeric_order = []        # 数值字段的原始顺序
+        self.industry_stats = None     # 各行业 total_esg_score 的矩统计
+        self.rating_counts = pd.Series(dtype='int64')
+        self.industry_counts = pd.Series(dtype='int64')
+        self.companies = set()
+        # 近似分析模式下发行人数由HyperLogLog估计，不保存发行人名称集合
+        self.track_companies = track_companies
+        self.year_min = None
+        self.year_max = None
+        self.preview = None
+        self.snapshot_dates = set()    # 已处理的评级日期（增量模式使用）
+        # total_esg_score 的固定分箱直方图，超出范围的值计入两端的分箱
+        self.hist_edges = np.linspace(hist_range[0], hist_range[1], hist_bins + 1)
+        self.score_hist = np.zeros(hist_bins, dtype='int64')
+        self._chart_inputs = None
+
+    def update(self, chunk, workers=None):
+        """用一个已重命名的数据块更新汇总量
+
+        workers大于1且数据块足够大时，行业分组统计改为共享内存上的多进程分片计算
+        """
+        if chunk.empty:
+            return
+        self.row_count += len(chunk)
+        self._chart_inputs = None
+        # 内存中的分数降为float32存储，统计量仍按float64累加，与流式读取和惰性查询后端一致
+        downcast = chunk.columns[chunk.dtypes == 'float32']
+        if len(downcast):
+            chunk = chunk.astype(dict.fromkeys(downcast, 'float64'))
+
+        available_scores = [col for col in SCORE_COLUMNS if col in chunk.columns]
+        if len(available_scores) >= 3 and 'esg_pillar_avg' not in chunk.columns:
+            chunk = chunk.assign(esg_pillar_avg=_pillar_average(chunk, available_scores))
+        # 评级序数编码是分类信息，不参与数值统计
+        numeric_cols = [col for col in chunk.select_dtypes(include=[np.number]).columns if col != 'esg_rating_code']
+        if numeric_cols:
+            self.numeric_order.extend(col for col in numeric_cols if col not in self.numeric_order)
+            self.numeric_stats = _merge_moments(self.numeric_stats, _chunk_moments(chunk, numeric_cols))
+
+        if 'total_esg_score' in chunk.columns:
+            values = chunk['total_esg_score'].to_numpy(dtype='float64', na_value=np.nan)
+            self.score_hist += _bin_counts(values, self.hist_edges)
+
+        if ('industry' in chunk.columns and 'total_esg_score' in chunk.columns and workers and workers > 1
+                and len(chunk) >= SHARDED_GROUPBY_MIN_ROWS):
+            row_counts, moments = _sharded_industry_moments(
+                chunk['industry'], chunk['total_esg_score'].to_numpy(dtype='float64', na_value=np.nan), workers)
+            self.industry_counts = self.industry_counts.add(row_counts, fill_value=0)
+            self.industry_stats = _merge_moments(self.industry_stats, moments)
+        elif 'industry' in chunk.columns:
+            self.industry_counts = self.industry_counts.add(_nonzero_counts(chunk['industry']), fill_value=0)
+            if 'total_esg_score' in chunk.columns:
+                self.industry_stats = _merge_moments(
+                    self.industry_stats, _chunk_moments(chunk, ['total_esg_score'], by='industry'))
+
+        if 'esg_rating' in chunk.columns:
+            self.rating_counts = self.rating_counts.add(
+                _normalize_rating_counts(_nonzero_counts(chunk['esg_rating'])), fill_value=0)
+
+        if 'company_name' in chunk.columns and self.track_companies:
+            self.companies.update(chunk['company_name'].dropna().unique())
+
+        if 'year' in chunk.columns and chunk['year'].notna().any():
+            year_min, year_max = int(chunk['year'].min()), int(chunk['year'].max())
+            self.year_min = year_min if self.year_min is None else min(self.year_min, year_min)
+            self.year_max = year_max if self.year_max is None else max(self.year_max, year_max)
+
+        if self.preview is None:
+            display_cols = ['company_name', 'year'] if 'company_name' in chunk.columns else ['year']
+            display_cols = [col for col in display_cols if col in chunk.columns]
+            self.preview = chunk[display_cols + available_scores[:3]].head(10)
+
+    @staticmethod
+    def _finalize(moments):
+        """矩统计 -> count/mean/std/min/max"""
+        result = pd.DataFrame(index=moments.index)
+        result['count'] = moments['count'].astype('int64')
+        result['mean'] = moments['mean']
+        result['std'] = np.sqrt(moments['m2'] / (moments['count'] - 1).where(moments['count'] > 1))
+        result['min'] = moments['min']
+        result['max'] = moments['max']
+        return result
+
+    def hist_out_of_range(self):
+        """total_esg_score 超出直方图范围时返回实际的(最小值, 最大值)，否则返回 None；超出的值被计入两端的分箱"""
+        if self.numeric_stats is None or 'total_esg_score' not in self.numeric_stats.index:
+            return None
+        low, high = self.numeric_stats.loc['total_esg_score', ['min', 'max']]
+        if low < self.hist_edges[0] or high > self.hist_edges[-1]:
+            return float(low), float(high)
+        return None
+
+    def available_scores(self):
+        if self.numeric_stats is None:
+            return []
+        return [col for col in SCORE_COLUMNS if col in self.numeric_stats.index]
+
+    def numeric_summary(self, limit=None):
+        """与 describe() 对应的数值字段统计(不含分位数)"""
+        if self.numeric_stats is None:
+            return pd.DataFrame()
+        order = self.numeric_order[:limit] if limit else self.numeric_order
+        return self._finalize(self.numeric_stats.loc[order]).T
+
+    def industry_summary(self):
+        """与 groupby('industry').agg(...) 相同结构的行业统计"""
+        if self.industry_stats is None:
+            return pd.DataFrame()
+        summary = self._finalize(self.industry_stats)
+        summary.columns = pd.MultiIndex.from_product([['total_esg_score'], summary.columns])
+        summary.index.name = 'industry'
+        return summary
+
+    def industry_means(self):
+        if self.industry_stats is None:
+            return pd.Series(dtype='float64')
+        return self.industry_stats['mean'].dropna()
+
+    def sorted_rating_counts(self):
+        """按评级等级排序(AAA..C)的计数，无法识别的评级按次数排在最后"""
+        counts = self.rating_counts.astype('int64').sort_values(ascending=False, kind='stable')
+        return counts.iloc[sorted(range(len(counts)), key=lambda i: _rating_sort_key(counts.index[i]))]
+
+    def rating_mode(self):
+        """最常见评级及其次数"""
+        if len(self.rating_counts) == 0:
+            return None, 0
+        counts = self.rating_counts.astype('int64').sort_values(ascending=False, kind='stable')
+        return counts.index[0], int(counts.iloc[0])
+
+    def score_mean(self, column):
+        if self.numeric_stats is None or column not in self.numeric_stats.index:
+            return np.nan
+        return self.numeric_stats.loc[column, 'mean']
+
+    def score_count(self, column):
+        if self.numeric_stats is None or column not in self.numeric_stats.index:
+            return 0
+        return int(self.numeric_stats.loc[column, 'count'])
+
+    def chart_inputs(self, top_ratings=10, top_industries=8):
+        """图表所需的全部预聚合输入（分箱计数、Top-N评级和行业、支柱均值），计算一次后缓存"""
+        key = (top_ratings, top_industries)
+        if self._chart_inputs is not None and self._chart_inputs['key'] == key:
+            return self._chart_inputs
+
+        # 取次数最多的N个评级，再按评级等级排列
+        rating_labels, rating_counts = _top_n(self.rating_counts, top_ratings)
+        order = sorted(range(len(rating_labels)), key=lambda i: _rating_sort_key(rating_labels[i]))
+        rating_labels, rating_counts = [rating_labels[i] for i in order], rating_counts[order]
+        industry_labels, industry_means = _top_n(self.industry_means(), top_industries)
+        pillar_names = {'environmental_score': '环境(E)', 'social_score': '社会(S)', 'governance_score': '治理(G)'}
+        pillars = [(label, self.score_mean(col)) for col, label in pillar_names.items()
+                   if self.score_count(col) > 0]
+        self._chart_inputs = {
+            'key': key,
+            'hist_counts': self.score_hist,
+            'hist_edges': self.hist_edges,
+            'sample_count': self.score_count('total_esg_score'),
+            'score_mean': self.score_mean('total_esg_score'),
+            'rating_labels': rating_labels,
+            'rating_counts': rating_counts,
+            'rating_distinct': len(self.rating_counts),
+            'industry_labels': industry_labels,
+            'industry_means': industry_means,
+            'pillar_labels': [label for label, _ in pillars],
+            'pillar_means': np.array([mean for _, mean in pillars]),
+        }
+        return self._chart_inputs
+
+    def merge(self, other):
+        """合并两份汇总量，结果与对两部分数据整体计算一致"""
+        merged = ESGAggregates()
+        merged.row_count = self.row_count + other.row_count
+        merged.numeric_stats = _merge_moments(self.numeric_stats, other.numeric_stats)
+        merged.numeric_order = self.numeric_order + [col for col in other.numeric_order
+                                                     if col not in self.numeric_order]
+        if not np.array_equal(self.hist_edges, other.hist_edges):
+            raise ValueError('直方图分箱不同，不能合并汇总量')
+        merged.hist_edges = self.hist_edges
+        merged.score_hist = self.score_hist + other.score_hist
+        merged.industry_stats = _merge_moments(self.industry_stats, other.industry_stats)
+        merged.rating_counts = self.rating_counts.add(other.rating_counts, fill_value=0)
+        merged.industry_counts = self.industry_counts.add(other.industry_counts, fill_value=0)
+        merged.companies = self.companies | other.companies
+        years_min = [y for y in [self.year_min, other.year_min] if y is not None]
+        years_max = [y for y in [self.year_max, other.year_max] if y is not None]
+        merged.year_min = min(years_min) if years_min else None
+        merged.year_max = max(years_max) if years_max else None
+        merged.preview = self.preview if self.preview is not None else other.preview
+        merged.snapshot_dates = self.snapshot_dates | other.snapshot_dates
+        return merged
+
+    @staticmethod
+    def _moments_to_dict(moments):
+        if moments is None:
+            return None
+        return {'index': [str(i) for i in moments.index],
+                **{col: moments[col].astype(float).tolist() for col in moments.columns}}
+
+    @staticmethod
+    def _moments_from_dict(data):
+        if data is None:
+            return None
+        index = data.pop('index')
+        return pd.DataFrame(data, index=index)
+
+    def to_dict(self):
+        """转换为可JSON序列化的状态"""
+        return {
+            'row_count': int(self.row_count),
+            'numeric_stats': self._moments_to_dict(self.numeric_stats),
+            'numeric_order': [str(col) for col in self.numeric_order],
+            'hist_edges': self.hist_edges.tolist(),
+            'score_hist': self.score_hist.tolist(),
+            'industry_stats': self._moments_to_dict(self.industry_stats),
+            'rating_counts': {str(k): int(v) for k, v in self.rating_counts.items()},
+            'industry_counts': {str(k): int(v) for k, v in self.industry_counts.items()},
+            'companies': sorted(str(c) for c in self.companies),
+            'year_min': None if self.year_min is None else int(self.year_min),
+            'year_max': None if self.year_max is None else int(self.year_max),
+            'preview': None if self.preview is None else self.preview.to_dict(orient='split'),
+            'snapshot_dates': sorted(self.snapshot_dates),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        aggregates = cls()
+        aggregates.row_count = state['row_count']
+        aggregates.numeric_stats = cls._moments_from_dict(state['numeric_stats'])
+        aggregates.numeric_order = state['numeric_order']
+        aggregates.hist_edges = np.asarray(state['hist_edges'])
+        aggregates.score_hist = np.asarray(state['score_hist'], dtype='int64')
+        aggregates.industry_stats = cls._moments_from_dict(state['industry_stats'])
+        aggregates.rating_counts = pd.Series(state['rating_counts'], dtype='int64')
+        aggregates.industry_counts = pd.Series(state['industry_counts'], dtype='int64')
+        aggregates.companies = set(state['companies'])
+        aggregates.year_min = state['year_min']
+        aggregates.year_max = state['year_max']
+        if state['preview'] is not None:
+            preview = state['preview']
+            aggregates.preview = pd.DataFrame(preview['data'], columns=preview['columns'])
+        aggregates.snapshot_dates = set(state['snapshot_dates'])
+        return aggregates
+
+
+def _query_plan(header, key_fields):
+    """惰性查询计划需要的字段信息：投影字段(源字段, 分析字段, 类型)、数值字段顺序和预览字段"""
+    mapping = ESGDataAnalyzer._build_field_mapping(key_fields)
+    fields = [(col, mapping[col], 'float' if mapping[col] in SCORE_COLUMNS else 'str')
+              for col in header if col in mapping]
+    targets = [target for _, target, _ in fields]
+    scores = [col for col in SCORE_COLUMNS if col in targets]
+    # 数值字段顺序与分块读取时 select_dtypes 的结果一致：分数字段(文件顺序) -> year -> 三大支柱平均分
+    numeric = [target for _, target, kind in fields if kind == 'float']
+    if key_fields['date']:
+        numeric.append('year')
+    if len(scores) >= 3:
+        numeric.append('esg_pillar_avg')
+    preview = ['company_name', 'year'] if 'company_name' in targets else ['year']
+    preview = [col for col in preview if col in targets or (col == 'year' and key_fields['date'])]
+    return {
+        'fields': fields,
+        'targets': targets,
+        'date': key_fields['date'],
+        'scores': scores,
+        'numeric': numeric,
+        'preview': preview + scores[:3],
+        'usecols': list(dict.fromkeys(col for col in key_fields.values() if col)),
+    }
+
+
+def _moments_from_query(frame):
+    """查询结果(count/mean/var/min/max) -> 与 _chunk_moments 相同的矩统计"""
+    moments = pd.DataFrame(index=frame.index)
+    moments['count'] = frame['count'].astype('float64')
+    moments['mean'] = frame['mean'].astype('float64')
+    moments['m2'] = (frame['var'].astype('float64') * (moments['count'] - 1)).fillna(0)
+    moments['min'] = frame['min'].astype('float64')
+    moments['max'] = frame['max'].astype('float64')
+    return moments
+
+
+class LazyQueryBackend:
+    """惰性查询后端：把行业、评级和支柱汇总构建为查询计划，直接对CSV/Parquet文件执行
+
+    只读取关键字段(投影下推)，增量模式的日期过滤在扫描时完成(谓词下推)，数据不整体载入pandas。
+    子类实现 columns() 和 _collect()，结果组装为与pandas分块路径相同的 ESGAggregates。
+    """
+
+    name = None
+
+    def columns(self, path):
+        raise NotImplementedError
+
+    def _collect(self, path, plan, exclude_dates, hist_edges):
+        raise NotImplementedError
+
+    @staticmethod
+    def _is_parquet(path):
+        return str(path).lower().endswith(('.parquet', '.pq'))
+
+    def aggregate(self, path, key_fields, header, exclude_dates=None, hist_range=SCORE_HIST_RANGE):
+        """执行查询计划并返回 ESGAggregates；exclude_dates为已处理的评级日期"""
+        plan = _query_plan(header, key_fields)
+        aggregates = ESGAggregates(hist_range=hist_range)
+        parts = self._collect(path, plan, sorted(exclude_dates or []), aggregates.hist_edges)
+        if parts['row_count'] == 0:
+            return aggregates
+
+        aggregates.row_count = int(parts['row_count'])
+        if plan['numeric']:
+            aggregates.numeric_order = list(plan['numeric'])
+            aggregates.numeric_stats = _moments_from_query(parts['numeric'].loc[plan['numeric']])
+        if 'total_esg_score' in plan['targets']:
+            hist = parts['hist']
+            aggregates.score_hist[hist.index.to_numpy(dtype='int64')] += hist.to_numpy(dtype='int64')
+        if 'industry' in plan['targets']:
+            industry = parts['industry'].sort_index()
+            aggregates.industry_counts = aggregates.industry_counts.add(industry['rows'], fill_value=0)
+            if 'total_esg_score' in plan['targets']:
+                aggregates.industry_stats = _moments_from_query(industry)
+        if 'esg_rating' in plan['targets']:
+            aggregates.rating_counts = aggregates.rating_counts.add(_normalize_rating_counts(parts['rating']),
+                                                                    fill_value=0)
+        if 'company_name' in plan['targets']:
+            aggregates.companies = set(parts['companies'])
+        if plan['date']:
+            aggregates.snapshot_dates = set(parts['snapshot_dates'])
+            years = aggregates.numeric_stats.loc['year']
+            if years['count'] > 0:
+                aggregates.year_min, aggregates.year_max = int(years['min']), int(years['max'])
+        aggregates.preview = parts['preview'].reset_index(drop=True)
+        return aggregates
+
+
+def _sql_ident(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class DuckDBBackend(LazyQueryBackend):
+    """DuckDB后端：CSV只解析一次写入列式临时表，其余汇总都是对临时表的向量化查询
+
+    memory_limit/temp_directory 控制内存上限和溢写目录，超过内存的数据会自动溢写到磁盘。
+    """
+
+    name = 'duckdb'
+
+    def __init__(self, memory_limit=None, temp_directory=None, threads=None):
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError('duckdb后端需要安装duckdb: pip install duckdb') from e
+        self._duckdb = duckdb
+        self.config = {key: value for key, value in [('memory_limit', memory_limit),
+                                                     ('temp_directory', temp_directory),
+                                                     ('threads', threads)] if value is not None}
+
+    def _source(self, path):
+        if self._is_parquet(path):
+            return f'read_parquet({_sql_literal(path)})'
+        nullstr = ', '.join(_sql_literal(value) for value in CSV_NA_VALUES)
+        return f'read_csv({_sql_literal(path)}, header=true, all_varchar=true, nullstr=[{nullstr}])'
+
+    def columns(self, path):
+        with self._duckdb.connect(config=self.config) as con:
+            return [row[0] for row in con.execute(f'DESCRIBE SELECT * FROM {self._source(path)}').fetchall()]
+
+    def _collect(self, path, plan, exclude_dates, hist_edges):
+        with self._duckdb.connect(config=self.config) as con:
+            projections = [f"CAST({_sql_ident(src)} AS {'DOUBLE' if kind == 'float' else 'VARCHAR'}) "
+                           f"AS {_sql_ident(target)}" for src, target, kind in plan['fields']]
+            where = ''
+            if plan['date']:
+                date = _sql_ident(plan['date'])
+                projections.append(f'CAST({date} AS VARCHAR) AS snapshot_date')
+                if exclude_dates:
+                    # 谓词下推：已处理的评级日期在扫描时过滤，日期为空的行保留
+                    excluded = ', '.join(_sql_literal(value) for value in exclude_dates)
+                    where = f'WHERE {date} IS NULL OR CAST({date} AS VARCHAR) NOT IN ({excluded})'
+            projected = f"SELECT {', '.join(projections)} FROM {self._source(path)} {where}"
+
+            derived = []
+            if plan['date']:
+                sample = con.execute(f'SELECT snapshot_date FROM ({projected}) WHERE snapshot_date IS NOT NULL '
+                                     f'LIMIT 200').df()['snapshot_date']
+                date_format = _detect_date_format(sample)
+                parsed = (f'try_strptime(snapshot_date, {_sql_literal(date_format)})' if date_format
+                          else 'TRY_CAST(snapshot_date AS TIMESTAMP)')
+                derived.append(f'year({parsed}) AS year')
+            if len(plan['scores']) >= 3:
+                total = ' + '.join(f'COALESCE({col}, 0)' for col in plan['scores'])
+                present = ' + '.join(f'CAST({col} IS NOT NULL AS INTEGER)' for col in plan['scores'])
+                # 与 numpy.round 一致：rint(x * 100) / 100
+                derived.append(f'round_even(({total}) / NULLIF({present}, 0) * 100, 0) / 100 AS esg_pillar_avg')
+            select = ', '.join(['*'] + derived)
+            con.execute(f'CREATE TEMP TABLE esg AS SELECT {select} FROM ({projected})')
+
+            parts = {'row_count': con.execute('SELECT COUNT(*) FROM esg').fetchone()[0]}
+            if plan['numeric']:
+                stats = ', '.join(f'COUNT({c}), AVG({c}), VAR_SAMP({c}), MIN({c}), MAX({c})'
+                                  for c in map(_sql_ident, plan['numeric']))
+                values = np.asarray(con.execute(f'SELECT {stats} FROM esg').fetchone(), dtype='float64')
+                parts['numeric'] = pd.DataFrame(values.reshape(-1, 5), index=plan['numeric'],
+                                                columns=['count', 'mean', 'var', 'min', 'max'])
+            if 'total_esg_score' in plan['targets']:
+                # 分箱方式与 _bin_index 相同，repr(float) 保证浮点常量精确往返
+                start = float(hist_edges[0])
+                width = float((hist_edges[-1] - hist_edges[0]) / (len(hist_edges) - 1))
+                bins = len(hist_edges) - 2
+                parts['hist'] = con.execute(
+                    f'SELECT CAST(LEAST(GREATEST(FLOOR((total_esg_score - {start!r}) / {width!r}), 0), '
+                    f'{bins}) AS BIGINT) AS bin, COUNT(*) AS n FROM esg '
+                    f'WHERE total_esg_score IS NOT NULL AND NOT isnan(total_esg_score) GROUP BY bin'
+                ).df().set_index('bin')['n']
+            if 'industry' in plan['targets']:
+                score = 'total_esg_score' if 'total_esg_score' in plan['targets'] else 'NULL'
+                parts['industry'] = con.execute(
+                    f'SELECT industry, COUNT(*) AS rows, COUNT({score}) AS count, AVG({score}) AS mean, '
+                    f'VAR_SAMP({score}) AS var, MIN({score}) AS min, MAX({score}) AS max '
+                    f'FROM esg WHERE industry IS NOT NULL GROUP BY industry'
+                ).df().set_index('industry')
+            if 'esg_rating' in plan['targets']:
+                parts['rating'] = con.execute(
+                    'SELECT esg_rating, COUNT(*) AS n FROM esg WHERE esg_rating IS NOT NULL GROUP BY esg_rating'
+                ).df().set_index('esg_rating')['n']
+            if 'company_name' in plan['targets']:
+                parts['companies'] = [row[0] for row in con.execute(
+                    'SELECT DISTINCT company_name FROM esg WHERE company_name IS NOT NULL').fetchall()]
+            if plan['date']:
+                parts['snapshot_dates'] = [row[0] for row in con.execute(
+                    'SELECT DISTINCT snapshot_date FROM esg WHERE snapshot_date IS NOT NULL').fetchall()]
+            preview = ', '.join(map(_sql_ident, plan['preview']))
+            parts['preview'] = con.execute(f'SELECT {preview} FROM esg ORDER BY rowid LIMIT 10').df()
+        return parts
+
+
+class PolarsBackend(LazyQueryBackend):
+    """Polars后端：所有汇总构建为LazyFrame，collect_all 共享同一次扫描并用流式引擎执行"""
+
+    name = 'polars'
+
+    def __init__(self, engine='streaming'):
+        try:
+            import polars
+        except ImportError as e:
+            raise ImportError('polars后端需要安装polars: pip install polars') from e
+        self._pl = polars
+        self.engine = engine
+
+    def _scan(self, path):
+        pl = self._pl
+        if self._is_parquet(path):
+            return pl.scan_parquet(path)
+        return pl.scan_csv(path, infer_schema=False, null_values=CSV_NA_VALUES)
+
+    def columns(self, path):
+        return self._scan(path).collect_schema().names()
+
+    @staticmethod
+    def _moments(pl, column, alias_prefix=''):
+        col = pl.col(column)
+        return [col.count().alias(f'{alias_prefix}count'), col.mean().alias(f'{alias_prefix}mean'),
+                col.var(ddof=1).alias(f'{alias_prefix}var'), col.min().cast(pl.Float64).alias(f'{alias_prefix}min'),
+                col.max().cast(pl.Float64).alias(f'{alias_prefix}max')]
+
+    def _collect(self, path, plan, exclude_dates, hist_edges):
+        pl = self._pl
+        projections = [pl.col(src).cast(pl.Float64 if kind == 'float' else pl.String).alias(target)
+                       for src, target, kind in plan['fields']]
+        if plan['date']:
+            projections.append(pl.col(plan['date']).cast(pl.String).alias('snapshot_date'))
+        frame = self._scan(path).select(projections)
+        if plan['date'] and exclude_dates:
+            # 谓词下推：已处理的评级日期在扫描时过滤，日期为空的行保留
+            snapshot = pl.col('snapshot_date')
+            frame = frame.filter(snapshot.is_null() | ~snapshot.is_in(exclude_dates))
+
+        derived = []
+        if plan['date']:
+            sample = frame.select('snapshot_date').drop_nulls().head(200).collect().to_series().to_pandas()
+            date_format = _detect_date_format(sample)
+            snapshot = pl.col('snapshot_date').str
+            parsed = (snapshot.strptime(pl.Datetime, date_format, strict=False) if date_format
+                      else snapshot.to_datetime(strict=False))
+            derived.append(parsed.dt.year().alias('year'))
+        if len(plan['scores']) >= 3:
+            # 与pandas逐行均值一致：按字段顺序依次相加（mean_horizontal为两两相加，末位可能不同）
+            total = reduce(lambda acc, col: acc + pl.col(col).fill_null(0), plan['scores'][1:],
+                           pl.col(plan['scores'][0]).fill_null(0))
+            present = pl.sum_horizontal([pl.col(col).is_not_null().cast(pl.Int32) for col in plan['scores']])
+            # 与 numpy.round 一致：rint(x * 100) / 100；polars对标量除数按乘以倒数计算，这里用逐行的除数列
+            hundred = (present * 0 + 100).cast(pl.Float64)
+            pillar_avg = (total / present * 100).round(0, mode='half_to_even') / hundred
+            derived.append(pl.when(present > 0).then(pillar_avg).alias('esg_pillar_avg'))
+        if derived:
+            frame = frame.with_columns(derived)
+
+        names, queries = ['row_count'], [frame.select(pl.len())]
+        if plan['numeric']:
+            names.append('numeric')
+            queries.append(frame.select([expr for col in plan['numeric']
+                                         for expr in self._moments(pl, col, f'{col}_')]))
+        if 'total_esg_score' in plan['targets']:
+            width = (hist_edges[-1] - hist_edges[0]) / (len(hist_edges) - 1)
+            score = pl.col('total_esg_score')
+            names.append('hist')
+            queries.append(frame.filter(score.is_not_null() & score.is_not_nan())
+                           .select(((score - hist_edges[0]) / width).floor().clip(0, len(hist_edges) - 2)
+                                   .cast(pl.Int64).alias('bin'))
+                           .group_by('bin').agg(pl.len().alias('n')))
+        if 'industry' in plan['targets']:
+            names.append('industry')
+            if 'total_esg_score' in plan['targets']:
+                stats = self._moments(pl, 'total_esg_score')
+            else:
+                stats = [pl.lit(None, pl.Float64).alias(key) for key in ['count', 'mean', 'var', 'min', 'max']]
+            queries.append(frame.filter(pl.col('industry').is_not_null()).group_by('industry')
+                           .agg([pl.len().alias('rows')] + stats))
+        if 'esg_rating' in plan['targets']:
+            names.append('rating')
+            queries.append(frame.filter(pl.col('esg_rating').is_not_null()).group_by('esg_rating')
+                           .agg(pl.len().alias('n')))
+        if 'company_name' in plan['targets']:
+            names.append('companies')
+            queries.append(frame.select(pl.col('company_name').drop_nulls().unique()))
+        if plan['date']:
+            names.append('snapshot_dates')
+            queries.append(frame.select(pl.col('snapshot_date').drop_nulls().unique()))
+        names.append('preview')
+        queries.append(frame.select(plan['preview']).head(10))
+
+        results = dict(zip(names, pl.collect_all(queries, engine=self.engine)))
+        parts = {'row_count': results['row_count'].item(), 'preview': results['preview'].to_pandas()}
+        if 'numeric' in results:
+            values = np.asarray(results['numeric'].row(0), dtype='float64')
+            parts['numeric'] = pd.DataFrame(values.reshape(-1, 5), index=plan['numeric'],
+                                            columns=['count', 'mean', 'var', 'min', 'max'])
+        if 'hist' in results:
+            parts['hist'] = results['hist'].to_pandas().set_index('bin')['n']
+        if 'industry' in results:
+            parts['industry'] = results['industry'].to_pandas().set_index('industry')
+        if 'rating' in results:
+            parts['rating'] = results['rating'].to_pandas().set_index('esg_rating')['n']
+        if 'companies' in results:
+            parts['companies'] = results['companies'].to_series().to_list()
+        if 'snapshot_dates' in results:
+            parts['snapshot_dates'] = results['snapshot_dates'].to_series().to_list()
+        return parts
+
+
+# 可选的惰性查询后端；'pandas' 为参考实现（内存/分块读取）
+QUERY_BACKENDS = {'duckdb': DuckDBBackend, 'polars': PolarsBackend}
+
+
+def get_query_backend(backend):
+    """'pandas'/None -> None；后端名 -> 后端实例；LazyQueryBackend实例原样返回"""
+    if backend is None or isinstance(backend, LazyQueryBackend):
+        return backend
+    if backend == 'pandas':
+        return None
+    if backend not in QUERY_BACKENDS:
+        raise ValueError(f"未知的查询后端: {backend}，可选: pandas, {', '.join(QUERY_BACKENDS)}")
+    return QUERY_BACKENDS[backend]()
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS返回字节，Linux返回KB
+    return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+class StageInstrumentation:
+    """分析阶段监控：记录每个阶段的墙钟时间、CPU时间、峰值RSS、tracemalloc增量和行列数变化
+
+    通过 add_hook 注册回调，每个阶段结束时以记录字典调用；结果可导出为JSON或Prometheus文本格式。
+    trace_memory为True时在 run() 期间开启tracemalloc（开销较大，默认关闭）。
+    """
+
+    PROMETHEUS_METRICS = [
+        ('wall_s', 'esg_stage_wall_seconds', '分析阶段墙钟耗时（秒）'),
+        ('cpu_s', 'esg_stage_cpu_seconds', '分析阶段CPU耗时（秒）'),
+        ('peak_rss_mb', 'esg_stage_peak_rss_megabytes', '阶段结束时进程峰值内存（MB）'),
+        ('tracemalloc_delta_mb', 'esg_stage_tracemalloc_delta_megabytes', '阶段内Python分配内存净增量（MB）'),
+        ('tracemalloc_peak_mb', 'esg_stage_tracemalloc_peak_megabytes', '阶段内Python分配内存峰值（MB）'),
+        ('rows_out', 'esg_stage_rows_out', '阶段结束时的数据行数'),
+        ('cols_out', 'esg_stage_cols_out', '阶段结束时的数据列数'),
+    ]
+
+    def __init__(self, trace_memory=False, hooks=None):
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks or [])
+        self.records = []
+
+    def add_hook(self, callback):
+        """注册阶段回调 callback(record)，返回callback以便用作装饰器"""
+        self.hooks.append(callback)
+        return callback
+
+    def reset(self):
+        self.records = []
+
+    @contextlib.contextmanager
+    def run(self):
+        """一次完整分析的范围：按需开启并在结束时关闭tracemalloc"""
+        started = self.trace_memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        try:
+            yield self
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name, shape=None, labels=None):
+        """测量一个阶段；shape为返回(行数, 列数)的函数，labels为附加到记录上的标签"""
+        shape = shape or (lambda: (0, 0))
+        rows_in, cols_in = shape()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            mem_before = tracemalloc.get_traced_memory()[0]
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            rows_out, cols_out = shape()
+            record = {
+                'stage': name,
+                'status': status,
+                'wall_s': round(wall, 4),
+                'cpu_s': round(cpu, 4),
+                'tracemalloc_delta_mb': None,
+                'tracemalloc_peak_mb': None,
+                'peak_rss_mb': _peak_rss_mb(),
+                'rows_in': int(rows_in), 'cols_in': int(cols_in),
+                'rows_out': int(rows_out), 'cols_out': int(cols_out),
+            }
+            if tracing:
+                mem_after, mem_peak = tracemalloc.get_traced_memory()
+                record['tracemalloc_delta_mb'] = round((mem_after - mem_before) / 2 ** 20, 3)
+                record['tracemalloc_peak_mb'] = round((mem_peak - mem_before) / 2 ** 20, 3)
+            record.update(labels or {})
+            self.records.append(record)
+            for hook in self.hooks:
+                try:
+                    hook(record)
+                except Exception as e:
+                    # 监控回调出错不影响分析本身
+                    logger.warning('⚠️ 阶段监控回调出错: %s: %s', type(e).__name__, e)
+
+    def to_json(self, path=None):
+        """导出全部阶段记录为JSON字符串；指定path时同时写入文件"""
+        text = json.dumps(self.records, ensure_ascii=False, indent=2)
+        if path:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+        return text
+
+    def to_prometheus(self, path=None):
+        """导出每个阶段最近一次的记录为Prometheus文本格式（适用于node_exporter的textfile收集器）"""
+        latest = {}
+        for record in self.records:
+            latest[record['stage']] = record
+        lines = []
+        for key, metric, help_text in self.PROMETHEUS_METRICS:
+            samples = [(r, r[key]) for r in latest.values() if r.get(key) is not None]
+            if not samples:
+                continue
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} gauge')
+            for record, value in samples:
+                lines.append(f'{metric}{{{self._prometheus_labels(record)}}} {value}')
+        text = '\n'.join(lines) + '\n'
+        if path:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+        return text
+
+    @staticmethod
+    def _prometheus_labels(record):
+        labels = {'stage': record['stage'], 'status': record['status']}
+        if 'file' in record:
+            labels['file'] = os.path.basename(str(record['file']))
+        return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                        for k, v in labels.items())
+
+
+class ESGQualityReport:
+    """数据质量校验结果：逐块累计各项问题的计数，最后按 QUALITY_THRESHOLDS 判断是否合格"""
+
+    def __init__(self, key_fields=None):
+        self.key_fields = key_fields or {}
+        self.rows = 0
+        self.null_counts = Counter()
+        self.date_unparsed = 0
+        self.score_non_numeric = Counter()
+        self.score_out_of_range = Counter()
+        self.unknown_ratings = Counter()
+        self.duplicate_keys = 0
+        self.quarantined = 0
+
+    def checks(self):
+        """每项检查一行：检查名、字段、问题行数、占比；空值占比按各关键字段分别统计"""
+        rows = max(self.rows, 1)
+        records = [('null', col, count) for col, count in self.null_counts.items()]
+        if self.key_fields.get('date'):
+            records.append(('date_unparsed', self.key_fields['date'], self.date_unparsed))
+        for col in self.score_non_numeric.keys() | self.score_out_of_range.keys():
+            records.append(('score_non_numeric', col, self.score_non_numeric[col]))
+            records.append(('score_out_of_range', col, self.score_out_of_range[col]))
+        if self.key_fields.get('rating'):
+            records.append(('unknown_rating', self.key_fields['rating'], sum(self.unknown_ratings.values())))
+        if self.key_fields.get('name') and self.key_fields.get('date'):
+            records.append(('duplicate_key', f"{self.key_fields['name']}+{self.key_fields['date']}", self.duplicate_keys))
+        frame = pd.DataFrame(records, columns=['check', 'column', 'count'])
+        frame['ratio'] = frame['count'] / rows
+        return frame.sort_values(['check', 'column'], ignore_index=True)
+
+    def failures(self, thresholds=None):
+        """超过阈值的检查项，列表为空表示数据合格"""
+        thresholds = {**QUALITY_THRESHOLDS, **(thresholds or {})}
+        checks = self.checks()
+        if self.rows == 0:
+            return ['数据为空']
+        failed = checks[checks['ratio'] > checks['check'].map(thresholds).fillna(np.inf)]
+        return [f'{row.check}({row.column}): {row.count} 行, {row.ratio:.2%} > {thresholds[row.check]:.2%}'
+                for row in failed.itertuples()]
+
+    def to_dict(self, thresholds=None):
+        return {
+            'rows': self.rows,
+            'quarantined': self.quarantined,
+            'key_fields': self.key_fields,
+            'checks': self.checks().to_dict(orient='records'),
+            'unknown_ratings': dict(self.unknown_ratings.most_common(20)),
+            'failures': self.failures(thresholds),
+        }
+
+
+def _validate_chunk(chunk, key_fields, report, seen_keys, date_format=None, score_range=SCORE_RANGE):
+    """对一块原始数据做向量化检查并累计到report；返回 (每行的问题标签, 更新后的已见键)
+
+    重复键按 (发行人, 解析后的日期) 的64位哈希判断，已见过的键保存在有序数组中，跨块用二分查找。
+    """
+    report.rows += len(chunk)
+    issues = pd.Series('', index=chunk.index, dtype=object)
+
+    def flag(mask, label):
+        if mask.any():
+            issues[mask] += label + ';'
+
+    for col in dict.fromkeys(col for col in key_fields.values() if col):
+        values = chunk[col]
+        missing = values.isna()
+        if pd.api.types.is_string_dtype(values.dtype):
+            # 只有空白的文本也按缺失处理
+            missing |= values.str.strip().eq('').fillna(False).astype(bool)
+        report.null_counts[col] += int(missing.sum())
+        flag(missing.to_numpy(), f'null:{col}')
+
+    dates = None
+    if key_fields['date']:
+        dates = _parse_dates(chunk[key_fields['date']], date_format, errors='coerce')
+        unparsed = (chunk[key_fields['date']].notna() & dates.isna()).to_numpy()
+        report.date_unparsed += int(unparsed.sum())
+        flag(unparsed, 'date_unparsed')
+
+    low, high = score_range
+    for role in ['total_score', 'environmental_score', 'social_score', 'governance_score']:
+        col = key_fields[role]
+        if not col:
+            continue
+        numbers = pd.to_numeric(chunk[col], errors='coerce')
+        non_numeric = (chunk[col].notna() & numbers.isna()).to_numpy()
+        out_of_range = ((numbers < low) | (numbers > high)).to_numpy()
+        report.score_non_numeric[col] += int(non_numeric.sum())
+        report.score_out_of_range[col] += int(out_of_range.sum())
+        flag(non_numeric, f'score_non_numeric:{col}')
+        flag(out_of_range, f'score_out_of_range:{col}')
+
+    if key_fields['rating']:
+        ratings = chunk[key_fields['rating']]
+        unknown = ratings.notna().to_numpy() & (rating_codes(ratings) == 0)
+        if unknown.any():
+            report.unknown_ratings.update(ratings[unknown].astype(str).value_counts().to_dict())
+        flag(unknown, 'unknown_rating')
+
+    if key_fields['name'] and dates is not None:
+        present = (chunk[key_fields['name']].notna() & dates.notna()).to_numpy()
+        keys = pd.util.hash_pandas_object(pd.DataFrame({
+            'name': chunk[key_fields['name']][present].astype(str).to_numpy(),
+            'date': dates[present].to_numpy(dtype='datetime64[ns]').view('int64'),
+        }), index=False).to_numpy()
+        # 块内重复(保留第一次出现) + 与之前各块重复
+        position = np.searchsorted(seen_keys, keys)
+        seen = seen_keys[np.minimum(position, len(seen_keys) - 1)] == keys if len(seen_keys) else \
+            np.zeros(len(keys), dtype=bool)
+        duplicate = pd.Series(keys).duplicated().to_numpy() | seen
+        report.duplicate_keys += int(duplicate.sum())
+        mask = np.zeros(len(chunk), dtype=bool)
+        mask[np.flatnonzero(present)[duplicate]] = True
+        flag(mask, 'duplicate_key')
+        new_keys = np.unique(keys[~duplicate])
+        seen_keys = np.insert(seen_keys, np.searchsorted(seen_keys, new_keys), new_keys)
+    return issues, seen_keys
+
+
 #面向对象编程
 class ESGDataAnalyzer:
     """ESG数据分析器"""
 #面向对象编程
-    def __init__(self, file_path='znttaqleyuk9pjxj.csv'):
+    def __init__(self, file_path='znttaqleyuk9pjxj.csv', chunksize=None, cache_dir=None,
+                 cache_columns=CACHE_COLUMNS, state_path=None, output_dir=None,
+                 figure_formats=DEFAULT_FIGURE_FORMATS, instrumentation=None, backend='pandas', workers=None,
+                 report_dir=None, approximate=False, hist_range=SCORE_HIST_RANGE):
         self.financial_data = None
         self.file_path = file_path
-        self.setup_visualization()
+        # chunksize不为空时启用流式加载，只保留汇总量而不保留明细数据
+        self.chunksize = chunksize
+        self.aggregates = None
+        self.source_columns = None
+        self.key_fields = None
+        # cache_dir不为空时启用列式缓存，cache_columns为热启动读取的字段(None表示全部)
+        self.cache = ESGColumnarCache(cache_dir) if cache_dir else None
+        self.cache_columns = cache_columns
+        self.prepared_from_cache = False
+        # state_path不为空时启用增量模式：只处理新的评级日期，并与已保存的汇总量合并
+        self.state_path = state_path
+        # backend为'duckdb'/'polars'(或 LazyQueryBackend 实例)时，汇总量由惰性查询直接对文件计算
+        # 'pandas' 为参考实现；惰性后端执行失败时自动退回pandas分块读取
+        self.query_backend = get_query_backend(backend)
+        # workers大于1时，大数据量的行业分组统计在多个进程上分片计算
+        self.workers = workers
+        # ESG总分直方图的取值范围，默认0-10分制
+        self.hist_range = tuple(hist_range)
+        # 数据文件编码(首次读取时检测)和与检测结果不一致、按其他编码解码的行数
+        self.encoding = None
+        self.mixed_encoding_rows = 0
+        # output_dir不为空时进入无界面渲染模式，图表按figure_formats保存为文件
+        self.output_dir = output_dir
+        self.figure_formats = tuple(figure_formats)
+        self._dashboard = None
+        self.chart_paths = []
+        # report_dir不为空时，总结报告同时写入按内容寻址的报告产物存储(JSON + Parquet)
+        self.report_store = ESGReportStore(report_dir) if report_dir else None
+        self.report_id = None
+        # validate_data 的结果
+        self.quality_report = None
+        # load_local_data 失败的原因（批处理时返回给主进程）
+        self.load_error = None
+        # approximate为True时进入近似分析模式：分块读取并同时更新可合并的草图(ESGSketches)，
+        # 分位数、发行人数和评级/行业频数由草图估计，内存占用与数据量无关
+        self.approximate = approximate
+        self.sketches = None
+        # 阶段监控：run_complete_analysis 的每个阶段都会记录耗时/内存/行列数，可注册回调或导出
+        self.instrumentation = instrumentation or StageInstrumentation()
+        # 绘图环境在第一次绘图时才设置，只需要统计结果的运行不导入matplotlib
+        self._plt = None
 #图像设置
     def setup_visualization(self):
-        
-        plt.rcParams['font.sans-serif'] = ['SimHei', 'DejaVu Sans', 'Arial']
-        plt.rcParams['axes.unicode_minus'] = False
-        plt.rcParams['figure.figsize'] = (16, 14)  # 增大默认图像尺寸，提供更多空间
-        plt.rcParams['figure.dpi'] = 150  # 提高分辨率
-        plt.rcParams['savefig.dpi'] = 300  # 保存图像时的分辨率
-        plt.rcParams['font.size'] = 12
-        plt.rcParams['axes.titlesize'] = 14
-        plt.rcParams['axes.labelsize'] = 12
-        plt.rcParams['xtick.labelsize'] = 10
-        plt.rcParams['ytick.labelsize'] = 10
-        plt.rcParams['legend.fontsize'] = 10
-        plt.rcParams['figure.titlesize'] = 16
-        print("可视化环境设置完成")
+        """导入pyplot并应用图表样式(每个分析器只设置一次)，返回pyplot模块"""
+        if self._plt is None:
+            # 无界面模式：使用Agg后端，图表只写入文件，不会阻塞在plt.show()
+            self._plt = _pyplot(headless=bool(self.output_dir))
+            logger.info('可视化环境设置完成')
+        return self._plt
     #数据读取函数
     def load_local_data(self):
         #数据写入
-        print("本地数据加载")
+        logger.info('本地数据加载')
 
         try:
             # 检查文件是否存在，是否成功读取
             if not os.path.exists(self.file_path):
-                print(f"文件不存在: {self.file_path}")
-                print("请确保CSV文件在当前目录下")
+                logger.error('文件不存在: %s', self.file_path)
+                logger.info('请确保CSV文件在当前目录下')
+                self.load_error = f'文件不存在: {self.file_path}'
                 return False
 
-            # 读取CSV文件，可能是编码的问题
-            self.financial_data = pd.read_csv(self.file_path, encoding='utf-8')
+            if self.state_path:
+                return self._load_incremental()
+
+            if self.chunksize or self.query_backend is not None or self.approximate:
+                return self._load_streaming()
+
+            if self.cache is not None and self._load_from_cache():
+                return True
 
-            # 如果utf-8读取失败，尝试其他编码
-            if self.financial_data.empty:
-                print("⚠️ UTF-8编码读取失败，尝试GBK编码...")
-                self.financial_data = pd.read_csv(self.file_path, encoding='gbk')
+            # 先用文件开头的样本检测编码，再流式解码一遍读取CSV
+            with self._open_source() as source:
+                self.financial_data = pd.read_csv(source)
+            self._report_decoding(source)
+            self.source_columns = self.financial_data.columns.tolist()
 
             #数据特征前瞻
-            print(f"成功加载ESG数据: {len(self.financial_data)} 条记录")
-            print(f"数据形状: {self.financial_data.shape}")
-            print(f"字段数量: {len(self.financial_data.columns)}")
+            logger.info('成功加载ESG数据: %s 条记录', len(self.financial_data))
+            logger.info('数据形状: %s', self.financial_data.shape)
+            logger.info('字段数量: %s', len(self.financial_data.columns))
 
             # 显示数据基本信息
-            print("\n🔍 数据基本信息:")
-            print(f"数据列: {list(self.financial_data.columns)[:10]}...")  # 只显示前10列
+            logger.info('\n🔍 数据基本信息:')
+            logger.info('数据列: %s...', list(self.financial_data.columns)[:10])  # 只显示前10列
 
             # 显示前几行数据
-            print("\n数据预览:")
-            print(self.financial_data.head(5).to_string(index=False))
+            logger.info('\n数据预览:')
+            logger.info('%s', _LazyText(lambda: self.financial_data.head(5).to_string(index=False)))
 
             return True
 
         except Exception as e:
-            print(f"❌ 加载本地文件失败: {e}")
+            logger.error('❌ 加载本地文件失败: %s', e)
+            self.load_error = f'{type(e).__name__}: {e}'
             return False
 
+    def _load_from_cache(self):
+        """尝试从列式缓存加载已准备好的数据，跳过CSV解析、日期解析和重命名"""
+        try:
+            cached = self.cache.load(self.file_path, columns=self.cache_columns)
+        except Exception as e:
+            logger.warning('⚠️ 读取缓存失败，改为解析CSV: %s', e)
+            return False
+        if cached is None:
+            return False
+
+        self.financial_data, meta = cached
+        self.source_columns = meta['source_columns']
+        self.key_fields = meta['key_fields']
+        self.prepared_from_cache = True
+        logger.info('⚡ 命中列式缓存: %s 条记录', len(self.financial_data))
+        logger.info('读取字段: %s', list(self.financial_data.columns))
+        return True
+
+    def _store_cache(self):
+        try:
+            self.cache.store(self.file_path, self.financial_data, self.source_columns, self.key_fields)
+            logger.info('💾 已写入列式缓存')
+        except Exception as e:
+            logger.warning('⚠️ 写入缓存失败: %s', e)
+
+    def _date_column(self):
+        """明细数据中的评级日期字段：优先使用解析后的 as_of_date，其次是原始日期字段，都没有时返回None"""
+        columns = self.financial_data.columns if self.financial_data is not None else []
+        if 'as_of_date' in columns:
+            return 'as_of_date'
+        date_column = self.key_fields['date'] if self.key_fields else None
+        return date_column if date_column in columns else None
+
+    def build_score_store(self, path):
+        """把准备好的数据写成内存映射评分存储，之后按发行人/行业/日期查询无需重新加载CSV"""
+        if self.financial_data is None or 'company_name' not in self.financial_data.columns:
+            logger.error('❌ 评分存储需要内存中已准备好的数据（先运行 prepare_esg_data，且不能是流式模式）')
+            return None
+        if self._date_column() is None:
+            logger.error('❌ 评分存储需要评级日期字段，数据中没有日期')
+            return None
+        date_column = self._date_column()
+        store = ESGScoreStore.build(self.financial_data, path, date_column=date_column, source=self.file_path)
+        logger.info('🗄️ 已写入评分存储: %s (%s 条记录, %s 个发行人)', path, len(store), len(store.issuers))
+        return store
+
+    def score_scenarios(self, weights, industry_weights=None):
+        """按多组E/S/G权重情景重新计算综合评分，返回综合分、全市场排名和行业内百分位"""
+        if self.financial_data is None:
+            logger.error('❌ 情景评分需要内存中已准备好的数据（先运行 prepare_esg_data，且不能是流式模式）')
+            return None
+        result = score_scenarios(self.financial_data, weights, industry_weights)
+        logger.info('🧪 已完成 %s 个权重情景的综合评分 (%s 条记录)', result['scores'].shape[1], len(result['scores']))
+        logger.info('各情景平均综合分:\n%s', _LazyText(lambda: result['scores'].mean().round(3).to_string()))
+        return result
+
+    def build_peer_index(self, path=None, column='total_esg_score'):
+        """建立行业同业排名索引；path已存在时读取后只合并本次数据中更新的评级快照，再写回path"""
+        if self.financial_data is None or 'company_name' not in self.financial_data.columns:
+            logger.error('❌ 同业排名需要内存中已准备好的数据（先运行 prepare_esg_data，且不能是流式模式）')
+            return None
+        if self._date_column() is None:
+            logger.error('❌ 同业排名需要评级日期字段，数据中没有日期')
+            return None
+        index = None
+        if path and os.path.exists(path):
+            try:
+                index = ESGPeerIndex.load(path)
+            except Exception as e:
+                logger.warning('⚠️ 读取同业排名索引失败，重新建立: %s', e)
+        if index is None or index.column != column:
+            index = ESGPeerIndex(column)
+        date_column = self._date_column()
+        updated = index.update(self.financial_data, date_column=date_column)
+        logger.info('🏅 同业排名索引: %s 个发行人, %s 个行业 (本次更新 %s 个发行人)',
+                    len(index), len(index.buckets), updated)
+        if path:
+            index.save(path)
+        return index
+
+    def build_panel(self):
+        """建立发行人×年份面板，并输出年度分数变化和评级迁移的概要"""
+        data = self.financial_data
+        if data is None or 'company_name' not in data.columns or 'year' not in data.columns:
+            logger.error('❌ 面板分析需要内存中已准备好的数据（先运行 prepare_esg_data，且不能是流式模式）')
+            return None
+        date_column = self._date_column()
+        panel = ESGPanel.from_frame(data, date_column=date_column)
+        logger.info('🧮 面板: %s 个发行人 × %s 个年份', len(panel.issuers), len(panel.years))
+        if 'total_esg_score' in panel.scores and len(panel.years) > 1:
+            logger.info('📈 年度ESG总分变化:\n%s', _LazyText(lambda: panel.yoy_summary().round(3).to_string()))
+        if panel.rating_codes is not None and len(panel.years) > 1:
+            logger.info('🔁 评级迁移(全部相邻年份):\n%s', _LazyText(lambda: panel.pooled_transitions().to_string()))
+        return panel
+
+    def rating_migration(self, from_date, to_date):
+        """两个快照之间的评级迁移矩阵：行为起始评级、列为结束评级(AAA..C)，按公司名配对
+
+        from_date/to_date 可以是日期或年份(整数)；同一公司在一个快照中有多条记录时取最后一条
+        """
+        data = self.financial_data
+        if data is None or 'company_name' not in data.columns or 'esg_rating_code' not in data.columns:
+            logger.error('❌ 评级迁移需要内存中已准备好的数据（先运行 prepare_esg_data，且不能是流式模式）')
+            return None
+        date_column = self._date_column()
+
+        def snapshot(when):
+            if isinstance(when, (int, np.integer)) and 'year' in data.columns:
+                mask = (data['year'] == when).to_numpy()
+            elif date_column and date_column in data.columns:
+                mask = (_parse_dates(data[date_column], errors='coerce') == pd.Timestamp(when)).to_numpy()
+            else:
+                raise ValueError(f'无法按 {when!r} 选取快照：数据中没有日期或年份字段')
+            rows = data.loc[mask, ['company_name', 'esg_rating_code']]
+            return rows.drop_duplicates('company_name', keep='last')
+
+        pairs = snapshot(from_date).merge(snapshot(to_date), on='company_name', suffixes=('_from', '_to'))
+        matrix = _migration_frame(_migration_counts(pairs['esg_rating_code_from'], pairs['esg_rating_code_to']))
+        logger.info('🔁 评级迁移 %s -> %s: %s 家公司配对', from_date, to_date, len(pairs))
+        return matrix
+
+    def validate_data(self, quarantine_path=None, thresholds=None, score_range=SCORE_RANGE):
+        """在完整分析之前分块校验源文件的关键字段，返回 ESGQualityReport
+
+        检查日期解析率、分数取值范围、评级是否可识别、(发行人, 日期)重复和各字段空值占比。
+        quarantine_path不为空时，把有问题的行(原始取值 + 行号 + 问题标签)写入该CSV文件。
+        """
+        logger.info('\n' + '=' * 80)
+        logger.info('0. 数据质量校验')
+        logger.info('=' * 80)
+        if not os.path.exists(self.file_path):
+            logger.error('文件不存在: %s', self.file_path)
+            return None
+
+        if LazyQueryBackend._is_parquet(self.file_path):
+            import pyarrow.parquet as pq
+            header = pq.ParquetFile(self.file_path).schema_arrow.names
+        else:
+            with self._open_source() as source:
+                header = pd.read_csv(source, nrows=0).columns.tolist()
+        key_fields = self._match_key_fields(header)
+        usecols = list(dict.fromkeys(col for col in key_fields.values() if col))
+        report = ESGQualityReport(key_fields)
+        seen_keys = np.empty(0, dtype='uint64')
+        date_format = None
+        if quarantine_path and os.path.exists(quarantine_path):
+            os.remove(quarantine_path)
+
+        for chunk in self._raw_chunks(usecols):
+            if key_fields['date'] and date_format is None:
+                date_format = _detect_date_format(chunk[key_fields['date']].dropna())
+            issues, seen_keys = _validate_chunk(chunk, key_fields, report, seen_keys, date_format, score_range)
+            bad = issues.ne('').to_numpy()
+            report.quarantined += int(bad.sum())
+            if quarantine_path and bad.any():
+                rows = chunk[bad].copy()
+                rows.insert(0, 'row_number', chunk.index[bad])
+                rows['quality_issues'] = issues[bad].str.rstrip(';')
+                rows.to_csv(quarantine_path, mode='a', index=False, header=not os.path.exists(quarantine_path),
+                            encoding='utf-8')
+
+        self.quality_report = report
+        checks = report.checks()
+        logger.info('校验 %s 行, 有问题的行: %s%s', report.rows, report.quarantined,
+                    f' (已写入 {quarantine_path})' if quarantine_path and report.quarantined else '')
+        logger.info('%s', _LazyText(lambda: checks.to_string(index=False, formatters={'ratio': '{:.2%}'.format})))
+        if report.unknown_ratings:
+            logger.info('无法识别的评级: %s', dict(report.unknown_ratings.most_common(10)))
+        failures = report.failures(thresholds)
+        if failures:
+            logger.error('❌ 数据质量不合格:%s', _bullet_list(failures))
+        else:
+            logger.info('✅ 数据质量校验通过')
+        return report
+
+    def _raw_chunks(self, usecols):
+        """按块读取原始关键字段(文本字段不做类型转换)；行索引为文件中的数据行号(从0开始)"""
+        chunksize = self.chunksize or DEFAULT_CHUNKSIZE
+        if LazyQueryBackend._is_parquet(self.file_path):
+            import pyarrow.parquet as pq
+            offset = 0
+            for batch in pq.ParquetFile(self.file_path).iter_batches(batch_size=chunksize, columns=usecols):
+                chunk = batch.to_pandas()
+                chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+                offset += len(chunk)
+                yield chunk
+            return
+        with self._open_source() as source:
+            yield from pd.read_csv(source, usecols=usecols, dtype=str, chunksize=chunksize)
+        self._report_decoding(source)
+
+    def _load_incremental(self):
+        """增量模式：读取已保存的汇总状态，只累计其中没有的评级日期"""
+        state = None
+        saved = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('version') != STATE_VERSION:
+                logger.warning('⚠️ 增量状态格式已过期，重新全量计算')
+                saved = {}
+            elif not np.allclose(np.asarray(saved['aggregates']['hist_edges'])[[0, -1]], self.hist_range):
+                logger.warning('⚠️ 增量状态的直方图范围与 hist_range 不一致，重新全量计算')
+                saved = {}
+            else:
+                state = ESGAggregates.from_dict(saved['aggregates'])
+                if self.approximate and saved.get('sketches'):
+                    self.sketches = ESGSketches.from_dict(saved['sketches'])
+                logger.info('📂 读取增量状态: %s 条记录, %s 个评级日期', state.row_count, len(state.snapshot_dates))
+
+        if not self._load_streaming(state):
+            return False
+
+        if not self.key_fields['date']:
+            logger.warning('⚠️ 未找到日期字段，无法增量处理，已按全量结果保存')
+        elif state is not None and saved.get('key_fields') != self.key_fields:
+            logger.warning('⚠️ 关键字段与已保存状态不一致，重新全量计算')
+            if not self._load_streaming():
+                return False
+
+        with open(self.state_path + '.tmp', 'w', encoding='utf-8') as f:
+            saved = {'version': STATE_VERSION, 'key_fields': self.key_fields, 'aggregates': self.aggregates.to_dict()}
+            if self.sketches is not None:
+                saved['sketches'] = self.sketches.to_dict()
+            json.dump(saved, f, ensure_ascii=False)
+        os.replace(self.state_path + '.tmp', self.state_path)
+        logger.info('💾 已更新增量状态: %s', self.state_path)
+        return True
+
+    def _load_streaming(self, state=None):
+        """分块读取CSV，只读取关键字段并逐块累计汇总量；state不为空时只累计新的评级日期
+
+        近似分析模式下同时更新草图（惰性查询后端不产生草图，因此改用pandas分块读取）
+        """
+        if self.query_backend is not None and not self.approximate and self._load_lazy(state):
+            return True
+        chunksize = self.chunksize or DEFAULT_CHUNKSIZE
+        with self._open_source() as source:
+            header = pd.read_csv(source, nrows=0).columns.tolist()
+        key_fields = self._match_key_fields(header)
+        usecols = list(dict.fromkeys(col for col in key_fields.values() if col))
+        field_mapping = self._build_field_mapping(key_fields)
+
+        # 显式指定类型，避免逐块推断
+        dtypes = {}
+        for role in ['name', 'date', 'rating', 'industry']:
+            if key_fields[role]:
+                dtypes[key_fields[role]] = 'str'
+        for role in ['total_score', 'environmental_score', 'social_score', 'governance_score']:
+            if key_fields[role]:
+                dtypes[key_fields[role]] = 'float64'
+
+        aggregates = ESGAggregates(hist_range=self.hist_range, track_companies=not self.approximate)
+        sketches = ESGSketches() if self.approximate else None
+        date_format = None
+        with self._open_source() as source:
+            reader = pd.read_csv(source, usecols=usecols, dtype=dtypes, chunksize=chunksize)
+            for chunk in reader:
+                if key_fields['date']:
+                    if state is not None:
+                        # 跳过已经计入状态的评级日期
+                        chunk = chunk[~chunk[key_fields['date']].isin(state.snapshot_dates)]
+                        if chunk.empty:
+                            continue
+                    aggregates.snapshot_dates.update(chunk[key_fields['date']].dropna().unique())
+                    # 日期格式只在第一块识别一次
+                    if date_format is None:
+                        date_format = _detect_date_format(chunk[key_fields['date']])
+                    chunk['year'] = _parse_dates(chunk[key_fields['date']], date_format,
+                                                 errors='coerce').dt.year
+                chunk = chunk.rename(columns=field_mapping)
+                aggregates.update(chunk, workers=self.workers)
+                if sketches is not None:
+                    sketches.update(chunk)
+        self._report_decoding(source)
+
+        self._adopt_aggregates(header, key_fields, aggregates, state)
+        if sketches is not None:
+            # 增量模式下与已保存的草图合并
+            merge_saved = state is not None and key_fields['date'] and self.sketches is not None
+            self.sketches = self.sketches.merge(sketches) if merge_saved else sketches
+        logger.info('成功流式加载ESG数据: %s 条记录 (每块 %s 行)', self.aggregates.row_count, chunksize)
+        logger.info('字段数量: %s，实际读取字段: %s', len(header), usecols)
+        return True
+
+    def _open_source(self):
+        """按检测到的编码打开数据文件；编码只在第一次打开时检测"""
+        if self.encoding is None:
+            self.encoding = _detect_encoding(self.file_path)
+            logger.info('文件编码: %s', self.encoding)
+        return _DecodingReader(self.file_path, self.encoding)
+
+    def _report_decoding(self, source):
+        self.mixed_encoding_rows = source.mixed_rows
+        if source.mixed_rows:
+            logger.warning('⚠️ 有 %s 行不是 %s 编码，已按其他候选编码解码', source.mixed_rows, source.encoding)
+
+    def _load_lazy(self, state=None):
+        """用惰性查询后端直接对CSV/Parquet计算汇总量；失败时返回False，由调用方退回pandas分块读取"""
+        backend = self.query_backend
+        if not LazyQueryBackend._is_parquet(self.file_path):
+            self.encoding = self.encoding or _detect_encoding(self.file_path)
+            if self.encoding not in ('utf-8', 'utf-8-sig'):
+                logger.info('%s后端只支持UTF-8文件，%s 编码改用pandas分块读取', backend.name, self.encoding)
+                return False
+        try:
+            header = backend.columns(self.file_path)
+            key_fields = self._match_key_fields(header)
+            exclude_dates = state.snapshot_dates if state is not None and key_fields['date'] else None
+            aggregates = backend.aggregate(self.file_path, key_fields, header, exclude_dates=exclude_dates,
+                                           hist_range=self.hist_range)
+        except Exception as e:
+            logger.warning('⚠️ %s后端执行失败，改用pandas分块读取: %s: %s', backend.name, type(e).__name__, e)
+            return False
+
+        self._adopt_aggregates(header, key_fields, aggregates, state)
+        usecols = list(dict.fromkeys(col for col in key_fields.values() if col))
+        logger.info('成功通过%s后端加载ESG数据: %s 条记录', backend.name, self.aggregates.row_count)
+        logger.info('字段数量: %s，实际读取字段: %s', len(header), usecols)
+        return True
+
+    def _adopt_aggregates(self, header, key_fields, aggregates, state=None):
+        """流式/惰性加载完成后保存字段信息和汇总量；增量模式下与已保存的状态合并"""
+        self.source_columns = header
+        self.key_fields = key_fields
+        self.financial_data = None
+
+        if state is not None and key_fields['date']:
+            logger.info('➕ 新增评级日期: %s 个, 新增记录: %s 条', len(aggregates.snapshot_dates), aggregates.row_count)
+            aggregates = state.merge(aggregates)
+        self.aggregates = aggregates
+
+    def _has_data(self):
+        return self.financial_data is not None or self.aggregates is not None
+
+    def _row_count(self):
+        if self.financial_data is not None:
+            return len(self.financial_data)
+        return self.aggregates.row_count if self.aggregates is not None else 0
+
+    def _data_shape(self):
+        """当前数据的(行数, 列数)；流式模式下列数为数值字段数"""
+        if self.financial_data is not None:
+            return self.financial_data.shape
+        if self.aggregates is not None:
+            return self.aggregates.row_count, len(self.aggregates.numeric_order)
+        return 0, 0
+
+    def _stage(self, name):
+        return self.instrumentation.stage(name, shape=self._data_shape, labels={'file': self.file_path})
+
     def explore_data_fields(self):
         #提前创建字符串
-        print("\n" + "=" * 80)
-        print("1. 探索ESG数据字段结构")
-        print("=" * 80)
+        logger.info('\n' + '=' * 80)
+        logger.info('1. 探索ESG数据字段结构')
+        logger.info('=' * 80)
         
-        if self.financial_data is None:
-            print("❌没有可用的数据")
+        if not self._has_data():
+            logger.error('❌没有可用的数据')
             return
 
-        print(f"共有 {len(self.financial_data.columns)} 个字段")
-        print(f"数据记录数: {len(self.financial_data)}")
+        logger.info('共有 %s 个字段', len(self.source_columns))
+        logger.info('数据记录数: %s', self._row_count())
 
         # 分类显示ESG字段，进行各个行业主体打分
         self._categorize_esg_fields()
 
     def _categorize_esg_fields(self):
     
-        field_names = self.financial_data.columns.tolist()
-
-        #基础信息字段
-        #通过关键词对field_name进行计数，筛选前15
-        basic_fields = [f for f in field_names if
-                        any(keyword in f.lower() for keyword in
-                            ['issuer', 'name', 'date', 'country', 'industry', 'rating'])]
-        print(f"\n 基础信息字段 ({len(basic_fields)}个):")
-        for field in sorted(basic_fields)[:15]:
-            print(f"  - {field}")
-
-        # E(环境)相关字段
-        env_fields = [f for f in field_names if
-                      any(keyword in f.lower() for keyword in
-                          ['environment', 'climate', 'carbon', 'energy', 'water', 'waste', 'biodiv'])]
-        print(f"\n🌱 环境(E)相关字段 ({len(env_fields)}个):")
-        for field in sorted(env_fields)[:15]:
-            print(f"  - {field}")
-
-        # S(社会)相关字段
-        social_fields = [f for f in field_names if
-                         any(keyword in f.lower() for keyword in
-                             ['social', 'human', 'labor', 'health', 'safety', 'product', 'privacy'])]
-        print(f"\n👥 社会(S)相关字段 ({len(social_fields)}个):")
-        for field in sorted(social_fields)[:15]:
-            print(f"  - {field}")
-
-        # G(治理)相关字段
-        gov_fields = [f for f in field_names if
-                      any(keyword in f.lower() for keyword in
-                          ['governance', 'board', 'committee', 'director', 'audit', 'ethics'])]
-        print(f"\n🏛️ 治理(G)相关字段 ({len(gov_fields)}个):")
-        for field in sorted(gov_fields)[:15]:
-            print(f"  - {field}")
-
-        # 评分字段
-        score_fields = [f for f in field_names if 'score' in f.lower()]
-        print(f"\n 评分字段 ({len(score_fields)}个):")
-        for field in sorted(score_fields)[:20]:
-            print(f"  - {field}")
+        field_index = build_field_index(self.source_columns)
+
+        #通过字段分类索引取各类字段，显示前15（评分字段前20）；字段列表只在输出时才拼接
+        listings = [
+            ('basic', '\n 基础信息字段 (%s个):%s', 15),
+            ('environmental', '\n🌱 环境(E)相关字段 (%s个):%s', 15),  # E(环境)相关字段
+            ('social', '\n👥 社会(S)相关字段 (%s个):%s', 15),  # S(社会)相关字段
+            ('governance', '\n🏛️ 治理(G)相关字段 (%s个):%s', 15),  # G(治理)相关字段
+            ('score', '\n 评分字段 (%s个):%s', 20),  # 评分字段
+        ]
+        for category, message, limit in listings:
+            fields = field_index.fields(category)
+            logger.info(message, len(fields), _LazyText(_bullet_list, sorted(fields)[:limit]))
 
     def identify_key_fields(self):
         #行业字段筛选
-        print("\n" + "=" * 80)
-        print("2. 识别关键ESG字段")
-        print("=" * 80)
+        logger.info('\n' + '=' * 80)
+        logger.info('2. 识别关键ESG字段')
+        logger.info('=' * 80)
 
-        if self.financial_data is None:
-            print("❌ 没有可用的数据")
+        if not self._has_data():
+            logger.error('❌ 没有可用的数据')
             return {}
 
-        available_columns = self.financial_data.columns.tolist()
-        key_fields = {}
-
-        # 寻找公司名称字段
-        name_fields = [col for col in available_columns if
-                       any(keyword in col.lower() for keyword in
-                           ['issuer_name', 'name', 'company'])]
-        key_fields['name'] = name_fields[0] if name_fields else None
-        print(f"公司名称字段: {key_fields['name']}")
-
-        # 寻找日期字段
-        date_fields = [col for col in available_columns if
-                       any(keyword in col.lower() for keyword in
-                           ['date', 'as_of_date', 'rating_date'])]
-        key_fields['date'] = date_fields[0] if date_fields else None
-        print(f"📅 日期字段: {key_fields['date']}")
-
-        # 寻找评级字段
-        rating_fields = [col for col in available_columns if
-                         any(keyword in col.lower() for keyword in
-                             ['rating', 'iva_company_rating'])]
-        key_fields['rating'] = rating_fields[0] if rating_fields else None
-        print(f"⭐ 评级字段: {key_fields['rating']}")
-
-        # 寻找行业字段
-        industry_fields = [col for col in available_columns if
-                           any(keyword in col.lower() for keyword in
-                               ['industry', 'iva_industry'])]
-        key_fields['industry'] = industry_fields[0] if industry_fields else None
-        print(f"🏭 行业字段: {key_fields['industry']}")
-
-        # 寻找ESG总分字段
-        total_score_fields = [col for col in available_columns if
-                              any(keyword in col.lower() for keyword in
-                                  ['weighted_average_score', 'total_score', 'overall_score'])]
-        key_fields['total_score'] = total_score_fields[0] if total_score_fields else None
-        print(f"总分字段: {key_fields['total_score']}")
-
-        # 寻找三大支柱分数
-        pillar_fields = {
-            'environmental': [col for col in available_columns if 'environmental_pillar_score' in col.lower()],
-            'social': [col for col in available_columns if 'social_pillar_score' in col.lower()],
-            'governance': [col for col in available_columns if 'governance_pillar_score' in col.lower()]
-        }
-
-        for pillar, fields in pillar_fields.items():
-            key_fields[f'{pillar}_score'] = fields[0] if fields else None
-            print(f" {pillar.capitalize()}支柱分数: {key_fields[f'{pillar}_score']}")
+        key_fields = self._match_key_fields(self.source_columns)
+        logger.info('公司名称字段: %s', key_fields['name'])
+        logger.info('📅 日期字段: %s', key_fields['date'])
+        logger.info('⭐ 评级字段: %s', key_fields['rating'])
+        logger.info('🏭 行业字段: %s', key_fields['industry'])
+        logger.info('总分字段: %s', key_fields['total_score'])
+        for pillar in ['environmental', 'social', 'governance']:
+            logger.info(' %s支柱分数: %s', pillar.capitalize(), key_fields[f'{pillar}_score'])
 
+        self.key_fields = key_fields
         return key_fields
 
-    def prepare_esg_data(self, key_fields):
-        
-        print("\n" + "=" * 80)
-        print("3. 准备ESG数据")
-        print("=" * 80)
-
-        if self.financial_data is None:
-            print("❌ 没有可用的数据")
-            return False
-
-        # 创建数据副本
-        analysis_data = self.financial_data.copy()
+    @staticmethod
+    def _match_key_fields(available_columns):
+        """根据字段名匹配关键ESG字段（只需要表头，不需要数据）"""
+        return dict(build_field_index(available_columns).key_fields)
 
-        # 处理日期字段
-        if key_fields['date']:
-            try:
-                analysis_data['year'] = pd.to_datetime(analysis_data[key_fields['date']]).dt.year
-                print(f"✅ 已提取年份信息: {analysis_data['year'].min()} - {analysis_data['year'].max()}")
-            except Exception as e:
-                print(f"⚠️ 日期字段处理失败: {e}")
-                # 创建模拟年份
-                analysis_data['year'] = 2023
-                print("⚠️ 使用默认年份2023")
-
-        # 重命名字段以便统一使用
+    @staticmethod
+    def _build_field_mapping(key_fields):
+        """原始字段名 -> 统一字段名"""
         field_mapping = {}
         if key_fields['name']:
             field_mapping[key_fields['name']] = 'company_name'
@@ -231,109 +3211,258 @@ class ESGDataAnalyzer:
             field_mapping[key_fields['social_score']] = 'social_score'
         if key_fields.get('governance_score'):
             field_mapping[key_fields['governance_score']] = 'governance_score'
+        return field_mapping
 
-        analysis_data = analysis_data.rename(columns=field_mapping)
-        print(f"✅ 字段重命名完成: {field_mapping}")
+    def prepare_esg_data(self, key_fields):
+        
+        logger.info('\n' + '=' * 80)
+        logger.info('3. 准备ESG数据')
+        logger.info('=' * 80)
+
+        if self.aggregates is not None and self.financial_data is None:
+            # 流式加载时已逐块完成年份提取和字段重命名
+            logger.info('✅ 流式模式已完成字段重命名: %s', self._build_field_mapping(key_fields))
+            if self.aggregates.year_min is not None:
+                logger.info('✅ 已提取年份信息: %s - %s', self.aggregates.year_min, self.aggregates.year_max)
+            return True
+
+        if self.prepared_from_cache:
+            logger.info('✅ 使用缓存中已准备好的数据，跳过日期解析和字段重命名')
+            return True
+
+        if self.financial_data is None:
+            logger.error('❌ 没有可用的数据')
+            return False
+
+        # 直接在原数据上处理，不再复制整张宽表
+        analysis_data = self.financial_data
+
+        # 处理日期字段
+        if key_fields['date']:
+            # 无法解析的日期年份记为缺失，不再用默认年份代替
+            dates = _parse_dates(analysis_data[key_fields['date']], errors='coerce')
+            analysis_data['year'] = dates.dt.year
+            # 保留解析后的评级日期，列式缓存中以它代替原始日期字段
+            analysis_data['as_of_date'] = dates
+            unparsed = int((analysis_data[key_fields['date']].notna() & dates.isna()).sum())
+            if unparsed:
+                logger.warning('⚠️ %s 行日期无法解析，年份记为缺失（可先运行 validate_data 检查数据质量）', unparsed)
+            if dates.notna().any():
+                logger.info('✅ 已提取年份信息: %s - %s', int(analysis_data['year'].min()),
+                            int(analysis_data['year'].max()))
+            else:
+                logger.warning('⚠️ 日期字段全部无法解析')
+
+        # 重命名字段以便统一使用
+        field_mapping = self._build_field_mapping(key_fields)
+        analysis_data.rename(columns=field_mapping, inplace=True)
+        logger.info('✅ 字段重命名完成: %s', field_mapping)
+
+        # 三大支柱平均分在分数降为float32之前计算，两位小数的取整与流式读取和惰性查询后端一致
+        available_scores = [col for col in SCORE_COLUMNS if col in analysis_data.columns]
+        if len(available_scores) >= 3 and all(pd.api.types.is_numeric_dtype(analysis_data[col])
+                                              for col in available_scores):
+            analysis_data['esg_pillar_avg'] = _pillar_average(analysis_data, available_scores)
+
+        # 统一字段类型，降低内存占用
+        _normalize_schema(analysis_data)
 
         # 更新financial_data
         self.financial_data = analysis_data
+        self.key_fields = key_fields
+        if self.cache is not None:
+            self._store_cache()
         return True
         
     def calculate_esg_metrics(self):
         """计算ESG指标"""
-        print("\n" + "=" * 80)
-        print("4. 计算ESG指标")
-        print("=" * 80)
-        
-        if self.financial_data is None or self.financial_data.empty:
-            print("❌ 没有可用的ESG数据")
+        logger.info('\n' + '=' * 80)
+        logger.info('4. 计算ESG指标')
+        logger.info('=' * 80)
+
+        if self.financial_data is not None and not self.financial_data.empty:
+            available_scores = [col for col in SCORE_COLUMNS if col in self.financial_data.columns]
+            # 如果有多个分数且准备数据时尚未算出，计算三大支柱平均分
+            if len(available_scores) >= 3 and 'esg_pillar_avg' not in self.financial_data.columns:
+                try:
+                    self.financial_data['esg_pillar_avg'] = _pillar_average(self.financial_data, available_scores)
+                except Exception as e:
+                    logger.warning('⚠️ 计算三大支柱平均分失败: %s', e)
+            # 一次遍历算出后续所有步骤需要的统计量
+            self.aggregates = ESGAggregates(hist_range=self.hist_range)
+            self.aggregates.update(self.financial_data, workers=self.workers)
+
+        if not self._ensure_statistics():
+            logger.error('❌ 没有可用的ESG数据')
             return
-      
-        metrics_calculated = []
-
-        # 检查并处理ESG分数
-        score_columns = ['total_esg_score', 'environmental_score', 'social_score', 'governance_score']
-        available_scores = [col for col in score_columns if col in self.financial_data.columns]
 
+        aggregates = self.aggregates
+        available_scores = aggregates.available_scores()
+        metrics_calculated = list(available_scores)
         if available_scores:
-            print(f"✅ 可用的ESG分数字段: {available_scores}")
-            metrics_calculated.extend(available_scores)
-
-        # 如果有多个分数，计算平均分和总分
-        if len(available_scores) >= 3:
-            try:
-                # 计算三大支柱平均分
-                self.financial_data['esg_pillar_avg'] = self.financial_data[available_scores].mean(axis=1).round(2)
-                metrics_calculated.append('三大支柱平均分')
-                print("✅ 计算三大支柱平均分完成")
-            except:
-                print("⚠️ 计算三大支柱平均分失败")
+            logger.info('✅ 可用的ESG分数字段: %s', available_scores)
+        if 'esg_pillar_avg' in aggregates.numeric_order:
+            metrics_calculated.append('三大支柱平均分')
+            logger.info('✅ 计算三大支柱平均分完成')
 
         # 评级分布分析
-        if 'esg_rating' in self.financial_data.columns:
-            rating_counts = self.financial_data['esg_rating'].value_counts()
-            print(f"\n📊 ESG评级分布:")
-            for rating, count in rating_counts.items():
-                print(f"  - {rating}: {count} 家公司")
-        
+        if len(aggregates.rating_counts) > 0:
+            logger.info('\n📊 ESG评级分布:%s', _LazyText(
+                lambda: _bullet_list(f'{rating}: {count} 家公司'
+                                     for rating, count in aggregates.sorted_rating_counts().items())))
+
         if metrics_calculated:
-            print(f"\n📊 成功分析 {len(metrics_calculated)} 个ESG指标")
+            logger.info('\n📊 成功分析 %s 个ESG指标', len(metrics_calculated))
+            if aggregates.preview is not None:
+                logger.info('\nESG指标预览:')
+                logger.info('%s', _LazyText(aggregates.preview.to_string, index=False))
+        else:
+            logger.warning('⚠️ 未能计算任何ESG指标')
 
-            # 显示计算结果预览
-            display_cols = ['company_name', 'year'] if 'company_name' in self.financial_data.columns else ['year']
-            display_cols.extend(available_scores[:3])  # 只显示前3个分数
+    def _ensure_statistics(self):
+        """确保统计引擎结果可用；尚未计算时用内存中的数据补算一次"""
+        if self.aggregates is not None:
+            return True
+        if self.financial_data is None or self.financial_data.empty:
+            return False
+        self.aggregates = ESGAggregates(hist_range=self.hist_range)
+        self.aggregates.update(self.financial_data, workers=self.workers)
+        return True
 
-            print("\nESG指标预览:")
-            print(self.financial_data[display_cols].head(10).to_string(index=False))
-        else:
-            print("⚠️ 未能计算任何ESG指标")
-   
     def descriptive_analysis(self):
         """描述性统计分析"""
-        print("\n" + "=" * 80)
-        print("5. 描述性统计分析")
-        print("=" * 80)
-          
-        if self.financial_data is None or self.financial_data.empty:
-            print("❌ 没有可用的ESG数据")
-            return
+        logger.info('\n' + '=' * 80)
+        logger.info('5. 描述性统计分析')
+        logger.info('=' * 80)
 
-        # 数值字段统计
-        numeric_cols = self.financial_data.select_dtypes(include=[np.number]).columns
-        if len(numeric_cols) > 0:
-            print("📈 数值字段描述统计:")
-            # 只显示前10个数值字段的统计信息
-            display_cols = numeric_cols[:10] if len(numeric_cols) > 10 else numeric_cols
-            print(self.financial_data[display_cols].describe().round(2))
+        if not self._ensure_statistics():
+            logger.error('❌ 没有可用的ESG数据')
+            return
+        if not logger.isEnabledFor(logging.INFO):
+            # 本阶段只输出统计表，静默模式下无需生成
+            return
+        aggregates = self.aggregates
+
+        # 数值字段统计，只显示前10个数值字段
+        numeric_summary = aggregates.numeric_summary(limit=10)
+        if not numeric_summary.empty:
+            if self.financial_data is not None:
+                # 明细数据在内存中时与 describe() 一致，补上四分位数
+                logger.info('📈 数值字段描述统计:')
+                numeric_summary = self._with_quartiles(numeric_summary)
+            elif self.sketches is not None:
+                logger.info('📈 数值字段描述统计（流式汇总，不含分位数；近似分位数见下方草图估计）:')
+            else:
+                logger.info('📈 数值字段描述统计（流式汇总，不含分位数）:')
+            logger.info('%s', numeric_summary.round(2))
 
         # 按行业统计（如果有行业信息）
-        if 'industry' in self.financial_data.columns and 'total_esg_score' in self.financial_data.columns:
-            industry_stats = self.financial_data.groupby('industry').agg({
-                'total_esg_score': ['count', 'mean', 'std', 'min', 'max']
-            }).round(2)
-
-            print("\n🏭 各行业ESG评分统计:")
-            print(industry_stats)
+        industry_stats = aggregates.industry_summary()
+        if not industry_stats.empty:
+            logger.info('\n🏭 各行业ESG评分统计:')
+            logger.info('%s', industry_stats.round(2))
 
         # 评级统计
-        if 'esg_rating' in self.financial_data.columns:
-            rating_stats = self.financial_data['esg_rating'].describe()
-            print(f"\n⭐ ESG评级统计:")
-            print(f"  唯一评级数量: {rating_stats['unique']}")
-            print(f"  最常见评级: {rating_stats['top']} (出现{rating_stats['freq']}次)")
+        if len(aggregates.rating_counts) > 0:
+            top_rating, top_count = aggregates.rating_mode()
+            logger.info('\n⭐ ESG评级统计:')
+            logger.info('  唯一评级数量: %s', len(aggregates.rating_counts))
+            logger.info('  最常见评级: %s (出现%s次)', top_rating, top_count)
+
+        if self.sketches is not None:
+            self._describe_sketches()
+
+    def _with_quartiles(self, numeric_summary):
+        """在 count/mean/std/min/max 中按 describe() 的行顺序插入由明细数据计算的 25%/50%/75% 分位数"""
+        columns = [col for col in numeric_summary.columns if col in self.financial_data.columns]
+        quartiles = self.financial_data[columns].astype('float64').quantile([0.25, 0.5, 0.75])
+        quartiles.index = ['25%', '50%', '75%']
+        return pd.concat([numeric_summary.loc[['count', 'mean', 'std', 'min']], quartiles,
+                          numeric_summary.loc[['max']]])[numeric_summary.columns]
+
+    def _describe_sketches(self):
+        """近似分析模式：输出由草图估计的分位数、发行人数和高频评级/行业，并注明误差范围"""
+        sketches = self.sketches
+        bounds = sketches.error_bounds()
+        logger.info('\n≈ 近似统计（草图估计）:')
+        quantiles = sketches.quantile_summary()
+        if not quantiles.empty:
+            logger.info('分数分位数 (排名误差 ±%.2f%%):', bounds['quantile_rank_error'] * 100)
+            logger.info('%s', quantiles.round(2))
+        logger.info('  发行人数量: ≈%s (相对误差 ±%.2f%%)', sketches.distinct_issuers(),
+                    bounds['distinct_relative_error'] * 100)
+        for column, label in [('industry', '行业'), ('esg_rating', '评级')]:
+            top = sketches.top(column, 5)
+            if len(top):
+                logger.info('  最常见%s (频数高估不超过%s条): %s', label, bounds['frequency_additive_error'][column],
+                            ', '.join(f'{key}≈{count}' for key, count in top.items()))
+
+    def save_sketches(self, path):
+        """把近似分析草图写入JSON文件，可用 ESGSketches.load(path).merge(...) 跨文件/日期合并"""
+        if self.sketches is None:
+            logger.warning('⚠️ 没有可保存的草图（需要 approximate=True）')
+            return False
+        self.sketches.save(path)
+        logger.info('💾 近似分析草图已写入: %s', path)
+        return True
 
     def create_visualizations(self):
         """创建ESG数据可视化图表"""
-        print("\n" + "=" * 80)
-        print("6. 创建ESG数据可视化分析")
-        print("=" * 80)
+        logger.info('\n' + '=' * 80)
+        logger.info('6. 创建ESG数据可视化分析')
+        logger.info('=' * 80)
 
-        if self.financial_data is None or self.financial_data.empty:
-            print("❌ 没有可用的ESG数据")
+        if not self._ensure_statistics():
+            logger.error('❌ 没有可用的ESG数据')
             return
+        aggregates = self.aggregates
+
+        self._warn_hist_range(aggregates.hist_out_of_range())
+        # 图表只使用预先聚合好的分箱计数和Top-N结果，绘图开销与数据行数无关
+        inputs = aggregates.chart_inputs()
+        if inputs['rating_distinct'] > len(inputs['rating_labels']):
+            logger.warning('⚠️ 评级数量过多，只显示前%s个最常见的评级', len(inputs['rating_labels']))
+
+        plt = self.setup_visualization()
+        fig, axes = self._get_dashboard_figure()
+        _draw_dashboard(axes, inputs)
+
+        # 使用更宽松的布局
+        plt.tight_layout(pad=4.0)  # 增加pad参数，从默认的1.08增加到4.0
+
+        # 在显示前添加一些间距
+        logger.info('\n📈 正在生成ESG可视化图表...')
+        logger.info('⏳ 请稍候，图表正在渲染...')
+        if self.output_dir:
+            stem = os.path.splitext(os.path.basename(str(self.file_path)))[0]
+            for path in _save_figure(fig, self.output_dir, f'{stem}_esg_dashboard', self.figure_formats):
+                logger.info('💾 图表已保存: %s', path)
+                self.chart_paths.append(path)
+        else:
+            plt.show()
+            # 交互窗口关闭后图表不能再复用
+            self._dashboard = None
+
+        # 图表显示后添加分隔
+        logger.info('\n' + '=' * 60)
+        logger.info('🎨 ESG可视化图表显示完成')
+        logger.info('=' * 60)
+
+    def _warn_hist_range(self, actual):
+        if actual is not None:
+            logger.warning('⚠️ ESG总分取值范围 [%.6g, %.6g] 超出直方图范围 [%s, %s]，超出的值计入两端的分箱；'
+                           '请用 hist_range（或 ESG_HIST_RANGE）指定分制', actual[0], actual[1], *self.hist_range)
+
+    def _get_dashboard_figure(self):
+        """创建或复用 18x16 英寸的总览图，复用时只清空各子图"""
+        if self._dashboard is not None:
+            fig, axes = self._dashboard
+            for ax in axes:
+                ax.cla()
+            return fig, axes
 
         # 创建图表 - 使用更大的图像尺寸和更多的间距
-        fig = plt.figure(figsize=(18, 16), dpi=150)  # 进一步增大图像尺寸
+        fig = self.setup_visualization().figure(figsize=(18, 16), dpi=150)  # 进一步增大图像尺寸
         fig.suptitle('ESG数据分析可视化', fontsize=18, fontweight='bold', y=0.98)
 
         # 使用GridSpec进行更精细的布局控制 - 增加行间距
@@ -345,236 +3474,527 @@ class ESGDataAnalyzer:
             fig.add_subplot(gs[1, 0]),
             fig.add_subplot(gs[1, 1])
         ]
-
-        # 子图1: ESG总分分布
-        if 'total_esg_score' in self.financial_data.columns:
-            data = self.financial_data['total_esg_score'].dropna()
-            if len(data) > 0:
-                axes[0].hist(data, bins=20, alpha=0.7, color='skyblue',
-                             edgecolor='black', linewidth=0.5)
-                axes[0].set_title('ESG总分分布', fontweight='bold', pad=20)  # 增加标题间距
-                axes[0].set_xlabel('ESG总分', labelpad=15)  # 增加标签间距
-                axes[0].set_ylabel('公司数量', labelpad=15)
-                axes[0].grid(True, alpha=0.3, linestyle='--')
-                # 添加统计信息
-                axes[0].text(0.05, 0.95, f'样本数: {len(data)}\n均值: {data.mean():.2f}',
-                             transform=axes[0].transAxes, verticalalignment='top',
-                             bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.5),
-                             fontsize=10)
-
-        # 子图2: ESG评级分布 - 优化x轴显示
-        if 'esg_rating' in self.financial_data.columns:
-            rating_counts = self.financial_data['esg_rating'].value_counts()
-            if len(rating_counts) > 0:
-                # 如果评级数量太多，只显示前10个
-                if len(rating_counts) > 10:
-                    rating_counts = rating_counts.head(10)
-                    print(f"⚠️ 评级数量过多，只显示前10个最常见的评级")
-
-                bars = axes[1].bar(range(len(rating_counts)), rating_counts.values,
-                                   color='lightcoral', alpha=0.7, edgecolor='black', linewidth=0.5)
-                axes[1].set_title('ESG评级分布', fontweight='bold', pad=20)
-                axes[1].set_xlabel('ESG评级', labelpad=15)
-                axes[1].set_ylabel('公司数量', labelpad=15)
-                axes[1].set_xticks(range(len(rating_counts)))
-
-                # 优化x轴标签显示
-                labels = rating_counts.index
-                # 如果标签太长，进行截断
-                truncated_labels = [label[:8] + '...' if len(str(label)) > 8 else str(label) for label in labels]
-
-                axes[1].set_xticklabels(truncated_labels,
-                                        rotation=45,
-                                        ha='right',
-                                        fontsize=9)  # 减小字体大小
-
-                axes[1].grid(True, alpha=0.3, linestyle='--')
-
-                # 在柱状图上添加数值标签
-                for i, bar in enumerate(bars):
-                    height = bar.get_height()
-                    axes[1].text(bar.get_x() + bar.get_width() / 2., height,
-                                 f'{int(height)}', ha='center', va='bottom', fontsize=8)
-
-        # 子图3: 三大支柱分数对比（如果可用）
-        pillar_scores = []
-        pillar_labels = []
-        for pillar in ['environmental_score', 'social_score', 'governance_score']:
-            if pillar in self.financial_data.columns:
-                valid_data = self.financial_data[pillar].dropna()
-                if len(valid_data) > 0:
-                    pillar_scores.append(valid_data.mean())
-                    pillar_labels.append(pillar.replace('_score', '').capitalize())
-
-        if len(pillar_scores) >= 2:
-            colors = ['lightgreen', 'lightblue', 'gold']
-            bars = axes[2].bar(range(len(pillar_scores)), pillar_scores,
-                               color=colors[:len(pillar_scores)], alpha=0.7,
-                               edgecolor='black', linewidth=0.5)
-            axes[2].set_title('ESG三大支柱平均分对比', fontweight='bold', pad=20)
-            axes[2].set_xlabel('ESG支柱', labelpad=15)
-            axes[2].set_ylabel('平均分数', labelpad=15)
-            axes[2].set_xticks(range(len(pillar_scores)))
-
-            # 简化支柱标签
-            simplified_labels = []
-            for label in pillar_labels:
-                if label == 'Environmental':
-                    simplified_labels.append('环境(E)')
-                elif label == 'Social':
-                    simplified_labels.append('社会(S)')
-                elif label == 'Governance':
-                    simplified_labels.append('治理(G)')
-                else:
-                    simplified_labels.append(label)
-
-            axes[2].set_xticklabels(simplified_labels, rotation=0, fontsize=11)  # 稍微增大字体
-            axes[2].grid(True, alpha=0.3, linestyle='--')
-
-            # 在柱状图上添加数值标签
-            for i, bar in enumerate(bars):
-                height = bar.get_height()
-                axes[2].text(bar.get_x() + bar.get_width() / 2., height,
-                             f'{height:.2f}', ha='center', va='bottom', fontsize=10)
-
-        # 子图4: 行业ESG表现（如果有行业数据）
-        if 'industry' in self.financial_data.columns and 'total_esg_score' in self.financial_data.columns:
-            industry_avg = self.financial_data.groupby('industry')['total_esg_score'].mean().nlargest(8)
-            if len(industry_avg) > 0:
-                bars = axes[3].bar(range(len(industry_avg)), industry_avg.values,
-                                   color='orange', alpha=0.7, edgecolor='black', linewidth=0.5)
-                axes[3].set_title('各行业平均ESG评分', fontweight='bold', pad=20)
-                axes[3].set_xlabel('行业', labelpad=15)
-                axes[3].set_ylabel('平均ESG评分', labelpad=15)
-                axes[3].set_xticks(range(len(industry_avg)))
-
-                # 优化行业名称显示
-                industry_labels = []
-                for label in industry_avg.index:
-                    if len(str(label)) > 12:
-                        # 如果行业名称太长，进行截断
-                        industry_labels.append(str(label)[:10] + '...')
-                    else:
-                        industry_labels.append(str(label))
-
-                axes[3].set_xticklabels(industry_labels,
-                                        rotation=45,
-                                        ha='right',
-                                        fontsize=9)  # 减小字体大小
-
-                axes[3].grid(True, alpha=0.3, linestyle='--')
-
-                # 在柱状图上添加数值标签
-                for i, bar in enumerate(bars):
-                    height = bar.get_height()
-                    axes[3].text(bar.get_x() + bar.get_width() / 2., height,
-                                 f'{height:.2f}', ha='center', va='bottom', fontsize=8)
-
-        # 使用更宽松的布局
-        plt.tight_layout(pad=4.0)  # 增加pad参数，从默认的1.08增加到4.0
-
-        # 在显示前添加一些间距
-        print("\n📈 正在生成ESG可视化图表...")
-        print("⏳ 请稍候，图表正在渲染...")
-        plt.show()
-
-        # 图表显示后添加分隔
-        print("\n" + "=" * 60)
-        print("🎨 ESG可视化图表显示完成")
-        print("=" * 60)
+        self._dashboard = (fig, axes)
+        return fig, axes
+
+    def render_industry_charts(self, output_dir=None, formats=None, workers=None):
+        """无界面并行渲染各行业图表：先一次性算出每个行业的分箱计数和支柱均值，再分批交给工作进程"""
+        output_dir = output_dir or self.output_dir or 'esg_charts'
+        formats = tuple(formats or self.figure_formats)
+        data = self.financial_data
+        if data is None or 'industry' not in data.columns or 'total_esg_score' not in data.columns:
+            logger.warning('⚠️ 需要内存中的行业和ESG总分数据才能绘制行业图表')
+            return []
+
+        scores = data['total_esg_score'].to_numpy(dtype='float64', na_value=np.nan)
+        codes, industries = pd.factorize(data['industry'])
+        valid = (codes >= 0) & ~np.isnan(scores)
+        edges = np.linspace(self.hist_range[0], self.hist_range[1], SCORE_HIST_BINS + 1)
+        if valid.any() and (scores[valid].min() < edges[0] or scores[valid].max() > edges[-1]):
+            self._warn_hist_range((float(scores[valid].min()), float(scores[valid].max())))
+        bins = _bin_index(scores[valid], edges)
+        # 行业编码 x 分箱 的二维计数，一次bincount完成
+        hist = np.bincount(codes[valid] * SCORE_HIST_BINS + bins,
+                           minlength=len(industries) * SCORE_HIST_BINS).reshape(len(industries), -1)
+
+        pillar_cols = [col for col in ['environmental_score', 'social_score', 'governance_score']
+                       if col in data.columns]
+        pillar_means = data.groupby('industry', observed=True)[pillar_cols].mean() if pillar_cols else None
+
+        payloads = []
+        for i, industry in enumerate(industries):
+            payloads.append({
+                'industry': str(industry),
+                'hist': hist[i],
+                'edges': edges,
+                'pillars': {} if pillar_means is None else pillar_means.loc[industry].to_dict(),
+            })
+
+        workers = min(workers or os.cpu_count() or 1, len(payloads)) or 1
+        batches = [payloads[i::workers] for i in range(workers)]
+        logger.info('🎨 使用 %s 个进程渲染 %s 个行业图表...', workers, len(payloads))
+        paths = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for batch_paths in pool.map(_render_industry_batch, batches,
+                                        [output_dir] * workers, [formats] * workers):
+                paths.extend(batch_paths)
+        self.chart_paths.extend(paths)
+        logger.info('💾 已保存 %s 个图表文件到 %s', len(paths), output_dir)
+        return paths
 
     def generate_summary_report(self):
         """生成ESG分析总结报告"""
-        print("\n" + "=" * 80)
-        print("ESG分析总结报告")
-        print("=" * 80)
+        logger.info('\n' + '=' * 80)
+        logger.info('ESG分析总结报告')
+        logger.info('=' * 80)
 
-        if self.financial_data is None:
-            print("❌ 没有可分析的数据")
+        if not self._ensure_statistics():
+            logger.error('❌ 没有可分析的数据')
             return
+        summary = self._summary()
+
+        logger.info('📋 ESG分析总结:')
+        logger.info('• 分析数据量: %s 条记录', summary['row_count'])
+        if summary['companies']:
+            logger.info('• 涉及公司数量: %s%s 家', '≈' if self.sketches is not None else '', summary['companies'])
+        if summary['year_min'] is not None:
+            logger.info('• 数据时间范围: %s - %s', summary['year_min'], summary['year_max'])
+        if summary['mean_total_esg_score'] is not None:
+            logger.info('• 平均ESG总分: %.2f', summary['mean_total_esg_score'])
+        if summary['top_rating'] is not None:
+            logger.info('• 最常见ESG评级: %s', summary['top_rating'])
+        if summary['industries']:
+            logger.info('• 涉及行业数量: %s 个', summary['industries'])
+
+        self._print_recommendations()
+        if self.report_store is not None and self.report_id is None:
+            self._store_report(summary)
+
+    def _summary(self):
+        """总结报告中的各项指标"""
+        aggregates = self.aggregates
+        has_total = 'total_esg_score' in aggregates.available_scores()
+        return {
+            'row_count': int(aggregates.row_count),
+            'companies': self.sketches.distinct_issuers() if self.sketches is not None else len(aggregates.companies),
+            'year_min': aggregates.year_min,
+            'year_max': aggregates.year_max,
+            'mean_total_esg_score': float(aggregates.score_mean('total_esg_score')) if has_total else None,
+            'top_rating': aggregates.rating_mode()[0] if len(aggregates.rating_counts) > 0 else None,
+            'industries': len(aggregates.industry_counts),
+        }
 
-        print("📋 ESG分析总结:")
-        print(f"• 分析数据量: {len(self.financial_data)} 条记录")
-
-        if 'company_name' in self.financial_data.columns:
-            print(f"• 涉及公司数量: {self.financial_data['company_name'].nunique()} 家")
-
-        if 'year' in self.financial_data.columns:
-            print(f"• 数据时间范围: {self.financial_data['year'].min()} - {self.financial_data['year'].max()}")
-
-        if 'total_esg_score' in self.financial_data.columns:
-            avg_score = self.financial_data['total_esg_score'].mean()
-            print(f"• 平均ESG总分: {avg_score:.2f}")
-
-        if 'esg_rating' in self.financial_data.columns:
-            top_rating = self.financial_data['esg_rating'].mode().iloc[0] if not self.financial_data[
-                'esg_rating'].empty else 'N/A'
-            print(f"• 最常见ESG评级: {top_rating}")
-
-        if 'industry' in self.financial_data.columns:
-            print(f"• 涉及行业数量: {self.financial_data['industry'].nunique()} 个")
-
-        print("\n💡 ESG数据分析建议:")
-        print("1. 关注ESG三大支柱的平衡发展")
-        print("2. 分析不同行业的ESG表现差异")
-        print("3. 跟踪ESG评级的动态变化")
-        print("4. 识别ESG表现优异的公司和行业")
-
-    def run_complete_analysis(self):
-        """运行完整的ESG分析流程"""
-        print("🚀 开始ESG数据分析（本地文件版）")
-        print("=" * 80)
+    def _store_report(self, summary):
+        """把总结报告写入报告产物存储；输入指纹包含源文件内容哈希和影响结果的分析参数"""
+        if not os.path.isfile(str(self.file_path)):
+            return
+        try:
+            report = {
+                'version': REPORT_VERSION,
+                'inputs': {
+                    'path': os.path.abspath(self.file_path),
+                    'size': os.path.getsize(self.file_path),
+                    'content_hash': _content_hash(self.file_path),
+                    'key_fields': self.key_fields,
+                    'state_path': self.state_path,
+                    'params': self._report_params(),
+                },
+                'summary': summary,
+                'charts': sorted(self.chart_paths),
+            }
+            self.report_id = self.report_store.save(report, self.aggregates, self.file_path)
+            logger.info('💾 报告产物已写入: %s', self.report_store._object_dir(self.report_id))
+        except Exception as e:
+            logger.warning('⚠️ 写入报告产物失败: %s', e)
+
+    def _report_params(self):
+        """影响汇总结果的分析参数：直方图范围、分块大小和查询后端（与JSON往返后的形式一致）"""
+        return {
+            'hist_range': [float(v) for v in self.hist_range],
+            'chunksize': self.chunksize,
+            'backend': self.query_backend.name if self.query_backend is not None else 'pandas',
+        }
 
+    def load_report(self):
+        """源文件未变化时读取上次的报告产物并恢复汇总量，返回报告；否则返回 None"""
+        if self.report_store is None or self.state_path or self.approximate:
+            return None
+        object_id = self.report_store.lookup(self.file_path, params=self._report_params())
+        if object_id is None:
+            return None
+        report = self.report_store.load(object_id)
+        self.aggregates = self.report_store.load_aggregates(object_id)
+        self.key_fields = report['inputs']['key_fields']
+        self.chart_paths = list(report['charts'])
+        self.report_id = object_id
+        logger.info('⚡ 源文件未变化，复用报告产物: %s', object_id)
+        return report
+
+    def _print_recommendations(self):
+        logger.info('\n💡 ESG数据分析建议:')
+        logger.info('1. 关注ESG三大支柱的平衡发展')
+        logger.info('2. 分析不同行业的ESG表现差异')
+        logger.info('3. 跟踪ESG评级的动态变化')
+        logger.info('4. 识别ESG表现优异的公司和行业')
+
+    def run_complete_analysis(self, raise_errors=False):
+        """运行完整的ESG分析流程；raise_errors为True时把异常抛给调用方而不是只打印
+
+        每个阶段的测量结果记录在 self.instrumentation.records 中。
+        """
+        logger.info('🚀 开始ESG数据分析（本地文件版）')
+        logger.info('=' * 80)
+
+        with self.instrumentation.run():
+            return self._run_stages(raise_errors)
+
+    def _run_stages(self, raise_errors):
         # 加载本地数据
-        if not self.load_local_data():
-            print("❌ 无法加载数据文件，分析终止")
-            return
+        with self._stage('load'):
+            loaded = self.load_local_data()
+        if not loaded:
+            logger.error('❌ 无法加载数据文件，分析终止')
+            return False
 
         try:
             # 执行分析步骤 - 添加步骤间分隔
-            print("\n" + "🔍 步骤1: 探索ESG数据字段结构")
-            self.explore_data_fields()
-
-            print("\n" + "🔑 步骤2: 识别关键ESG字段")
-            key_fields = self.identify_key_fields()
-
-            print("\n" + "🛠️ 步骤3: 准备ESG数据")
-            if self.prepare_esg_data(key_fields):
-                print("\n" + "📈 步骤4: 计算ESG指标")
-                self.calculate_esg_metrics()
-
-                print("\n" + "📊 步骤5: 描述性统计分析")
-                self.descriptive_analysis()
-
-                print("\n" + "🎨 步骤6: 创建可视化图表")
-                self.create_visualizations()
-
-                print("\n" + "📋 步骤7: 生成总结报告")
-                self.generate_summary_report()
+            logger.info('\n🔍 步骤1: 探索ESG数据字段结构')
+            with self._stage('explore'):
+                self.explore_data_fields()
+
+            logger.info('\n🔑 步骤2: 识别关键ESG字段')
+            with self._stage('identify'):
+                key_fields = self.identify_key_fields()
+
+            logger.info('\n🛠️ 步骤3: 准备ESG数据')
+            with self._stage('prepare'):
+                prepared = self.prepare_esg_data(key_fields)
+            if prepared:
+                logger.info('\n📈 步骤4: 计算ESG指标')
+                with self._stage('metrics'):
+                    self.calculate_esg_metrics()
+
+                logger.info('\n📊 步骤5: 描述性统计分析')
+                with self._stage('descriptive'):
+                    self.descriptive_analysis()
+
+                logger.info('\n🎨 步骤6: 创建可视化图表')
+                with self._stage('visualise'):
+                    self.create_visualizations()
+
+                logger.info('\n📋 步骤7: 生成总结报告')
+                with self._stage('report'):
+                    self.generate_summary_report()
+                return True
             else:
-                print("❌ 数据准备失败，无法继续分析")
+                logger.error('❌ 数据准备失败，无法继续分析')
+                return False
 
         except Exception as e:
-            print(f"❌ 分析过程中出现错误: {e}")
-            import traceback
-            traceback.print_exc()
+            if raise_errors:
+                raise
+            logger.exception('❌ 分析过程中出现错误: %s', e)
+            return False
 
         finally:
-            print("\n" + "=" * 50)
-            print("✅ ESG分析完成！")
-            print("=" * 50)
+            logger.info('\n' + '=' * 50)
+            logger.info('✅ ESG分析完成！')
+            logger.info('=' * 50)
+
+
+@lru_cache(maxsize=None)
+def _resolve_font_family(candidates):
+    """在已安装的字体中按顺序挑出可用的字体(只查一次字体表)，避免每段文字都为缺失的字体回退查找"""
+    from matplotlib import font_manager
+    installed = {font.name for font in font_manager.fontManager.ttflist}
+    available = [name for name in candidates if name in installed]
+    return available or list(candidates[-1:])
+
+
+@lru_cache(maxsize=None)
+def _apply_plot_style():
+    """应用 PLOT_RC_PARAMS（进程内只执行一次）"""
+    import matplotlib.pyplot as plt
+    plt.rcParams.update(PLOT_RC_PARAMS)
+    plt.rcParams['font.sans-serif'] = _resolve_font_family(tuple(PLOT_RC_PARAMS['font.sans-serif']))
+
+
+def _pyplot(headless=False):
+    """首次调用时才导入 matplotlib.pyplot 并应用图表样式；headless为True时使用Agg后端"""
+    import matplotlib
+    if headless and 'matplotlib.pyplot' not in sys.modules:
+        # 导入pyplot之前选择后端，省去加载交互式后端再切换的开销
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    if headless and plt.get_backend().lower() != 'agg':
+        plt.switch_backend('Agg')
+    _apply_plot_style()
+    return plt
+
+
+def _save_figure(fig, output_dir, name, formats):
+    """按多种格式保存图表，返回文件路径"""
+    os.makedirs(output_dir, exist_ok=True)
+    name = re.sub(r'[\\/:*?"<>|\s]+', '_', str(name))
+    paths = []
+    for fmt in formats:
+        path = os.path.join(output_dir, f'{name}.{fmt}')
+        fig.savefig(path, format=fmt, bbox_inches='tight', facecolor='white')
+        paths.append(path)
+    return paths
+
+
+def _truncate_labels(labels, max_len, keep):
+    """过长的标签截断为 keep 个字符加省略号"""
+    return [label if len(label) <= max_len else label[:keep] + '...' for label in map(str, labels)]
+
+
+def _draw_dashboard(axes, inputs):
+    """按 ESGAggregates.chart_inputs() 的预聚合结果绘制2x2总览图"""
+    # 子图1: ESG总分分布（分箱计数直接画阶梯图）
+    if inputs['sample_count'] > 0:
+        axes[0].stairs(inputs['hist_counts'], inputs['hist_edges'], fill=True, alpha=0.7,
+                       color='skyblue', edgecolor='black', linewidth=0.5)
+        axes[0].set_title('ESG总分分布', fontweight='bold', pad=20)  # 增加标题间距
+        axes[0].set_xlabel('ESG总分', labelpad=15)  # 增加标签间距
+        axes[0].set_ylabel('公司数量', labelpad=15)
+        axes[0].grid(True, alpha=0.3, linestyle='--')
+        # 添加统计信息
+        axes[0].text(0.05, 0.95, f'样本数: {inputs["sample_count"]}\n均值: {inputs["score_mean"]:.2f}',
+                     transform=axes[0].transAxes, verticalalignment='top',
+                     bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.5),
+                     fontsize=10)
+
+    # 子图2: ESG评级分布（Top-N）
+    rating_counts = inputs['rating_counts']
+    if len(rating_counts) > 0:
+        positions = np.arange(len(rating_counts))
+        bars = axes[1].bar(positions, rating_counts,
+                           color='lightcoral', alpha=0.7, edgecolor='black', linewidth=0.5)
+        axes[1].set_title('ESG评级分布', fontweight='bold', pad=20)
+        axes[1].set_xlabel('ESG评级', labelpad=15)
+        axes[1].set_ylabel('公司数量', labelpad=15)
+        axes[1].set_xticks(positions)
+        axes[1].set_xticklabels(_truncate_labels(inputs['rating_labels'], 8, 8),
+                                rotation=45, ha='right', fontsize=9)  # 减小字体大小
+        axes[1].grid(True, alpha=0.3, linestyle='--')
+        # 在柱状图上添加数值标签
+        axes[1].bar_label(bars, fmt='%d', fontsize=8)
+
+    # 子图3: 三大支柱分数对比（如果可用）
+    pillar_means = inputs['pillar_means']
+    if len(pillar_means) >= 2:
+        positions = np.arange(len(pillar_means))
+        colors = ['lightgreen', 'lightblue', 'gold']
+        bars = axes[2].bar(positions, pillar_means, color=colors[:len(pillar_means)], alpha=0.7,
+                           edgecolor='black', linewidth=0.5)
+        axes[2].set_title('ESG三大支柱平均分对比', fontweight='bold', pad=20)
+        axes[2].set_xlabel('ESG支柱', labelpad=15)
+        axes[2].set_ylabel('平均分数', labelpad=15)
+        axes[2].set_xticks(positions)
+        axes[2].set_xticklabels(inputs['pillar_labels'], rotation=0, fontsize=11)  # 稍微增大字体
+        axes[2].grid(True, alpha=0.3, linestyle='--')
+        axes[2].bar_label(bars, fmt='%.2f', fontsize=10)
+
+    # 子图4: 行业ESG表现（Top-N）
+    industry_means = inputs['industry_means']
+    if len(industry_means) > 0:
+        positions = np.arange(len(industry_means))
+        bars = axes[3].bar(positions, industry_means,
+                           color='orange', alpha=0.7, edgecolor='black', linewidth=0.5)
+        axes[3].set_title('各行业平均ESG评分', fontweight='bold', pad=20)
+        axes[3].set_xlabel('行业', labelpad=15)
+        axes[3].set_ylabel('平均ESG评分', labelpad=15)
+        axes[3].set_xticks(positions)
+        axes[3].set_xticklabels(_truncate_labels(inputs['industry_labels'], 12, 10),
+                                rotation=45, ha='right', fontsize=9)  # 减小字体大小
+        axes[3].grid(True, alpha=0.3, linestyle='--')
+        axes[3].bar_label(bars, fmt='%.2f', fontsize=8)
+
+
+def _draw_industry_chart(axes, payload):
+    """单个行业图表：ESG总分分布 + 三大支柱平均分"""
+    axes[0].stairs(payload['hist'], payload['edges'], fill=True, alpha=0.7,
+                   color='skyblue', edgecolor='black', linewidth=0.5)
+    axes[0].set_title('ESG总分分布', fontweight='bold')
+    axes[0].set_xlabel('ESG总分')
+    axes[0].set_ylabel('公司数量')
+    axes[0].grid(True, alpha=0.3, linestyle='--')
+
+    labels = {'environmental_score': '环境(E)', 'social_score': '社会(S)', 'governance_score': '治理(G)'}
+    pillars = {labels[k]: v for k, v in payload['pillars'].items() if pd.notna(v)}
+    if pillars:
+        axes[1].bar(range(len(pillars)), list(pillars.values()),
+                    color=['lightgreen', 'lightblue', 'gold'][:len(pillars)],
+                    alpha=0.7, edgecolor='black', linewidth=0.5)
+        axes[1].set_xticks(range(len(pillars)))
+        axes[1].set_xticklabels(list(pillars.keys()))
+    axes[1].set_title('ESG三大支柱平均分对比', fontweight='bold')
+    axes[1].grid(True, alpha=0.3, linestyle='--')
+
+
+def _render_industry_batch(payloads, output_dir, formats):
+    """渲染工作进程：整批行业复用同一个图表对象"""
+    plt = _pyplot(headless=True)
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5), dpi=100)
+    paths = []
+    try:
+        for payload in payloads:
+            for ax in axes:
+                ax.cla()
+            fig.suptitle(payload['industry'], fontsize=14, fontweight='bold')
+            _draw_industry_chart(axes, payload)
+            fig.tight_layout()
+            paths.extend(_save_figure(fig, output_dir, f"industry_{payload['industry']}", formats))
+    finally:
+        plt.close(fig)
+    return paths
+
+
+def _expand_batch_inputs(pattern):
+    """目录 -> 目录下所有CSV；否则按通配符展开"""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+    return sorted(glob.glob(pattern))
+
+
+def _analyze_file_worker(file_path, chunksize, output_dir=None, backend='pandas', hist_range=SCORE_HIST_RANGE):
+    """批处理工作进程：流式分析单个文件，返回可合并的汇总状态；异常只影响当前文件
+
+    output_dir不为空时同时在该进程内无界面渲染本文件的总览图。
+    """
+    # 工作进程只保留警告和错误，预览表和统计表不会被格式化
+    configure_logging('WARNING', structured=False)
+    try:
+        analyzer = ESGDataAnalyzer(file_path, chunksize=chunksize, output_dir=output_dir, backend=backend,
+                                   hist_range=hist_range)
+        if not analyzer.load_local_data():
+            return {'file': file_path, 'ok': False, 'error': analyzer.load_error or '加载失败'}
+        if output_dir and analyzer.aggregates.row_count > 0:
+            analyzer.create_visualizations()
+            analyzer.setup_visualization().close('all')
+        if analyzer.aggregates.row_count == 0:
+            return {'file': file_path, 'ok': False, 'error': '没有数据记录'}
+        return {'file': file_path, 'ok': True, 'aggregates': analyzer.aggregates.to_dict()}
+    except Exception as e:
+        return {'file': file_path, 'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+
+def run_batch(pattern, workers=None, chunksize=DEFAULT_CHUNKSIZE, output_dir=None, backend='pandas',
+              hist_range=SCORE_HIST_RANGE):
+    """批量分析多个年度/市场的ESG文件：进程池并行处理，合并为跨年度汇总报告
+
+    output_dir不为空时每个文件的总览图在各自的工作进程中渲染并保存到该目录。
+    """
+    files = _expand_batch_inputs(pattern)
+    if not files:
+        logger.error('❌ 没有匹配的文件: %s', pattern)
+        return None
+
+    workers = workers or os.cpu_count() or 1
+    logger.info('🚀 批量分析 %s 个文件，使用 %s 个进程', len(files), min(workers, len(files)))
+    logger.info('=' * 80)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(files))) as pool:
+        futures = {pool.submit(_analyze_file_worker, f, chunksize, output_dir, backend, hist_range): f for f in files}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # 工作进程异常退出时同样只记录该文件失败
+                result = {'file': futures[future], 'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            results.append(result)
+            status = "✅" if result['ok'] else f"❌ {result['error']}"
+            logger.info('  %s: %s', os.path.basename(result['file']), status)
+
+    results.sort(key=lambda r: r['file'])
+    succeeded = [r for r in results if r['ok']]
+    failed = [r for r in results if not r['ok']]
+    if not succeeded:
+        logger.error('❌ 所有文件均分析失败')
+        return None
+
+    per_file = [(r['file'], ESGAggregates.from_dict(r['aggregates'])) for r in succeeded]
+    combined = reduce(lambda a, b: a.merge(b), [agg for _, agg in per_file])
+
+    logger.info('\n' + '=' * 80)
+    logger.info('各文件ESG概况')
+    logger.info('=' * 80)
+    overview = pd.DataFrame([{
+        'file': os.path.basename(path),
+        'records': agg.row_count,
+        'companies': len(agg.companies),
+        'years': f"{agg.year_min}-{agg.year_max}" if agg.year_min is not None else '',
+        'avg_total_score': agg.score_mean('total_esg_score'),
+    } for path, agg in per_file])
+    logger.info('%s', _LazyText(lambda: overview.round(2).to_string(index=False)))
+
+    # 用合并后的汇总量输出跨年度报告
+    report = ESGDataAnalyzer(pattern, hist_range=hist_range)
+    report.aggregates = combined
+    report.descriptive_analysis()
+    report.generate_summary_report()
+
+    if failed:
+        logger.warning('\n⚠️ %s 个文件分析失败:', len(failed))
+        for r in failed:
+            logger.warning('  - %s: %s', r['file'], r['error'])
+    return {'combined': combined, 'results': results}
 
 
 # 主程序入口
 if __name__ == "__main__":
-    print("ESG数据分析工具 - 本地文件版")
-    print("=" * 50)
+    logger.info('ESG数据分析工具 - 本地文件版')
+    logger.info('=' * 50)
 
     # 可以指定不同的文件路径
     file_path = 'znttaqleyuk9pjxj.csv'  # 默认文件路径
-
-    # 创建分析器实例
-    analyzer = ESGDataAnalyzer(file_path)
-
-    # 运行完整分析
-    analyzer.run_complete_analysis()
+    # 命令行参数为目录或通配符时进入批量模式，例如: python ESG总体分析.py "data/esg_*.csv"
+    if len(sys.argv) > 1:
+        file_path = sys.argv[1]
+    # 文件达到数GB时设置为 DEFAULT_CHUNKSIZE 启用流式加载
+    chunksize = None
+    # 重复分析同一文件时使用列式缓存（需要安装pyarrow）
+    cache_dir = '.esg_cache'
+    # 每日增量更新时指定汇总状态文件，例如 'esg_state.json'
+    state_path = None
+    # 无界面服务器上设置输出目录，图表保存为文件而不是弹出窗口，例如 'esg_charts'
+    output_dir = os.environ.get('ESG_OUTPUT_DIR')
+    # 超大文件可设置 ESG_BACKEND=duckdb 或 polars，用惰性查询直接对CSV/Parquet计算汇总（需安装对应的包）
+    backend = os.environ.get('ESG_BACKEND', 'pandas')
+    # 上亿行数据设置 ESG_WORKERS=进程数，行业分组统计在共享内存上多进程分片计算
+    workers = int(os.environ.get('ESG_WORKERS', 0)) or None
+    # 日志级别和格式由环境变量控制：ESG_LOG_LEVEL=WARNING 静默运行，ESG_LOG_FORMAT=json 输出结构化日志
+    # 设置后把各阶段监控数据写入该文件：.prom为Prometheus文本格式，其余为JSON
+    metrics_path = os.environ.get('ESG_METRICS_PATH')
+    # 设置后在分析结束时写入内存映射评分存储，之后可用 ESGScoreStore(path).issuer(名称) 毫秒级查询单个发行人历史
+    score_store_path = os.environ.get('ESG_SCORE_STORE')
+    # 设置后总结报告写入该目录的报告产物存储；源文件未变化时直接复用上次的结果
+    report_dir = os.environ.get('ESG_REPORT_DIR')
+    # 设置后维护行业同业排名索引文件(.npz)，每次运行只合并新的评级快照；之后可用 ESGPeerIndex.load(path) 查询
+    peer_index_path = os.environ.get('ESG_PEER_INDEX')
+    # 设置 ESG_VALIDATE=1 时先校验数据质量，不合格则不进行分析；ESG_QUARANTINE 为问题行的输出文件
+    validate = os.environ.get('ESG_VALIDATE') == '1'
+    quarantine_path = os.environ.get('ESG_QUARANTINE')
+    # 上亿行数据快速探索时设置 ESG_APPROXIMATE=1，分位数/发行人数/频数由草图估计；ESG_SKETCH_PATH 为草图输出文件
+    approximate = os.environ.get('ESG_APPROXIMATE') == '1'
+    # 总分不是0-10分制时设置直方图范围，例如 ESG_HIST_RANGE=0,100
+    hist_range = SCORE_HIST_RANGE
+    if os.environ.get('ESG_HIST_RANGE'):
+        try:
+            hist_range = _parse_hist_range(os.environ['ESG_HIST_RANGE'])
+        except ValueError as e:
+            logger.error('❌ ESG_HIST_RANGE 无效: %s', e)
+            sys.exit(1)
+    sketch_path = os.environ.get('ESG_SKETCH_PATH')
+
+    if os.path.isdir(file_path) or glob.has_magic(file_path):
+        run_batch(file_path, output_dir=output_dir, backend=backend, hist_range=hist_range)
+    else:
+        # 创建分析器实例
+        analyzer = ESGDataAnalyzer(file_path, chunksize=chunksize, cache_dir=cache_dir, state_path=state_path,
+                                   output_dir=output_dir, backend=backend, workers=workers, report_dir=report_dir,
+                                   approximate=approximate, hist_range=hist_range)
+
+        if validate or quarantine_path:
+            report = analyzer.validate_data(quarantine_path=quarantine_path)
+            if validate and (report is None or report.failures()):
+                sys.exit(1)
+
+        # 运行完整分析；有可复用的报告产物时只输出总结报告
+        if not (score_store_path or peer_index_path) and analyzer.load_report() is not None:
+            analyzer.generate_summary_report()
+        else:
+            analyzer.run_complete_analysis()
+        if score_store_path:
+            analyzer.build_score_store(score_store_path)
+        if peer_index_path:
+            analyzer.build_peer_index(peer_index_path)
+        if approximate and sketch_path:
+            analyzer.save_sketches(sketch_path)
+        if metrics_path:
+            if metrics_path.endswith('.prom'):
+                analyzer.instrumentation.to_prometheus(metrics_path)
+            else:
+                analyzer.instrumentation.to_json(metrics_path)
@@ -0,0 +1,278 @@
+# esg_query_service.py
+# ESG数据本地查询服务：启动时加载并准备一次数据，常驻内存，通过HTTP按行业/评级/支柱/发行人查询
+# 用法: python ESG查询服务.py data.csv [--port 8765] [--cache-dir .esg_cache]
+# 示例: curl "http://127.0.0.1:8765/industries/Banks"
+#       curl "http://127.0.0.1:8765/issuers/ISSUER%2042?start=2020-01-01&end=2021-12-31"
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import numpy as np
+
+from ESG总体分析 import ESGDataAnalyzer, configure_logging, logger
+
+PILLAR_COLUMNS = ['environmental_score', 'social_score', 'governance_score']
+
+
+def _json_value(value):
+    """NumPy标量/NaN -> JSON可表示的值"""
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else float(value)
+    return value
+
+
+def _records(frame):
+    """DataFrame -> 行字典列表(索引作为普通字段)；float32分数保留6位小数，去掉转换成双精度后的尾数噪声"""
+    frame = frame.reset_index()
+    for col in frame.columns[frame.dtypes == 'float32']:
+        frame[col] = frame[col].astype('float64').round(6)
+    return [{str(k): _json_value(v) for k, v in row.items()} for row in frame.to_dict(orient='records')]
+
+
+class _LRUCache:
+    """线程安全的LRU响应缓存，键中包含数据代数，重新加载后旧结果自然失效"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class _Snapshot:
+    """一次加载的只读数据快照：汇总量 + 内存映射评分存储，查询线程共享，不做修改"""
+
+    def __init__(self, generation, aggregates, store, fingerprint):
+        self.generation = generation
+        self.aggregates = aggregates
+        self.store = store
+        self.fingerprint = fingerprint
+        self.loaded_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class ESGQueryService:
+    """常驻内存的ESG查询服务
+
+    数据由 ESGDataAnalyzer 加载并准备一次；后台线程轮询源文件，变化时在后台重新加载，
+    加载完成后整体替换快照，加载期间继续用旧快照响应查询。
+    """
+
+    def __init__(self, file_path, cache_dir=None, poll_interval=5.0, cache_size=256):
+        self.file_path = file_path
+        self.cache_dir = cache_dir
+        self.poll_interval = poll_interval
+        self.cache = _LRUCache(cache_size)
+        self.snapshot = None
+        self._work_dir = tempfile.mkdtemp(prefix='esg_service_')
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def _fingerprint(self):
+        stat = os.stat(self.file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def reload(self):
+        """加载并准备数据，建立评分存储后替换当前快照；同一时间只进行一次加载"""
+        with self._reload_lock:
+            fingerprint = self._fingerprint()
+            generation = 1 if self.snapshot is None else self.snapshot.generation + 1
+            started = time.perf_counter()
+            # 发行人查询需要明细数据，因此总是整体读入内存(pandas)，不使用流式或惰性查询后端
+            analyzer = self._prepare(self.cache_dir)
+            if analyzer.prepared_from_cache and analyzer.key_fields['date'] and analyzer._date_column() is None:
+                # 发行人按日期查询需要真实的评级日期；缓存中没有日期字段时绕过缓存重新解析
+                logger.warning('⚠️ 列式缓存中没有评级日期，改为直接解析源文件')
+                analyzer = self._prepare(None)
+            analyzer.calculate_esg_metrics()
+            store = analyzer.build_score_store(os.path.join(self._work_dir, f'store_{generation}'))
+            if store is None:
+                raise RuntimeError('评分存储建立失败')
+
+            previous, self.snapshot = self.snapshot, _Snapshot(generation, analyzer.aggregates, store, fingerprint)
+            self.cache.clear()
+            if previous is not None:
+                # 仍在处理旧快照的请求持有memmap引用，删除目录不影响已打开的映射
+                shutil.rmtree(previous.store.path, ignore_errors=True)
+            logger.info('✅ 数据已加载(第%s代): %s 条记录, 用时 %.2fs', generation, len(store),
+                        time.perf_counter() - started)
+
+    def _prepare(self, cache_dir):
+        analyzer = ESGDataAnalyzer(self.file_path, cache_dir=cache_dir)
+        if not analyzer.load_local_data():
+            raise RuntimeError(f'无法加载数据文件: {self.file_path}')
+        if not analyzer.prepare_esg_data(analyzer.identify_key_fields()):
+            raise RuntimeError(f'数据准备失败: {self.file_path}')
+        return analyzer
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if self._fingerprint() != self.snapshot.fingerprint:
+                    logger.info('🔄 检测到源文件变化，后台重新加载...')
+                    self.reload()
+            except Exception as e:
+                # 加载失败时保留旧快照继续服务
+                logger.warning('⚠️ 重新加载失败，继续使用旧数据: %s', e)
+
+    def start_watcher(self):
+        self._watcher = threading.Thread(target=self._watch, name='esg-reload', daemon=True)
+        self._watcher.start()
+
+    def close(self):
+        self._stop.set()
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+
+    def query(self, path, params):
+        """按路径和查询参数返回 (HTTP状态码, 响应对象)，结果按(数据代数, 路径, 参数)缓存；/health 总是实时返回"""
+        snapshot = self.snapshot
+        if path.strip('/') == 'health':
+            return self._health(snapshot)
+        key = (snapshot.generation, path, tuple(sorted(params.items())))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        result = self._dispatch(snapshot, path, params)
+        if result[0] == 200:
+            self.cache.put(key, result)
+        return result
+
+    def _dispatch(self, snapshot, path, params):
+        parts = [unquote(part) for part in path.strip('/').split('/') if part]
+        if parts == ['industries']:
+            return 200, _records(snapshot.aggregates.industry_summary().droplevel(0, axis=1))
+        if len(parts) == 2 and parts[0] == 'industries':
+            return self._industry(snapshot, parts[1])
+        if parts == ['ratings']:
+            counts = snapshot.aggregates.sorted_rating_counts()
+            return 200, [{'esg_rating': str(k), 'count': int(v)} for k, v in counts.items()]
+        if parts == ['pillars']:
+            return self._pillars(snapshot, params.get('industry'))
+        if len(parts) == 2 and parts[0] == 'issuers':
+            return self._issuer(snapshot, parts[1], params.get('start'), params.get('end'))
+        return 404, {'error': f'未知的查询路径: {path}'}
+
+    def _health(self, snapshot):
+        return 200, {'generation': snapshot.generation, 'loaded_at': snapshot.loaded_at,
+                     'rows': len(snapshot.store), 'cache_hits': self.cache.hits,
+                     'cache_misses': self.cache.misses}
+
+    def _industry(self, snapshot, name):
+        summary = snapshot.aggregates.industry_summary()
+        if summary.empty or name not in summary.index:
+            return 404, {'error': f'未找到行业: {name}'}
+        stats = _records(summary.droplevel(0, axis=1).loc[[name]])[0]
+        stats.pop('industry')
+        result = {'industry': name, 'total_esg_score': stats}
+        result['pillars'] = self._pillars(snapshot, name)[1]
+        return 200, result
+
+    def _pillars(self, snapshot, industry=None):
+        """三大支柱平均分；指定行业时从评分存储的行业行号索引计算"""
+        if industry is None:
+            return 200, {col: _json_value(snapshot.aggregates.score_mean(col)) for col in PILLAR_COLUMNS}
+        if industry not in snapshot.store.industries:
+            return 404, {'error': f'未找到行业: {industry}'}
+        columns = snapshot.store.industry(industry, as_frame=False)
+        return 200, {col: _json_value(np.nanmean(columns[col], dtype='float64')) if len(columns[col]) else None
+                     for col in PILLAR_COLUMNS if col in columns}
+
+    def _issuer(self, snapshot, name, start=None, end=None):
+        if snapshot.store.issuer_code(name) is None:
+            return 404, {'error': f'未找到发行人: {name}'}
+        try:
+            frame = snapshot.store.issuer(name, start=start, end=end)
+        except ValueError as e:
+            return 400, {'error': f'日期参数无效: {e}'}
+        frame['as_of_date'] = frame['as_of_date'].dt.strftime('%Y-%m-%d')
+        return 200, {'issuer': name, 'records': _records(frame.set_index('as_of_date'))}
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if self.service.snapshot is None:
+            status, body = 503, {'error': '数据仍在加载中'}
+        else:
+            try:
+                status, body = self.service.query(url.path, dict(parse_qsl(url.query)))
+            except Exception as e:
+                logger.exception('❌ 查询失败: %s', self.path)
+                status, body = 500, {'error': f'{type(e).__name__}: {e}'}
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+def serve(file_path, host='127.0.0.1', port=8765, cache_dir=None, poll_interval=5.0, cache_size=256):
+    """加载数据后启动多线程HTTP服务，直到 Ctrl+C"""
+    service = ESGQueryService(file_path, cache_dir=cache_dir, poll_interval=poll_interval, cache_size=cache_size)
+    service.reload()
+    service.start_watcher()
+    handler = type('QueryHandler', (_QueryHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    logger.info('🌐 ESG查询服务已启动: http://%s:%s/ (industries, ratings, pillars, issuers/<名称>, health)',
+                host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+# 主程序入口
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ESG数据本地查询服务')
+    parser.add_argument('file_path', nargs='?', default='znttaqleyuk9pjxj.csv', help='ESG数据文件')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=8765, help='监听端口')
+    parser.add_argument('--cache-dir', default='.esg_cache', help='列式缓存目录（需要安装pyarrow）')
+    parser.add_argument('--poll', type=float, default=5.0, help='检查源文件变化的间隔（秒）')
+    parser.add_argument('--cache-size', type=int, default=256, help='LRU响应缓存条数')
+    args = parser.parse_args()
+
+    configure_logging(os.environ.get('ESG_LOG_LEVEL', 'INFO'))
+    serve(args.file_path, host=args.host, port=args.port, cache_dir=args.cache_dir, poll_interval=args.poll,
+          cache_size=args.cache_size)
@@ -0,0 +1,51 @@
+# 内存(pandas)路径与惰性查询后端(DuckDB/Polars)的汇总统计一致性测试
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ESG总体分析 import ESGDataAnalyzer, SCORE_COLUMNS, configure_logging  # noqa: E402
+from ESG性能测试 import generate_synthetic_esg  # noqa: E402
+
+# 内存路径把分数存为float32，统计量按float64累加；剩余差异只来自float32对输入值的舍入
+RTOL = 1e-7
+
+
+@pytest.fixture(scope='module')
+def esg_csv(tmp_path_factory):
+    configure_logging('WARNING')
+    path = tmp_path_factory.mktemp('esg') / 'synthetic_esg.csv'
+    generate_synthetic_esg(20000, str(path), seed=7)
+    return str(path)
+
+
+@pytest.fixture(scope='module')
+def in_memory(esg_csv):
+    analyzer = ESGDataAnalyzer(esg_csv)
+    assert analyzer.load_local_data()
+    assert analyzer.prepare_esg_data(analyzer.identify_key_fields())
+    assert analyzer.financial_data['total_esg_score'].dtype == 'float32'
+    analyzer.calculate_esg_metrics()
+    return analyzer.aggregates
+
+
+@pytest.mark.parametrize('backend', ['duckdb', 'polars'])
+def test_in_memory_matches_backend(esg_csv, in_memory, backend):
+    pytest.importorskip(backend)
+    analyzer = ESGDataAnalyzer(esg_csv, backend=backend)
+    assert analyzer.load_local_data()
+    lazy = analyzer.aggregates
+
+    columns = SCORE_COLUMNS + ['esg_pillar_avg']
+    expected = lazy.numeric_summary()[columns]
+    actual = in_memory.numeric_summary()[columns]
+    assert (actual.loc['count'] == expected.loc['count']).all()
+    np.testing.assert_allclose(actual.to_numpy(dtype='float64'), expected.to_numpy(dtype='float64'), rtol=RTOL)
+
+    expected = lazy.industry_summary()
+    actual = in_memory.industry_summary()
+    assert list(actual.index) == list(expected.index)
+    np.testing.assert_allclose(actual.to_numpy(dtype='float64'), expected.to_numpy(dtype='float64'), rtol=RTOL)